@@ -1,5 +1,10 @@
+import threading
 from datetime import datetime
-import wx
+
+import cv2
+import numpy as np
+try: import wx
+except ImportError: wx = None # GUI classes are not available (e.g.: running 'mva_batch.py' on a server)
 
 #------------------------------------------------
 
@@ -48,30 +53,109 @@ def get_time_stamp():
                                                  ts.microsecond)
     return ts
 
-# ===========================================================
+#------------------------------------------------
 
-class PopupDialog(wx.Dialog):
-# Class for showing any message to the participant
-    def __init__(self, parent = None, id = -1, title = "Message", inString = "", font = None, pos = None, size = (200, 150), cancel_btn = False):
-        wx.Dialog.__init__(self, parent, id, title)
-        self.SetSize(size)
-        if pos == None: self.Center()
-        else: self.SetPosition(pos)
-        txt = wx.StaticText(self, -1, label = inString, pos = (20, 20))
-        txt.SetSize(size)
-        if font == None: font = wx.Font(12, wx.MODERN, wx.NORMAL, wx.FONTWEIGHT_NORMAL, False, "Arial", wx.FONTENCODING_SYSTEM)
-        txt.SetFont(font)
-        txt.Wrap(size[0]-30)
-        okButton = wx.Button(self, wx.ID_OK, "OK")
-        b_size = okButton.GetSize()
-        okButton.SetPosition((size[0] - b_size[0] - 20, size[1] - b_size[1] - 40))
-        okButton.SetDefault()
-        if cancel_btn == True:
-            cancelButton = wx.Button(self, wx.ID_CANCEL, "Cancel")
-            b_size = cancelButton.GetSize()
-            cancelButton.SetPosition((size[0] - b_size[0]*2 - 40, size[1] - b_size[1] - 40))
-        self.Center()
+class FrameMailbox(object):
+# Single-slot mailbox between an analysis thread and the GUI; only the latest posted frame is kept,
+# so that the GUI shows frames at its own rate without pacing the analysis.
+# Triple buffering; the analysis thread copies a frame into 'back', which is exchanged with 'ready'
+# under the lock, and the GUI takes 'ready' as 'front'. A buffer, which the GUI holds, is never written.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bufs = dict(back = None, ready = None, front = None)
+        self.info = None # information (frame index, result, ...) of the 'ready' frame
+        self.fresh = False # whether 'ready' wasn't taken yet
 
+    def post(self, img, info):
+    # called by the analysis thread
+        back = self.bufs['back']
+        if back is None or back.shape != img.shape: back = np.empty_like(img)
+        back[:] = img
+        with self.lock:
+            self.bufs['back'] = self.bufs['ready']
+            self.bufs['ready'] = back
+            self.info = info
+            self.fresh = True
+
+    def take(self):
+    # called by the GUI; returns the latest frame and its information, or (None, None) if nothing new was posted
+        with self.lock:
+            if self.fresh == False: return None, None
+            self.bufs['front'], self.bufs['ready'] = self.bufs['ready'], self.bufs['front']
+            self.fresh = False
+            return self.bufs['front'], self.info
+
+#------------------------------------------------
 
+class ColorLUT(object):
+# Color segmentation of HSV ranges from quantized BGR values, without HSV conversion of the whole image.
+# A BGR color is quantized to 16 bits (BGR565; 5 bits of blue & red, 6 bits of green) with one cv2.cvtColor,
+# and a table of the 65536 quantized colors (64 KB) of a HSV range gives the mask value of each pixel;
+# 255 when all the colors of the bin are in the range, 0 when none of them is, UNSURE when the bin
+# crosses the border of the range. Only the pixels of UNSURE bins are converted to HSV, so a mask is
+# identical to cv2.inRange of the HSV image.
+# The table of a range is computed when the range is used first, and kept (e.g.: ear color of each individual).
+    UNSURE = 1
+
+    def __init__(self):
+        self.tables = {} # key: (HSV_min, HSV_max)
+
+    def get_table(self, HSV_min, HSV_max):
+    # table of a HSV range; computed when the range is used first
+        key = (tuple(HSV_min), tuple(HSV_max))
+        if key in self.tables: return self.tables[key]
+        ### every color of each bin; index of a bin is B>>3 + (G>>2)<<5 + (R>>3)<<11
+        idx = np.arange(65536).reshape((256, 256))
+        bin_col = np.dstack( ((idx & 31) << 3, ((idx >> 5) & 63) << 2, (idx >> 11) << 3) ).astype(np.uint8)
+        HSV_min = np.array(HSV_min, dtype = np.uint8); HSV_max = np.array(HSV_max, dtype = np.uint8)
+        n_in = np.zeros((256, 256), dtype = np.uint16) # number of colors of each bin in the range
+        for b in xrange(8):
+            for g in xrange(4):
+                for r in xrange(8):
+                    col = bin_col + np.array((b, g, r), dtype = np.uint8)
+                    n_in += cv2.inRange(cv2.cvtColor(col, cv2.COLOR_BGR2HSV), HSV_min, HSV_max) & 1
+        table = np.empty(65536, dtype = np.uint8)
+        table[:] = self.UNSURE
+        table[n_in.reshape(65536) == 0] = 0
+        table[n_in.reshape(65536) == 256] = 255 # all 8x4x8 colors of the bin
+        self.tables[key] = table
+        return table
+
+    def mask(self, img, HSV_min, HSV_max, dst=None):
+    # binary image (255: in the HSV range) of a BGR image (numpy array), into 'dst' if it's given
+        table = self.get_table(HSV_min, HSV_max)
+        idx = cv2.cvtColor(img, cv2.COLOR_BGR2BGR565).view('<u2').reshape(img.shape[:2])
+        m = table.take(idx)
+        pts = cv2.findNonZero(cv2.compare(m, self.UNSURE, cv2.CMP_EQ))
+        if pts is not None: # pixels of UNSURE bins
+            xs = pts[:,0,0]; ys = pts[:,0,1]
+            m[ys, xs] = cv2.inRange(cv2.cvtColor(img[ys, xs].reshape((-1, 1, 3)), cv2.COLOR_BGR2HSV), HSV_min, HSV_max).reshape(-1)
+        if dst is None: return m
+        dst[:] = m
+        return dst
+
+# ===========================================================
 
+if wx != None:
+    class PopupDialog(wx.Dialog):
+    # Class for showing any message to the participant
+        def __init__(self, parent = None, id = -1, title = "Message", inString = "", font = None, pos = None, size = (200, 150), cancel_btn = False):
+            wx.Dialog.__init__(self, parent, id, title)
+            self.SetSize(size)
+            if pos == None: self.Center()
+            else: self.SetPosition(pos)
+            txt = wx.StaticText(self, -1, label = inString, pos = (20, 20))
+            txt.SetSize(size)
+            if font == None: font = wx.Font(12, wx.MODERN, wx.NORMAL, wx.FONTWEIGHT_NORMAL, False, "Arial", wx.FONTENCODING_SYSTEM)
+            txt.SetFont(font)
+            txt.Wrap(size[0]-30)
+            okButton = wx.Button(self, wx.ID_OK, "OK")
+            b_size = okButton.GetSize()
+            okButton.SetPosition((size[0] - b_size[0] - 20, size[1] - b_size[1] - 40))
+            okButton.SetDefault()
+            if cancel_btn == True:
+                cancelButton = wx.Button(self, wx.ID_CANCEL, "Cancel")
+                b_size = cancelButton.GetSize()
+                cancelButton.SetPosition((size[0] - b_size[0]*2 - 40, size[1] - b_size[1] - 40))
+            self.Center()
 
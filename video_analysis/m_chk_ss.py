@@ -37,7 +37,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import os, plistlib
+import os, plistlib, threading
 from glob import glob
 from copy import copy
 from math import degrees, radians, hypot, acos, sin, cos, atan2, pi
@@ -52,7 +52,7 @@ import cv2
 import cv2.cv as cv
 import numpy as np
 
-from common_funcs import GNU_notice, writeFile, get_time_stamp, PopupDialog
+from common_funcs import GNU_notice, writeFile, get_time_stamp, PopupDialog, FrameMailbox, ColorLUT
 
 #====================================================
 
@@ -73,6 +73,7 @@ class MChkSessionStart(wx.Frame):
 
         self.HSV_min_wht = (0, 0, 200)
         self.HSV_max_wht = (179, 50, 255)
+        self.color_lut = ColorLUT() # LED color segmentation (COLOR_LUT)
 
         self.font = cv.InitFont(cv.CV_FONT_HERSHEY_SIMPLEX, 0.5, 0.5, 0, 1, 8)
         self.video = None
@@ -82,6 +83,12 @@ class MChkSessionStart(wx.Frame):
 
         self.fps = 0
         self.last_fps_chk_time = -1
+        self.scan_thread = None # reads & checks frames while running, independently from the display
+        self.mailbox = FrameMailbox() # the latest checked frame, for the preview
+        self.LED_on_fi = -1 # frame index when a LED light was turned on
+        self.preview_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onPreviewTimer, self.preview_timer)
+        self.rgb_bufs = {} # RGB buffers for bitmaps; key: image shape
 
         posX = 5; posY = 10
         btn_choose_file = wx.Button( self.panel, 
@@ -155,19 +162,78 @@ class MChkSessionStart(wx.Frame):
             if self.LED_base_cm[key] == -1:
                 self.show_msg('[Base CM of LEDs] have to be set first.')
                 return
-        self.flag_run = not self.flag_run
-        self.proc_img()
+        if self.flag_run == True: self.stop_scan()
+        else: self.start_scan()
+
+    #------------------------------------------------
+
+    def start_scan(self):
+    # starts the scan thread and the preview timer
+        if debug: print 'MChkSessionStart.start_scan'
+
+        self.flag_run = True
+        self.scan_thread = threading.Thread(target = self.run_scan)
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+        self.preview_timer.Start(max(1, int(1000.0/PREVIEW_FPS)))
+
+    #------------------------------------------------
+
+    def stop_scan(self):
+    # stops the scan thread, then shows the last checked frame
+        if debug: print 'MChkSessionStart.stop_scan'
+
+        self.flag_run = False
+        if self.scan_thread != None:
+            self.scan_thread.join()
+            self.scan_thread = None
+        self.preview_timer.Stop()
+        self.onPreviewTimer(None)
+
+    #------------------------------------------------
+
+    def run_scan(self):
+    # scan thread; reads frames and checks LEDs until a LED light is turned on, the movie ends or it's stopped.
+    # each frame is posted into the mailbox, and the GUI shows the latest one at the preview rate.
+        if debug: print 'MChkSessionStart.run_scan'
+
+        while self.flag_run == True:
+            ret, frame = self.video.read()
+            if ret == False or frame is None: break # end of the movie
+            self.fi += 1
+            LED_on = self.chk_LED(frame)
+            self.mailbox.post(frame, (self.fi, LED_on))
+            self.count_fps()
+            if LED_on == True:
+                self.LED_on_fi = self.fi
+                break
+        self.flag_run = False
+
+    #------------------------------------------------
+
+    def onPreviewTimer(self, event):
+    # shows the latest checked frame (if there's a new one), at most 'PREVIEW_FPS' times per second
+        img, info = self.mailbox.take()
+        if img is not None: self.show_frame(img, *info)
+        if self.flag_run == False and self.scan_thread != None:
+        # the scan thread stopped by itself (a LED light was turned on, or the end of the movie)
+            self.scan_thread.join()
+            self.scan_thread = None
+            self.preview_timer.Stop()
+            self.onPreviewTimer(None) # a frame posted right before the end
+            if self.LED_on_fi != -1: self.show_LED_on_msg()
 
     #------------------------------------------------
     
     def cvImg_to_wxBMP(self, cvImg):
+    # cvImg: numpy array of BGR image
+    # it's converted into a RGB buffer (reused for the same image size), which the bitmap is made from
         if debug: print 'MChkSessionStart.cvImg_to_wxBMP'
 
-        cv.CvtColor(cvImg, cvImg, cv.CV_BGR2RGB)
-        img = wx.EmptyImage(cvImg.width, cvImg.height)
-        img.SetData(cvImg.tostring())
-        bmp = img.ConvertToBitmap()
-        return bmp
+        if cvImg.shape not in self.rgb_bufs: self.rgb_bufs[cvImg.shape] = np.empty_like(cvImg)
+        rgb_buf = self.rgb_bufs[cvImg.shape]
+        cv2.cvtColor(cvImg, cv2.COLOR_BGR2RGB, dst=rgb_buf)
+        return wx.BitmapFromBuffer(cvImg.shape[1], cvImg.shape[0], rgb_buf)
         '''
         wxBMP = wx.StaticBitmap( self.panel, 
                                  -1, 
@@ -271,56 +337,53 @@ class MChkSessionStart(wx.Frame):
                                UR = [_mx+150, _my-100, 15, 15],
                                LL = [_mx-150, _my-50, 15, 15],
                                LR = [_mx+150, _my-50, 15, 15] ) # [x, y, w, h]
-        self.LED_base_m = dict (UL = -1, UR = -1, LL = -1, LR = -1) # base zeroth moment
+        self.LED_base_cm = dict (UL = -1, UR = -1, LL = -1, LR = -1) # base zeroth moment
+        self.LED_on_fi = -1
 
         ### init openCV related variables
-        self.curr_frame = cv.CreateImage(self.frame_size, 8, 3)
-        self.orig_img = cv.CreateImage(self.frame_size, 8, 3)
-        self.HSV_img = cv.CreateImage(self.frame_size, 8, 3)
-        self.tmp_col_img = cv.CreateImage(self.frame_size, 8, 3)
+        self.curr_frame = np.empty_like(frame) # frame image to draw on
+        self.orig_img = frame
         self.init_grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
         self.grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
         self.grey_avg = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_32F, 1)
-        self.tmp_grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
         self.diff_grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
         self.grey_avg = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_32F, 1)
         self.storage = cv.CreateMemStorage(0)
-        self.mask_img = cv.CreateImage(self.frame_size, 8, 1)
         self.first_run = True
         self.flag_run = False
 
-        self.proc_img(cv.fromarray(frame)) # display the 1st frame
+        self.proc_img(frame) # display the 1st frame
 
     #------------------------------------------------
 
     def onStoreLEDBaseCM(self, event):
     # check each LED's base zeroth moments
+        if self.flag_run == True:
+        # the scan thread uses self.roi_mask & self.orig_img while it's running
+            self.show_msg_in_statbar('Stop the scan (space bar) first, to store the base CM of LEDs.')
+            return
         for key in self.LED_rects.iterkeys():
             self.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
                             self.orig_img, 
                             self.HSV_min_wht, 
                             self.HSV_max_wht, 
                             (0,0,0))
-            img_mat = cv.GetMat(self.tmp_grey_img)
-            moments = cv.Moments(img_mat)
-            cm = cv.GetCentralMoment(moments, 0, 0)
+            cm = cv2.moments(self.roi_mask)['m00'] # zeroth moment of the found color
             self.LED_base_cm[key] = cm
         self.show_msg('Zeroth moment of each LED is stored.')
 
     #------------------------------------------------
 
-    def chk_LED(self):
-    # check LED whether white light is on or not
+    def chk_LED(self, img):
+    # check LED whether white light is on or not in 'img' (numpy array of BGR image)
         LED_on = False
         for key in self.LED_rects.iterkeys():
             self.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
-                            self.orig_img, 
+                            img, 
                             self.HSV_min_wht,  
                             self.HSV_max_wht, 
                             (0,0,0))
-            img_mat = cv.GetMat(self.tmp_grey_img)
-            moments = cv.Moments(img_mat)
-            cm = cv.GetCentralMoment(moments, 0, 0)
+            cm = cv2.moments(self.roi_mask)['m00'] # zeroth moment of the found color
             if self.LED_base_cm[key] != -1 and cm > self.LED_base_cm[key] + 300:
                 LED_on = True
                 print key, self.LED_rects[key], self.LED_base_cm[key], cm
@@ -329,34 +392,52 @@ class MChkSessionStart(wx.Frame):
     #------------------------------------------------
 
     def proc_img(self, frame = None):
+    # read the next frame (or check 'frame' again, as the current frame), check LEDs, then display it.
+    # (while running, frames are checked in the scan thread instead; see run_scan)
         if debug: print 'MChkSessionStart.proc_img'
         if self.video == None: return
 
-        if frame == None:
-            self.orig_img = cv.fromarray(self.video.read()[1])
+        if frame is None:
+            ret, frame = self.video.read()
+            if ret == False or frame is None: return # end of the movie
             self.fi += 1
-            self.sTxt_frames.SetLabel('%i/%i'%(self.fi, self.frame_cnt))
-        else:
-            self.orig_img = frame
-        cv.Copy(self.orig_img, self.curr_frame)
-        LED_on = self.chk_LED()
+        LED_on = self.chk_LED(frame)
+        self.show_frame(frame, self.fi, LED_on)
         if LED_on == True:
-            cv.Circle(self.curr_frame, (self.w_size[0]/2,self.w_size[1]/2), 50, (0,0,200), -1)
-            _etime = float(self.fi+1) / 100
-            _msg = 'The movie recording started %.3f seconds before the experiment software started.\n'%(_etime)
-            _msg += '(Assumption: FPS of movie recording was 100)'
-            self.show_msg(_msg)
-            self.flag_run = False
+            self.LED_on_fi = self.fi
+            self.show_LED_on_msg()
 
+    #------------------------------------------------
+
+    def show_frame(self, frame, fi, LED_on):
+    # draws LED rects on a frame and displays it.
+    # only displayed frames are drawn; while running, it's called at the preview rate.
+        if debug: print 'MChkSessionStart.show_frame'
+
+        self.orig_img = frame
+        self.curr_frame[:] = frame
+        if LED_on == True:
+            cv2.circle(self.curr_frame, (self.w_size[0]/2,self.w_size[1]/2), 50, (0,0,200), -1)
         for key in self.LED_rects.iterkeys():
             _r = self.LED_rects[key]
-            cv.Rectangle(self.curr_frame, (_r[0], _r[1]), (_r[0]+_r[2], _r[1]+_r[3]), (0,0,255), 1)
-
+            cv2.rectangle(self.curr_frame, (_r[0], _r[1]), (_r[0]+_r[2], _r[1]+_r[3]), (0,0,255), 1)
         self.loaded_img.SetBitmap( self.cvImg_to_wxBMP(self.curr_frame) )
+        self.sTxt_frames.SetLabel('%i/%i'%(fi, self.frame_cnt))
 
-        if self.flag_run == True:
-            wx.FutureCall(1, self.proc_img)
+    #------------------------------------------------
+
+    def show_LED_on_msg(self):
+        if debug: print 'MChkSessionStart.show_LED_on_msg'
+
+        _etime = float(self.LED_on_fi+1) / 100
+        _msg = 'The movie recording started %.3f seconds before the experiment software started.\n'%(_etime)
+        _msg += '(Assumption: FPS of movie recording was 100)'
+        self.show_msg(_msg)
 
+    #------------------------------------------------
+
+    def count_fps(self):
+    # prints the number of checked frames per second
         if self.last_fps_chk_time == -1: self.last_fps_chk_time = time()
         if time()-self.last_fps_chk_time >= 1:
             print "FPS: %i"%self.fps
@@ -369,17 +450,22 @@ class MChkSessionStart(wx.Frame):
 
     def find_color(self, rect, inImage, HSV_min, HSV_max, bgcolor=(255,255,255)):
     # Find a color(range: 'HSV_min' ~ 'HSV_max') in an area('rect:[x,y,w,h]') of an image('inImage')
-    # 'bgcolor' is a background color of the masked image
-    # Result will be stored in self.tmp_grey_img
+    # 'bgcolor' is a background color of the masked image (not used; only 'rect' is processed)
+    # Result (binary image of 'rect') will be stored in self.roi_mask
         if debug: print 'MChkSessionStart.find_color'
 
-        cv.Zero(self.mask_img)
-        cv.Zero(self.tmp_grey_img)
-        cv.Set(self.tmp_col_img, bgcolor)
-        cv.Rectangle(self.mask_img, (rect[0], rect[1]), (rect[0]+rect[2], rect[1]+rect[3]), 255, cv.CV_FILLED)
-        cv.Copy(inImage, self.tmp_col_img, self.mask_img)
-        cv.CvtColor(self.tmp_col_img, self.HSV_img, cv.CV_BGR2HSV)
-        cv.InRangeS(self.HSV_img, HSV_min, HSV_max, self.tmp_grey_img)     
+        img = np.asarray(inImage)
+        ### filled rectangle, including (x+w, y+h)
+        x1 = max(0, rect[0]); y1 = max(0, rect[1])
+        x2 = min(img.shape[1], rect[0]+rect[2]+1); y2 = min(img.shape[0], rect[1]+rect[3]+1)
+        if x2 <= x1 or y2 <= y1:
+            self.roi_mask = np.zeros((1,1), dtype = np.uint8)
+            return
+        if COLOR_LUT == True:
+            self.roi_mask = self.color_lut.mask(img[y1:y2, x1:x2], HSV_min, HSV_max)
+        else:
+            roi_HSV = cv2.cvtColor(img[y1:y2, x1:x2], cv2.COLOR_BGR2HSV)
+            self.roi_mask = cv2.inRange(roi_HSV, np.array(HSV_min, dtype = np.uint8), np.array(HSV_max, dtype = np.uint8))
 
     #------------------------------------------------
 
@@ -427,6 +513,7 @@ class MChkSessionStart(wx.Frame):
 
     def onExit(self, event):
         if debug: print 'MChkSessionStart.onExit'
+        if self.flag_run == True: self.stop_scan()
         self.Destroy()
         
 
@@ -441,6 +528,9 @@ class MFE_App(wx.App):
 
 #====================================================
 
+PREVIEW_FPS = 15 # maximum number of displayed frames per second while running
+COLOR_LUT = False # LED color segmentation with a quantized BGR lookup table (ColorLUT in 'common_funcs.py'), instead of HSV conversion
+
 CWD = os.getcwd()
 debug = False
 
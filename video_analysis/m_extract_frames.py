@@ -56,19 +56,23 @@ from subprocess import call
 
 from common_funcs import GNU_notice
 
+FPS = 100 # FPS of the movie recording
+CROP = (640, 540, 320, 100) # cropping area (w, h, x, y) to eliminate irrelevant surroundings
+PRE_ONSET = 5.27 # the extracted frames start this many seconds before the stimulus onset
+DURATION = 10 # seconds to extract
+
 #------------------------------------------------
 
-def main(log_path, movie_path):
+def get_trial_list(log_path, movie_path):
+# returns a list of (trial folder name, stimulus onset time in the movie, index of the stimulus line in the LOG file)
+# of a session, without extracting frames or writing the LOG file.
+# ('mva_batch.py' uses this to analyze frames directly from the movie file)
     add_ts = -1
     mov_file_name = path.split(movie_path)[1].split('.')[0]
-    trial_mov_cnt = 0
+    trial_list = []
     f = open(log_path, 'r')
-    orig_lines = f.readlines()
-    f.close()
-    f = open(log_path, 'w')
-    for line in orig_lines:
+    for li, line in enumerate(f.readlines()):
         items = line.split(',')
-        f.write(line)
         if 'seconds have to be added' in line:
             add_ts = float(line.split('seconds have to be added')[0].split(',')[1])
         if len(items) > 2 and items[2].strip().lower() == 'auditory stimulus starts':
@@ -76,27 +80,42 @@ def main(log_path, movie_path):
             if add_ts == -1:
                 print 'ERROR:: add_ts is -1'
                 break
-            _ts = float(items[1])
-            _movie_ts = _ts + add_ts
-            f.write('# %.3f\n'%_movie_ts)
-            trial_mov_cnt += 1
-            _trial_mov_folder_name = mov_file_name + "_%.2i_%s"%(trial_mov_cnt, stim_fn)
-            ### Generate a tiral movie file 
-            ### ( 10 seconds movie, -5 ~ +5 around the stimulus onset )
-            _tmp_mov_name = _trial_mov_folder_name + '.mp4'
-            mkdir(_trial_mov_folder_name)
-            cmd = ['ffmpeg', 
-                   '-r', '100', 
-                   '-i', movie_path, 
-                   '-vf', 'crop=640:540:320:100',
-                   '-qscale:v', '3', 
-                   '-ss', str(_movie_ts-5.27), 
-                   '-t', '10', 
-                   '-r', '100', 
-                   path.join( _trial_mov_folder_name, 'f%06d.jpg' )]
-            print 'Excuting %s'%cmd
-            call(cmd)
+            _movie_ts = float(items[1]) + add_ts
+            _trial_mov_folder_name = mov_file_name + "_%.2i_%s"%(len(trial_list)+1, stim_fn)
+            trial_list.append( (_trial_mov_folder_name, _movie_ts, li) )
+    f.close()
+    return trial_list
+
+#------------------------------------------------
+
+def main(log_path, movie_path):
+    trial_list = get_trial_list(log_path, movie_path)
+    f = open(log_path, 'r')
+    orig_lines = f.readlines()
+    f.close()
+    ### stimulus onset time in the movie is written below the stimulus line of each trial
+    movie_ts_lines = dict([ (li, '# %.3f\n'%_movie_ts) for _trial_mov_folder_name, _movie_ts, li in trial_list ])
+    f = open(log_path, 'w')
+    for li, line in enumerate(orig_lines):
+        f.write(line)
+        if li in movie_ts_lines: f.write(movie_ts_lines[li])
     f.close()
+    for _trial_mov_folder_name, _movie_ts, li in trial_list:
+        ### Generate a tiral movie file 
+        ### ( 10 seconds movie, -5 ~ +5 around the stimulus onset )
+        _tmp_mov_name = _trial_mov_folder_name + '.mp4'
+        mkdir(_trial_mov_folder_name)
+        cmd = ['ffmpeg', 
+               '-r', str(FPS), 
+               '-i', movie_path, 
+               '-vf', 'crop=%i:%i:%i:%i'%CROP,
+               '-qscale:v', '3', 
+               '-ss', str(_movie_ts-PRE_ONSET), 
+               '-t', str(DURATION), 
+               '-r', str(FPS), 
+               path.join( _trial_mov_folder_name, 'f%06d.jpg' )]
+        print 'Excuting %s'%cmd
+        call(cmd)
             
 #------------------------------------------------
 
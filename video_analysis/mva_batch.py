@@ -0,0 +1,316 @@
+'''
+This is for analyzing the video data and calculating the head
+direction without GUI. (head turning experiment of common marmoset monkeys)
+It runs the same analysis as 'mva_surf.py' on all the directories in
+'results' directory, without displaying frames.
+
+Usage :
+python mva_batch.py [options] [calibration file path]
+
+Options :
+-p [number] : number of worker processes (default: number of CPUs)
+              Each trial directory is analyzed by one of worker processes.
+-r [number] : number of trial directories, which one worker process
+              analyzes before it's replaced with a new worker process
+              (default: 10), to bound memory usage of workers.
+-m [bf/flann] : descriptor matching method (default: bf)
+                bf: brute-force (exact), flann: approximate kd-tree
+-e [surf/orb] : feature engine for detecting & matching the head (default: surf)
+                surf: SURF (float descriptors), orb: ORB (binary descriptors,
+                Hamming distance); faster, and available in all OpenCV builds.
+                (see 'python mva_bench.py engines' for comparison)
+-d : descriptor cache; keypoints & descriptors of each frame are stored in
+     'results/features' directory, and read from there, instead of being
+     detected again, when the same frame is analyzed with the same feature
+     engine parameters. Re-running the analysis (with -n) after changing
+     matching, clustering or ear color parameters becomes much faster.
+     With this option, features are detected in the whole frame below the
+     feeding hole, also with -t option.
+-b [low,high] : keypoint budget; SURF hessian threshold is adjusted in
+     each trial to keep the number of keypoints per frame (scaled to the
+     whole frame below the feeding hole, averaged over 5 detections) in
+     this band, regardless of lighting. e.g.: -b 300,800
+-x [number] : only this number of keypoints with the strongest response
+              are kept in a detection. (at least 400; a lower number is
+              raised to 400, see README for the accuracy cost)
+     With -P, the threshold ('hessian_th') and the number of detected
+     keypoints ('detected') of each frame are in the profile CSV files.
+-t : track head; SURF detection only in a window around the predicted
+     head position. Whole frame is searched when the head wasn't found.
+-o : coarse-to-fine; the head region is first located by normalized
+     cross-correlation of the downscaled template image, rotated in 12
+     angles, against a quarter resolution frame, and SURF detection runs
+     only in that region. Whole frame is searched when the correlation is
+     low or the head wasn't found in the region. (with -t, after the
+     tracking window) It's turned off for the rest of a trial, when the
+     head was found in less than half of the regions of 50 frames.
+-k : optical flow tracking; after the head was found with SURF, its
+     matched points are followed into the next frames with pyramidal
+     Lucas-Kanade optical flow, instead of detecting SURF keypoints again.
+     SURF detection runs again when too few points pass the forward-
+     backward check, and after 30 tracked frames.
+-u : ear color segmentation with a lookup table of quantized BGR colors,
+     instead of HSV conversion of the head rect in every frame. The table
+     (64 KB) is computed once per ear color range; masks are identical.
+     (see 'python mva_bench.py color' for comparison)
+-g : motion gate; when nothing moved around the head since the previous
+     frame, the result of the previous frame is carried over (marked in
+     'Carried' column of the result CSV) without the full analysis.
+     The full analysis is forced after 10 carried frames.
+-G : global flip resolution; each frame is measured independently from
+     other frames (line perpendicular to the line connecting ears), and
+     which side the head faces is resolved for the whole trial at its end,
+     instead of comparing with the previous frame.
+-j [number] : split each trial into this number of chunks of frames,
+              which are analyzed in parallel by worker processes (-G is
+              implied). Results of a trial are written when all its
+              chunks are finished; a trial isn't resumed partially.
+              It can't be used with -P.
+-f [number] : number of frames read ahead by a background thread,
+              while a frame is analyzed (default: 8, 0: no read-ahead)
+-P : profile; write per-frame processing time of each stage and counters
+     (keypoints, matches, ...) of each trial in 'results/profile' directory,
+     and their summary (mean, p50, p95) of the run in
+     'results/profile/mva_profile_summary.csv'.
+-n : new run; analyze all the trials from the first frame, ignoring
+     checkpoints of a previous run. Without it, trials completed in a
+     previous run are skipped and a partially analyzed trial continues
+     after its last checkpoint ('results/checkpoint' directory).
+-l [LOG file path] -v [MP4 file path] : analyze trials directly from the
+     session movie file, without extracted JPG images. Trials and their
+     time windows are obtained from the LOG file, as 'm_extract_frames.py'
+     does. Result CSV files are still written in 'results' directory.
+
+Requirements :
+1) Same as 'mva_surf.py'; The current working directory should have
+'results' directory, which has directories containing extracted frames
+and template head images.
+2) Calibration file (plist), which has the position-Y of the feeding
+hole and HSV ranges of ear color of each individual.
+(Its format is described in 'mva_engine.py')
+'mva_surf.py' writes 'results/mva_calibration.plist' when the analysis
+starts, and it's used when no calibration file path is given.
+
+It will generate a result CSV file for each directory, named as same
+as the directory.
+
+----------------------------------------------------------------------
+Copyright (C) 2014 Jinook Oh, W. Tecumseh Fitch for ERC Advanced Grant
+SOMACCA # 230604
+- Contact: jinook.oh@univie.ac.at, tecumseh.fitch@univie.ac.at
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os, getopt, traceback
+from time import time
+from sys import argv
+from multiprocessing import Pool, cpu_count
+
+import cv2
+
+from common_funcs import GNU_notice
+from mva_engine import HeadDirectionAnalyzer, get_trial_sources, load_calibration, analyze_dir, get_profile_fp, summarize_profiles, analyze_chunk, finish_chunked_trial, load_checkpoint
+from m_extract_frames import CROP
+
+#------------------------------------------------
+
+def init_worker(calib, params, frame_size):
+# initializer of a worker process.
+# each worker has its own analyzer with image buffers allocated once here,
+# which are reused for all the trial directories the worker analyzes.
+    global worker_analyzer
+    cv2.setNumThreads(1) # parallelism comes from worker processes
+    worker_analyzer = HeadDirectionAnalyzer(calib, results_dir, params)
+    worker_analyzer.alloc_buffers(frame_size)
+
+#------------------------------------------------
+
+def analyze_dir_worker(trial):
+# analyze a trial in a worker process
+# trial: (trial directory name, frame source)
+# returns (directory name, number of frames, elapsed time, error message)
+    dirname, frame_source = trial
+    _s_time = time()
+    try:
+        frame_cnt = analyze_dir(worker_analyzer, dirname, frame_source)
+        return dirname, frame_cnt, time()-_s_time, None
+    except Exception:
+        return dirname, -1, time()-_s_time, traceback.format_exc()
+
+#------------------------------------------------
+
+def analyze_chunk_worker(chunk):
+# analyze a chunk of frames of a trial in a worker process
+# chunk: (trial directory name, frame source, first frame index, last frame index)
+# returns (directory name, last frame index, rows, confidence, number of frames, elapsed time, error message)
+    dirname, frame_source, start_fi, end_fi = chunk
+    _s_time = time()
+    try:
+        rows, confidence, frame_cnt = analyze_chunk(worker_analyzer, dirname, frame_source, start_fi, end_fi)
+        return dirname, end_fi, rows, confidence, frame_cnt, time()-_s_time, None
+    except Exception:
+        return dirname, end_fi, [], {}, 0, time()-_s_time, traceback.format_exc()
+
+#------------------------------------------------
+
+def get_chunks(dir_list, n_chunks, resume):
+# chunks of frames of trials; (trial directory name, frame source, first frame index, last frame index)
+# returns list of chunks and the number of chunks of each trial
+    chunks = []; n_trial_chunks = {}
+    for dirname, frame_source in dir_list:
+        if resume == True:
+            ckpt = load_checkpoint(results_dir, dirname)
+            if ckpt != None and ckpt['done'] == True: continue # completed in a previous run
+        size = max(1, -(-frame_source.frame_cnt // n_chunks)) # ceiling
+        for start_fi in xrange(1, frame_source.frame_cnt+1, size):
+            chunks.append( (dirname, frame_source, start_fi, min(frame_source.frame_cnt, start_fi+size-1)) )
+        n_trial_chunks[dirname] = len(xrange(1, frame_source.frame_cnt+1, size))
+    return chunks, n_trial_chunks
+
+#------------------------------------------------
+
+def run_chunks(chunks, n_trial_chunks, n_workers, init_args):
+# analyzes chunks of trials; a trial's result files are written when all its chunks are finished
+    if n_workers <= 1:
+        init_worker(*init_args)
+        results = ( analyze_chunk_worker(chunk) for chunk in chunks )
+    else:
+        pool = Pool(processes = n_workers, initializer = init_worker, initargs = init_args)
+        results = pool.imap_unordered(analyze_chunk_worker, chunks, chunksize = 1)
+    trials = {} # key: trial name, value: [rows, confidence, last frame index, number of frames, elapsed time, finished chunks, error]
+    cnt = 0
+    for dirname, end_fi, rows, confidence, frame_cnt, e_time, err in results:
+        if dirname not in trials: trials[dirname] = [ [], {}, 0, 0, 0.0, 0, None ]
+        t = trials[dirname]
+        t[0] += rows; t[1].update(confidence); t[2] = max(t[2], end_fi); t[3] += frame_cnt; t[4] += e_time; t[5] += 1
+        if err != None: t[6] = err
+        if t[5] < n_trial_chunks[dirname]: continue
+        ### all the chunks of the trial were analyzed
+        cnt += 1
+        if t[6] == None: finish_chunked_trial(results_dir, dirname, t[0], t[1], t[2])
+        print_progress(cnt, len(n_trial_chunks), dirname, t[3], t[4], t[6])
+        del trials[dirname]
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+
+#------------------------------------------------
+
+def print_progress(cnt, total, dirname, frame_cnt, e_time, err):
+    if err != None:
+        print '[%i/%i] %s : ERROR\n%s'%(cnt, total, dirname, err)
+    elif frame_cnt == -1:
+        print '[%i/%i] %s : completed in a previous run'%(cnt, total, dirname)
+    else:
+        print '[%i/%i] %s : %i frames, %.1f seconds (FPS: %.1f)'%(cnt,
+                                                                  total,
+                                                                  dirname,
+                                                                  frame_cnt,
+                                                                  e_time,
+                                                                  frame_cnt/max(e_time, 1e-6))
+
+#------------------------------------------------
+
+def main(calib_fp, params, n_workers, tasks_per_worker, log_path=None, movie_path=None, n_chunks=1):
+    if not os.path.isfile(calib_fp):
+        print '\nERROR:: Calibration file [%s] does not exist.\n'%calib_fp
+        return
+    dir_list = get_trial_sources(results_dir, log_path, movie_path) # list of (trial name, frame source)
+    if len(dir_list) == 0:
+        if movie_path != None: print '\nERROR:: There is no trial in [%s].\n'%log_path
+        else: print '\nERROR:: There is no folder containing JPG images in [%s].\n'%results_dir
+        return
+
+    calib = load_calibration(calib_fp)
+    if movie_path != None: frame_size = (CROP[0], CROP[1])
+    else: frame_size = cv2.imread(os.path.join(results_dir, dir_list[0][0], 'f000001.jpg')).shape[1::-1]
+    s_time = time()
+    if n_chunks > 1:
+        chunks, n_trial_chunks = get_chunks(dir_list, n_chunks, params.get('resume', True))
+        skipped = len(dir_list) - len(n_trial_chunks)
+        if skipped > 0: print '%i trial(s) completed in a previous run'%skipped
+        n_workers = max(1, min(n_workers, len(chunks)))
+        run_chunks(chunks, n_trial_chunks, n_workers, (calib, params, frame_size))
+        print 'Finished. %i folders, %i chunks, %i worker(s), %.1f seconds'%(len(n_trial_chunks), len(chunks), n_workers, time()-s_time)
+        return
+    n_workers = min(n_workers, len(dir_list))
+    if n_workers <= 1:
+        init_worker(calib, params, frame_size)
+        for di in xrange(len(dir_list)):
+            print_progress(di+1, len(dir_list), *analyze_dir_worker(dir_list[di]))
+    else:
+        pool = Pool(processes = n_workers,
+                    initializer = init_worker,
+                    initargs = (calib, params, frame_size),
+                    maxtasksperchild = tasks_per_worker)
+        ### only this (parent) process prints, in the order of completion
+        cnt = 0
+        for ret in pool.imap_unordered(analyze_dir_worker, dir_list, chunksize = 1):
+            cnt += 1
+            print_progress(cnt, len(dir_list), *ret)
+        pool.close()
+        pool.join()
+    print 'Finished. %i folders, %i worker(s), %.1f seconds'%(len(dir_list), n_workers, time()-s_time)
+    if params.get('profile', False) == True:
+        fp_list = [ get_profile_fp(results_dir, dirname) for dirname, frame_source in dir_list ]
+        summary_fp = os.path.join(results_dir, 'profile', 'mva_profile_summary.csv')
+        print '\n'.join( summarize_profiles(fp_list, summary_fp) )
+
+#------------------------------------------------
+
+CWD = os.getcwd()
+results_dir = os.path.join(CWD, "results")
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == '-w': GNU_notice(1)
+    elif len(argv) > 1 and argv[1] == '-c': GNU_notice(2)
+    else:
+        GNU_notice(0)
+        n_workers = cpu_count()
+        tasks_per_worker = 10
+        params = {} # analysis parameters, different from default values (DEFAULT_PARAMS in 'mva_engine.py')
+        log_path = None; movie_path = None
+        n_chunks = 1
+        opts, args = getopt.getopt(argv[1:], 'p:r:m:e:db:x:tokugGj:f:Pnl:v:')
+        for opt, val in opts:
+            if opt == '-p': n_workers = int(val)
+            elif opt == '-r': tasks_per_worker = int(val)
+            elif opt == '-m': params['match_method'] = val
+            elif opt == '-e': params['feature_engine'] = val
+            elif opt == '-d': params['feature_cache'] = True
+            elif opt == '-b': params['kp_band'] = tuple([ int(v) for v in val.split(',') ])
+            elif opt == '-x': params['kp_max'] = int(val)
+            elif opt == '-t': params['track_head'] = True
+            elif opt == '-o': params['coarse_loc'] = True
+            elif opt == '-k': params['lk_track'] = True
+            elif opt == '-u': params['color_lut'] = True
+            elif opt == '-g': params['motion_gate'] = True
+            elif opt == '-G': params['flip_mode'] = 'global'
+            elif opt == '-j':
+                n_chunks = int(val)
+                params['flip_mode'] = 'global' # frames have to be independent from the previous frames
+            elif opt == '-f': params['prefetch'] = int(val)
+            elif opt == '-P': params['profile'] = True
+            elif opt == '-n': params['resume'] = False
+            elif opt == '-l': log_path = val
+            elif opt == '-v': movie_path = val
+        if len(args) > 0: calib_fp = args[0]
+        else: calib_fp = os.path.join(results_dir, 'mva_calibration.plist')
+        if (log_path == None) != (movie_path == None):
+            print '\nERROR:: Both of LOG file (-l) and MP4 file (-v) have to be given.\n'
+        elif n_chunks > 1 and params.get('profile', False) == True:
+            print '\nERROR:: Profile (-P) is not available with chunks (-j); frames of a trial are processed in different processes.\n'
+        else:
+            main(calib_fp, params, n_workers, tasks_per_worker, log_path, movie_path, n_chunks)
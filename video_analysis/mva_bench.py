@@ -0,0 +1,604 @@
+'''
+This is for benchmarking parts of the head direction analysis of
+'mva_engine.py'. (head turning experiment of common marmoset monkeys)
+
+Usage :
+python mva_bench.py clustering [trial directory name]
+  Compares cluster_points (mva_engine.py) with fclusterdata of scipy,
+  which was used before; whether both give identical groups, and
+  their processing time.
+  With a trial directory name (a directory in 'results' directory),
+  SURF matched points (threshold 100) and ear contour centers
+  (threshold 55) of its frames are used. Otherwise, random point sets
+  are used.
+
+python mva_bench.py make_synthetic [number of trials] [number of frames]
+  Generates synthetic trials (default: 3 trials of 300 frames) in
+  'synthetic' directory, which has the same layout as 'results'
+  directory; template head image (G0_Synth_head.jpg), calibration file
+  and trial directories (G0_Synth_01_SYN_1/f000001.jpg, ...).
+  A textured head (rotated template image) with two bright ear blobs
+  moves and turns with known head directions, which are written in
+  'truth.csv' of each trial directory.
+
+python mva_bench.py synthetic [-m bf/flann] [-e surf/orb] [-d] [-b low,high] [-x number]
+                            [-t] [-o] [-k] [-u] [-g] [-G]
+  Analyzes the synthetic trials and reports frames per second, cost of
+  each stage (mean, p50, p95) and error of head direction against the
+  ground truth. Options are same as 'mva_batch.py'.
+  With -d, the first run fills the descriptor cache of the synthetic
+  trials ('synthetic/features') and following runs read from it.
+  The angle error is measured regardless of 180 degrees flip (0~90),
+  and the ratio of opposite directions is reported separately.
+  Synthetic heads face upward (toward the feeding hole) in the first
+  frame, as the analysis assumes for a new head direction, and turn
+  beyond the horizontal line; opposite directions are frames, where
+  the analysis lost which side the head faces.
+
+python mva_bench.py engines [-e surf,orb] [trial directory names]
+  Analyzes trials with each feature engine (default: surf,orb) and
+  reports frames per second, detection & matching time per frame and
+  agreement of head directions with the first engine (mean axial
+  difference, ratio of frames within 10 degrees). Error against the
+  ground truth is also reported for synthetic trials.
+  Without trial directory names, synthetic trials are used.
+
+python mva_bench.py sweep_check [-e surf/orb] [-G]
+  Self-check of 'mva_sweep.py'; the synthetic trials are analyzed as
+  'mva_batch.py' does (result CSV files are the reference), then with
+  the same parameters as a sweep job. All the frames should agree.
+
+python mva_bench.py color [trial directory names]
+  Ear color segmentation of find_color (mva_engine.py) with HSV conversion
+  and with the quantized BGR lookup table (ColorLUT of common_funcs.py,
+  -u option of 'mva_batch.py') in a head sized rect of each frame;
+  whether both give identical masks (frames and pixels), ratio of pixels
+  converted to HSV by the table, and their processing time per frame.
+  The same for the LED white color in 4 small rects, as 'm_chk_ss.py'
+  does.
+  Without trial directory names, synthetic trials are used.
+
+python mva_bench.py alloc [-e surf/orb] [trial directory names]
+  Image buffer allocations of the analysis and the display (as
+  'mva_surf.py' does) and peak resident memory, with buffers allocated
+  for every frame, as the previous pipeline did (copy), and with the
+  preallocated buffers, which are allocated only when the frame size
+  changes (reuse). Both are counted in the same way.
+  Without trial directory names, synthetic trials are used.
+
+----------------------------------------------------------------------
+Copyright (C) 2014 Jinook Oh, W. Tecumseh Fitch for ERC Advanced Grant
+SOMACCA # 230604
+- Contact: jinook.oh@univie.ac.at, tecumseh.fitch@univie.ac.at
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os, getopt, resource
+from multiprocessing import Pool
+from time import time
+from sys import argv
+from math import sin, cos, pi, radians
+
+import cv2
+import numpy as np
+from scipy.cluster.hierarchy import fclusterdata
+
+import mva_sweep
+
+from common_funcs import GNU_notice, ColorLUT
+from mva_engine import HeadDirectionAnalyzer, load_calibration, save_calibration, cluster_points, get_trial_dirs, analyze_dir, get_profile_fp, summarize_profiles, load_result, DirFrameSource, draw_result, get_ear_HSV_min, ear_color_lut
+
+#------------------------------------------------
+
+def fcluster_groups(pt_list, threshold):
+# groups of points with fclusterdata (previous clustering of 'mva_surf.py')
+    if len(pt_list) < 2: return [ [pt] for pt in pt_list ] # fclusterdata needs, at least, 2 points
+    result = fclusterdata(np.asarray(pt_list, dtype = np.float64), threshold, 'distance')
+    groups = []
+    for i in xrange(max(result)): groups.append([])
+    for i in xrange(len(result)): groups[result[i]-1].append(pt_list[i])
+    return groups
+
+#------------------------------------------------
+
+def canonical(groups):
+# groups in a comparable form, regardless of the order of groups and points
+    return sorted([ sorted(g) for g in groups ])
+
+#------------------------------------------------
+
+def compare_clustering(pt_sets):
+# pt_sets: list of (point list, threshold)
+    n_same = 0
+    t_fcluster = 0.0; t_grid = 0.0
+    for pt_list, threshold in pt_sets:
+        s_time = time()
+        groups1 = fcluster_groups(pt_list, threshold)
+        t_fcluster += time() - s_time
+        s_time = time()
+        groups2 = cluster_points(pt_list, threshold)[1]
+        t_grid += time() - s_time
+        if canonical(groups1) == canonical(groups2): n_same += 1
+        else: print 'DIFFERENT :: %i points, threshold %i'%(len(pt_list), threshold)
+    print '%i point sets, identical groups: %i'%(len(pt_sets), n_same)
+    print 'fclusterdata   : %.3f ms per point set'%(t_fcluster*1000/max(1, len(pt_sets)))
+    print 'cluster_points : %.3f ms per point set'%(t_grid*1000/max(1, len(pt_sets)))
+
+#------------------------------------------------
+
+def random_pt_sets():
+# random point sets, similar to matched points; a few dense groups and scattered points
+    rng = np.random.RandomState(0)
+    pt_sets = []
+    for n in [5, 20, 50, 100, 200, 400, 800]:
+        for threshold in [55, 100]:
+            for i in xrange(10):
+                centers = rng.uniform(0, 640, (rng.randint(1, 6), 2))
+                pts = centers[rng.randint(0, len(centers), n)] + rng.normal(0, threshold*0.7, (n, 2))
+                pts[:n/5] = rng.uniform(0, 640, (n/5, 2)) # scattered points
+                pt_sets.append( ([ tuple(pt) for pt in pts.astype(np.int32).tolist() ], threshold) )
+    return pt_sets
+
+#------------------------------------------------
+
+def recorded_pt_sets(dirname):
+# matched points & ear contour centers of frames in a trial directory
+    calib_fp = os.path.join(results_dir, 'mva_calibration.plist')
+    if not os.path.isfile(calib_fp): calib_fp = None
+    analyzer = HeadDirectionAnalyzer(load_calibration(calib_fp), results_dir)
+    analyzer.init_trial(dirname)
+    pt_sets = []
+    fi = 1
+    while True:
+        _fp = os.path.join(results_dir, dirname, 'f%.6i.jpg'%fi)
+        if os.path.isfile(_fp) == False: break
+        frame = cv2.imread(_fp)
+        analyzer.alloc_buffers( (frame.shape[1], frame.shape[0]) )
+        hgrey = analyzer.preprocessing(frame)
+        nn_pts, matched, m_pts = analyzer.match_head(hgrey, (0, analyzer.feeding_hole_Y, analyzer.frame_size[0], analyzer.frame_size[1]))
+        if len(m_pts) > 0: pt_sets.append( (m_pts, 100) )
+        center = analyzer.find_head(m_pts)
+        if center != None:
+            h_rect = [center[0]-150, max(analyzer.feeding_hole_Y+1, center[1]-100), center[0]+150, center[1]+100]
+            analyzer.find_color(h_rect, frame, analyzer.HSV_min_ear, analyzer.HSV_max_ear, (0,0,0))
+            _center_pt_list = [ tuple(pt) for pt in analyzer.get_blobs(analyzer.roi_mask, analyzer.s_frag_th, analyzer.roi_offset)[2].tolist() ]
+            if len(_center_pt_list) > 0: pt_sets.append( (_center_pt_list, 55) )
+        fi += 1
+    return pt_sets
+
+#------------------------------------------------
+
+def make_head_texture(rng, size):
+# textured head image (BGR) with many corners for SURF; dark and saturated enough not to be an ear color
+    h, w = size
+    tex = rng.randint(10, 120, (h/8, w/8, 3)).astype(np.uint8)
+    tex = cv2.resize(tex, (w, h), interpolation = cv2.INTER_NEAREST)
+    for i in xrange(12): # some blobs and lines
+        _c = tuple([ int(v) for v in rng.randint(0, 120, 3) ])
+        _pt = ( int(rng.randint(0, w)), int(rng.randint(0, h)) )
+        if i % 2 == 0: cv2.circle(tex, _pt, int(rng.randint(4, 15)), _c, -1)
+        else: cv2.line(tex, _pt, ( int(rng.randint(0, w)), int(rng.randint(0, h)) ), _c, 3)
+    mask = np.zeros((h, w), np.uint8)
+    cv2.ellipse(mask, (w/2, h/2), (w/2-1, h/2-1), 0, 0, 360, 255, -1)
+    tex[mask == 0] = 50 # outside of the head
+    return tex, mask
+
+#------------------------------------------------
+
+def make_synthetic_trial(dir_path, head, mask, rng, n_frames, feeding_hole_Y):
+# renders frames (f000001.jpg, ...) of a synthetic trial and its ground truth (truth.csv) in 'dir_path'
+# the head moves slowly below the feeding hole and turns; two ear blobs are perpendicular to the head direction.
+# the head faces upward (toward the feeding hole) in the first frame, which is the side the analysis takes
+# for a new head direction, and turns beyond the horizontal line, where the side has to be kept by the analysis.
+    os.mkdir(dir_path)
+    w, h = SYNTH_FRAME_SIZE
+    bg = cv2.GaussianBlur(rng.randint(20, 90, (h, w, 3)).astype(np.uint8), (7,7), 0) # background
+    hh, hw = head.shape[:2]
+    hd_base = rng.uniform(60, 120) # head direction in the first frame; upward
+    hd_amp = rng.uniform(100, 140) # amplitude of head turning; beyond the horizontal line on one side at least
+    hd_period = rng.uniform(150, 250) # period of head turning (frames)
+    truth = open( os.path.join(dir_path, 'truth.csv'), 'w' )
+    truth.write('Frame-index, Direction, Head-center\n')
+    for fi in xrange(1, n_frames+1):
+        hd = ( hd_base + hd_amp*sin(2*pi*fi/hd_period) ) % 360 # head direction (degrees, counterclockwise from the right)
+        cx = int( w/2 + 120*sin(2*pi*fi/700.0) )
+        cy = int( (feeding_hole_Y+h)/2 + 40*cos(2*pi*fi/500.0) )
+        img = bg.copy()
+        ### head; rotated template image
+        rot_mat = cv2.getRotationMatrix2D((hw/2.0, hh/2.0), hd, 1.0)
+        rot_mat[:,2] += (cx-hw/2.0, cy-hh/2.0) # to the head position in the frame
+        _head = cv2.warpAffine(head, rot_mat, (w, h))
+        _mask = cv2.warpAffine(mask, rot_mat, (w, h))
+        img[_mask > 127] = _head[_mask > 127]
+        ### ears; bright blobs on both sides of the head
+        for side in [90, -90]:
+            _r = radians(hd + side)
+            _pt = ( int(cx + SYNTH_EAR_DIST*cos(_r)), int(cy - SYNTH_EAR_DIST*sin(_r)) )
+            cv2.ellipse(img, _pt, (14, 11), -hd, 0, 360, (235,235,235), -1)
+        cv2.imwrite( os.path.join(dir_path, 'f%.6i.jpg'%fi), img, [cv2.IMWRITE_JPEG_QUALITY, 90] )
+        truth.write( '%i, %.2f, %i/%i\n'%(fi-1, hd, cx, cy) )
+    truth.close()
+
+#------------------------------------------------
+
+def make_synthetic(n_trials, n_frames):
+# synthetic results directory; template head image, calibration file and trial directories
+    if os.path.isdir(synth_dir):
+        print '\nERROR:: [%s] already exists.\n'%synth_dir
+        return
+    os.mkdir(synth_dir)
+    rng = np.random.RandomState(0)
+    head, mask = make_head_texture(rng, SYNTH_HEAD_SIZE)
+    cv2.imwrite( os.path.join(synth_dir, 'G0_Synth_head.jpg'), head, [cv2.IMWRITE_JPEG_QUALITY, 95] )
+    calib = load_calibration(None)
+    save_calibration( os.path.join(synth_dir, 'mva_calibration.plist'), calib )
+    for ti in xrange(n_trials):
+        dirname = 'G0_Synth_%.2i_SYN_1'%(ti+1)
+        make_synthetic_trial(os.path.join(synth_dir, dirname), head, mask, rng, n_frames, calib['feeding_hole_Y'])
+        print '%s : %i frames'%(dirname, n_frames)
+
+#------------------------------------------------
+
+def read_directions(fp, col):
+# reads frame indices and directions of a ground truth file
+# col: column index of direction
+    directions = {}
+    for line in open(fp, 'r').readlines():
+        if line.startswith('#') or line.startswith('Frame-'): continue
+        items = line.split(',')
+        if len(items) <= col: continue
+        directions[int(items[0])] = float(items[col])
+    return directions
+
+#------------------------------------------------
+
+def run_synthetic(params):
+# analyzes synthetic trials and reports speed, per-stage cost and angle error against the ground truth
+    dir_list = [ d for d in get_trial_dirs(synth_dir) if os.path.isfile(os.path.join(synth_dir, d, 'truth.csv')) ]
+    if len(dir_list) == 0:
+        print '\nERROR:: There is no synthetic trial in [%s]. (python mva_bench.py make_synthetic)\n'%synth_dir
+        return
+    params['profile'] = True
+    params['resume'] = False # always analyze all the frames
+    analyzer = HeadDirectionAnalyzer(load_calibration(os.path.join(synth_dir, 'mva_calibration.plist')), synth_dir, params)
+    n_frames = 0; e_time = 0.0
+    errs = [] # axial error (degrees, 0~90); head direction has 180 degrees ambiguity before the flip correction
+    n_flipped = 0 # directions, which are opposite to the ground truth
+    n_carried = 0 # results carried over by the motion gate
+    for dirname in dir_list:
+        s_time = time()
+        n_frames += analyze_dir(analyzer, dirname)
+        e_time += time() - s_time
+        truth = read_directions(os.path.join(synth_dir, dirname, 'truth.csv'), 1)
+        result = load_result(os.path.join(synth_dir, dirname + '.csv'))
+        n_carried += result['carried'].sum()
+        for _fi, r_deg in zip(result['frame'], result['direction']):
+            diff = abs(r_deg - truth[_fi]) % 360
+            if diff > 180: diff = 360 - diff
+            if diff > 90: n_flipped += 1
+            errs.append( min(diff, 180-diff) )
+    print '%i trials, %i frames, %.1f seconds (FPS: %.1f)'%(len(dir_list), n_frames, e_time, n_frames/max(e_time, 1e-6))
+    print 'Frames with head direction: %i (%.1f %%)'%(len(errs), 100.0*len(errs)/max(1, n_frames))
+    if len(errs) > 0:
+        errs = np.asarray(errs)
+        print 'Angle error (degrees) : mean %.2f, p50 %.2f, p95 %.2f'%(errs.mean(), np.percentile(errs, 50), np.percentile(errs, 95))
+        print 'Opposite directions : %i (%.1f %%)'%(n_flipped, 100.0*n_flipped/len(errs))
+        print 'Carried results (motion gate) : %i (%.1f %%)'%(n_carried, 100.0*n_carried/len(errs))
+    fp_list = [ get_profile_fp(synth_dir, dirname) for dirname in dir_list ]
+    print '\n'.join( summarize_profiles(fp_list, os.path.join(synth_dir, 'profile', 'mva_profile_summary.csv')) )
+
+#------------------------------------------------
+
+def axial_diff(a, b):
+# difference of two directions regardless of 180 degrees flip (0~90)
+    diff = abs(a - b) % 360
+    if diff > 180: diff = 360 - diff
+    return min(diff, 180-diff)
+
+#------------------------------------------------
+
+def bench_engines(r_dir, dir_list, engine_names):
+# analyzes trials with each feature engine and reports speed (whole frame, detection and matching)
+# and agreement of head directions with the first engine (and with the ground truth of synthetic trials)
+    calib_fp = os.path.join(r_dir, 'mva_calibration.plist')
+    if not os.path.isfile(calib_fp): calib_fp = None
+    calib = load_calibration(calib_fp)
+    directions = {} # key: engine name, value: {(dirname, frame index): direction}
+    for name in engine_names:
+        analyzer = HeadDirectionAnalyzer(calib, r_dir, dict(feature_engine = name, profile = True, prefetch = 0))
+        directions[name] = {}
+        n_frames = 0; e_time = 0.0
+        stage_times = dict(detect = 0.0, match = 0.0)
+        n_keypoints = 0
+        for dirname in dir_list:
+            analyzer.init_trial(dirname)
+            analyzer.prof.reset()
+            for fi, frame in DirFrameSource(r_dir, dirname):
+                s_time = time()
+                analyzer.prof.start_frame(fi)
+                res = analyzer.proc_frame(fi, frame)
+                analyzer.prof.end_frame()
+                e_time += time() - s_time
+                n_frames += 1
+                if res['row'] != None: directions[name][(dirname, fi)] = res['row'][2]
+            for _fi, total, stages, counts in analyzer.prof.rows:
+                for stage in stage_times.keys(): stage_times[stage] += stages.get(stage, 0.0)
+                n_keypoints += counts.get('keypoints', 0)
+        if n_frames == 0:
+            print '\nERROR:: There is no frame to analyze.\n'
+            return
+        print '[%s] %i frames, FPS: %.1f, detection %.2f ms/frame, matching %.2f ms/frame, keypoints %.1f/frame'%(name,
+                                                                            n_frames,
+                                                                            n_frames/max(e_time, 1e-6),
+                                                                            stage_times['detect']*1000/n_frames,
+                                                                            stage_times['match']*1000/n_frames,
+                                                                            float(n_keypoints)/n_frames)
+        print '    Frames with head direction: %i (%.1f %%)'%(len(directions[name]), 100.0*len(directions[name])/n_frames)
+        if name != engine_names[0]:
+        # agreement with the first engine (reference; SURF by default)
+            common = [ key for key in directions[name].keys() if key in directions[engine_names[0]] ]
+            if len(common) > 0:
+                diffs = np.array([ axial_diff(directions[name][key], directions[engine_names[0]][key]) for key in common ])
+                print '    Agreement with [%s] in %i frames : mean difference %.2f degrees, within 10 degrees %.1f %%'%(engine_names[0],
+                                                                                                                     len(common),
+                                                                                                                     diffs.mean(),
+                                                                                                                     100.0*(diffs<=10).mean())
+        errs = []
+        for dirname in dir_list:
+            truth_fp = os.path.join(r_dir, dirname, 'truth.csv')
+            if not os.path.isfile(truth_fp): continue
+            truth = read_directions(truth_fp, 1)
+            errs += [ axial_diff(r_deg, truth[key[1]]) for key, r_deg in directions[name].iteritems() if key[0] == dirname ]
+        if len(errs) > 0:
+            errs = np.asarray(errs)
+            print '    Angle error against the ground truth (degrees) : mean %.2f, p50 %.2f, p95 %.2f'%(errs.mean(),
+                                                                                                    np.percentile(errs, 50),
+                                                                                                    np.percentile(errs, 95))
+
+#------------------------------------------------
+
+def check_sweep(params):
+# analyzes the synthetic trials as 'mva_batch.py' does, then as a sweep job of 'mva_sweep.py' with the same parameters,
+# and reports the agreement, which should be 100 %
+    dir_list = get_trial_dirs(synth_dir)
+    if len(dir_list) == 0:
+        print '\nERROR:: There is no synthetic trial in [%s]. (python mva_bench.py make_synthetic)\n'%synth_dir
+        return
+    params['resume'] = False
+    params['prefetch'] = 0
+    calib = load_calibration(os.path.join(synth_dir, 'mva_calibration.plist'))
+    analyzer = HeadDirectionAnalyzer(calib, synth_dir, params)
+    mva_sweep.results_dir = synth_dir
+    mva_sweep.init_worker(calib)
+    n_all_agree = 0
+    for dirname in dir_list:
+        analyze_dir(analyzer, dirname)
+        result = load_result(os.path.join(synth_dir, dirname + '.csv'))
+        ref = dict( zip(result['frame'].tolist(), result['direction'].tolist()) )
+        set_id, _dirname, frame_cnt, e_time, directions, err = mva_sweep.sweep_job( (0, params, dirname) )
+        if err != None:
+            print '%s : ERROR\n%s'%(dirname, err)
+            continue
+        n_common, sum_diff, n_agree = mva_sweep.compare_directions(directions, ref)
+        flag_ok = n_common == len(ref) == len(directions) and n_agree == len(ref)
+        if flag_ok: n_all_agree += 1
+        print '%s : %i reference directions, %i sweep directions, %i common, mean difference %.2f, agreement %.1f %% %s'%(dirname,
+                                                    len(ref), len(directions), n_common, sum_diff/max(n_common, 1),
+                                                    100.0*n_agree/max(len(ref), 1), ['', '(OK)'][flag_ok])
+    print 'Trials with identical directions : %i/%i'%(n_all_agree, len(dir_list))
+
+#------------------------------------------------
+
+def bench_color(r_dir, dir_list):
+# color segmentation with HSV conversion (cv2.cvtColor & cv2.inRange) and with the quantized BGR lookup table (ColorLUT);
+# ear color in a head sized rect at the center of the area below the feeding hole (find_color of the analysis),
+# and LED white color in 4 small rects at the corners (as 'm_chk_ss.py' does)
+    calib_fp = os.path.join(r_dir, 'mva_calibration.plist')
+    if not os.path.isfile(calib_fp): calib_fp = None
+    calib = load_calibration(calib_fp)
+    analyzers = dict( hsv = HeadDirectionAnalyzer(calib, r_dir, dict(feature_engine = 'orb', prefetch = 0)), # (features aren't used)
+                      lut = HeadDirectionAnalyzer(calib, r_dir, dict(feature_engine = 'orb', prefetch = 0, color_lut = True)) )
+    led_lut = ColorLUT()
+    HSV_min_wht = (0, 0, 200); HSV_max_wht = (179, 50, 255) # LED white color of 'm_chk_ss.py'
+    e_time = dict(hsv = 0.0, lut = 0.0, seg_hsv = 0.0, seg_lut = 0.0, led_hsv = 0.0, led_lut = 0.0, build = 0.0)
+    n_frames = 0; n_same = 0; n_led_same = 0
+    n_px = 0; n_px_same = 0; n_px_unsure = 0 # pixels of the ear color masks
+    s_time = time()
+    led_lut.get_table(HSV_min_wht, HSV_max_wht)
+    e_time['build'] += time() - s_time
+    for dirname in dir_list:
+        HSV_min_ear = get_ear_HSV_min(dirname, calib['HSV_min_ear'])
+        for analyzer in analyzers.itervalues(): analyzer.HSV_min_ear = HSV_min_ear
+        s_time = time()
+        table = ear_color_lut.get_table(HSV_min_ear, calib['HSV_max_ear']) # table of the individual (once per range)
+        e_time['build'] += time() - s_time
+        for fi, frame in DirFrameSource(r_dir, dirname):
+            f_h, f_w = frame.shape[:2]
+            cx = f_w/2; cy = (calib['feeding_hole_Y'] + f_h)/2
+            rect = (cx-150, cy-100, cx+150, cy+100)
+            masks = {}
+            for name, analyzer in analyzers.iteritems():
+                analyzer.alloc_buffers( (f_w, f_h) )
+                s_time = time()
+                analyzer.find_color(rect, frame, analyzer.HSV_min_ear, analyzer.HSV_max_ear, (0,0,0))
+                e_time[name] += time() - s_time
+                masks[name] = analyzer.roi_mask.copy()
+            if np.array_equal(masks['hsv'], masks['lut']): n_same += 1
+            n_px += masks['hsv'].size
+            n_px_same += np.count_nonzero(masks['hsv'] == masks['lut'])
+            ### segmentation only, on the preprocessed color area
+            roi_col = analyzers['hsv'].col_buf[:masks['hsv'].shape[0], :masks['hsv'].shape[1]].copy()
+            n_px_unsure += np.count_nonzero(table.take(cv2.cvtColor(roi_col, cv2.COLOR_BGR2BGR565).view('<u2')) == ColorLUT.UNSURE)
+            s_time = time()
+            cv2.inRange(cv2.cvtColor(roi_col, cv2.COLOR_BGR2HSV), np.array(HSV_min_ear, dtype = np.uint8), np.array(calib['HSV_max_ear'], dtype = np.uint8))
+            e_time['seg_hsv'] += time() - s_time
+            s_time = time()
+            ear_color_lut.mask(roi_col, HSV_min_ear, calib['HSV_max_ear'])
+            e_time['seg_lut'] += time() - s_time
+            ### LED rects
+            led_same = True
+            for x, y in [ (10, 10), (f_w-30, 10), (10, f_h-30), (f_w-30, f_h-30) ]:
+                s_time = time()
+                m1 = cv2.inRange(cv2.cvtColor(frame[y:y+21, x:x+21], cv2.COLOR_BGR2HSV), np.array(HSV_min_wht, dtype = np.uint8), np.array(HSV_max_wht, dtype = np.uint8))
+                e_time['led_hsv'] += time() - s_time
+                s_time = time()
+                m2 = led_lut.mask(frame[y:y+21, x:x+21], HSV_min_wht, HSV_max_wht)
+                e_time['led_lut'] += time() - s_time
+                if not np.array_equal(m1, m2): led_same = False
+            if led_same == True: n_led_same += 1
+            n_frames += 1
+    if n_frames == 0:
+        print '\nERROR:: There is no frame to analyze.\n'
+        return
+    print '%i trials, %i frames; lookup tables of %i color ranges computed in %.2f seconds'%(len(dir_list), n_frames, len(ear_color_lut.tables)+1, e_time['build'])
+    print 'Ear color, identical masks : %i/%i frames, %.4f %% of pixels'%(n_same, n_frames, 100.0*n_px_same/max(n_px, 1))
+    print '    pixels converted to HSV (UNSURE bins) : %.2f %%'%(100.0*n_px_unsure/max(n_px, 1))
+    print '    find_color : HSV %.3f ms/frame, LUT %.3f ms/frame'%(e_time['hsv']*1000/n_frames, e_time['lut']*1000/n_frames)
+    print '    segmentation only : HSV %.3f ms/frame, LUT %.3f ms/frame'%(e_time['seg_hsv']*1000/n_frames, e_time['seg_lut']*1000/n_frames)
+    print 'LED color (4 rects), identical masks : %i/%i frames'%(n_led_same, n_frames)
+    print '    segmentation : HSV %.3f ms/frame, LUT %.3f ms/frame'%(e_time['led_hsv']*1000/n_frames, e_time['led_lut']*1000/n_frames)
+
+#------------------------------------------------
+
+def alloc_run(job):
+# analysis & display of trials (as 'mva_surf.py' does), in a worker process of bench_alloc
+# job: (results directory, trial directory names, analysis parameters, reuse)
+# reuse: False; image buffers of the analysis and the display are allocated for every frame,
+#        as the pipeline before the preallocated buffers (IplImage clones) did.
+# returns (frames, seconds, analyzer allocations, their bytes, display allocations, their bytes,
+#          peak resident set size before & after the run (KB))
+    r_dir, dir_list, params, reuse = job
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    params = dict(params, prefetch = 0, resume = False, reuse_buffers = reuse)
+    analyzer = HeadDirectionAnalyzer(load_calibration(None), r_dir, params)
+    n_frames = 0
+    n_disp_alloc = 0; disp_bytes = 0 # display buffers
+    curr_frame = None; temp_draw = None # display buffers (mva_surf.py)
+    s_time = time()
+    for dirname in dir_list:
+        analyzer.init_trial(dirname)
+        template_img = cv2.imread(analyzer.template_fp)
+        for fi, frame in DirFrameSource(r_dir, dirname):
+            res = analyzer.proc_frame(fi, frame)
+            if reuse == False or curr_frame is None or curr_frame.shape != frame.shape:
+                curr_frame = np.empty_like(frame)
+                n_disp_alloc += 1; disp_bytes += curr_frame.nbytes
+            if reuse == False or temp_draw is None or temp_draw.shape != template_img.shape:
+                temp_draw = np.empty_like(template_img)
+                n_disp_alloc += 1; disp_bytes += temp_draw.nbytes
+            curr_frame[:] = frame
+            temp_draw[:] = template_img
+            draw_result(curr_frame, res, temp_draw)
+            n_frames += 1
+    e_time = time() - s_time
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return n_frames, e_time, analyzer.n_alloc, analyzer.alloc_bytes, n_disp_alloc, disp_bytes, rss_before, rss_after
+
+#------------------------------------------------
+
+def bench_alloc(r_dir, dir_list, params):
+# image buffer allocations of the analysis & display pipeline, with buffers allocated for every frame (copy; the
+# previous pipeline) and with the preallocated buffers (reuse), counted in the same way; analyzer buffers by
+# the analyzer itself (alloc_buffers), display buffers where they're allocated. each is run in its own process
+# for its peak resident set size. (allocations inside OpenCV functions are not counted)
+    results = {}
+    for mode, reuse in [ ('copy', False), ('reuse', True) ]:
+        pool = Pool(processes = 1, maxtasksperchild = 1)
+        results[mode] = pool.apply(alloc_run, ((r_dir, dir_list, params, reuse),))
+        pool.close()
+        pool.join()
+    if results['reuse'][0] == 0:
+        print '\nERROR:: There is no frame to analyze.\n'
+        return
+    print '%i trials, %i frames'%(len(dir_list), results['reuse'][0])
+    print 'mode, FPS, analyzer allocations, bytes/frame, display allocations, bytes/frame, peak RSS (MB)'
+    per_frame = {}
+    for mode in ['copy', 'reuse']:
+        n_frames, e_time, n_alloc, alloc_bytes, n_disp_alloc, disp_bytes, rss_before, rss_after = results[mode]
+        per_frame[mode] = float(alloc_bytes + disp_bytes) / n_frames
+        print '%s, %.1f, %i, %.0f, %i, %.0f, %.1f'%(mode, n_frames/max(e_time, 1e-6), n_alloc, float(alloc_bytes)/n_frames,
+                                                  n_disp_alloc, float(disp_bytes)/n_frames, rss_after/1024.0) # ru_maxrss is in KB on Linux
+    print 'Allocated image buffer bytes per frame : %.0f (copy) -> %.0f (reuse)'%(per_frame['copy'], per_frame['reuse'])
+
+#------------------------------------------------
+
+SYNTH_FRAME_SIZE = (640, 540) # same as frames cropped by 'm_extract_frames.py'
+SYNTH_HEAD_SIZE = (120, 140) # height & width of the synthetic head
+SYNTH_EAR_DIST = 62 # distance between the head center and an ear
+
+CWD = os.getcwd()
+results_dir = os.path.join(CWD, "results")
+synth_dir = os.path.join(CWD, "synthetic") # results directory of synthetic trials
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == '-w': GNU_notice(1)
+    elif len(argv) > 1 and argv[1] == '-c': GNU_notice(2)
+    elif len(argv) > 1 and argv[1] == 'clustering':
+        GNU_notice(0)
+        if len(argv) > 2: compare_clustering( recorded_pt_sets(argv[2]) )
+        else: compare_clustering( random_pt_sets() )
+    elif len(argv) > 1 and argv[1] == 'make_synthetic':
+        GNU_notice(0)
+        n_trials = 3; n_frames = 300
+        if len(argv) > 2: n_trials = int(argv[2])
+        if len(argv) > 3: n_frames = int(argv[3])
+        make_synthetic(n_trials, n_frames)
+    elif len(argv) > 1 and argv[1] == 'synthetic':
+        GNU_notice(0)
+        params = {} # analysis parameters, different from default values (DEFAULT_PARAMS in 'mva_engine.py')
+        opts, args = getopt.getopt(argv[2:], 'm:e:db:x:tokugG')
+        for opt, val in opts:
+            if opt == '-m': params['match_method'] = val
+            elif opt == '-e': params['feature_engine'] = val
+            elif opt == '-d': params['feature_cache'] = True
+            elif opt == '-b': params['kp_band'] = tuple([ int(v) for v in val.split(',') ])
+            elif opt == '-x': params['kp_max'] = int(val)
+            elif opt == '-t': params['track_head'] = True
+            elif opt == '-o': params['coarse_loc'] = True
+            elif opt == '-k': params['lk_track'] = True
+            elif opt == '-u': params['color_lut'] = True
+            elif opt == '-g': params['motion_gate'] = True
+            elif opt == '-G': params['flip_mode'] = 'global'
+        run_synthetic(params)
+    elif len(argv) > 1 and argv[1] == 'engines':
+        GNU_notice(0)
+        engine_names = ['surf', 'orb']
+        opts, args = getopt.getopt(argv[2:], 'e:')
+        for opt, val in opts:
+            if opt == '-e': engine_names = val.split(',')
+        if len(args) > 0: bench_engines(results_dir, args, engine_names)
+        else: bench_engines(synth_dir, get_trial_dirs(synth_dir), engine_names)
+    elif len(argv) > 1 and argv[1] == 'sweep_check':
+        GNU_notice(0)
+        params = {}
+        opts, args = getopt.getopt(argv[2:], 'e:G')
+        for opt, val in opts:
+            if opt == '-e': params['feature_engine'] = val
+            elif opt == '-G': params['flip_mode'] = 'global'
+        check_sweep(params)
+    elif len(argv) > 1 and argv[1] == 'color':
+        GNU_notice(0)
+        if len(argv) > 2: bench_color(results_dir, argv[2:])
+        else: bench_color(synth_dir, get_trial_dirs(synth_dir))
+    elif len(argv) > 1 and argv[1] == 'alloc':
+        GNU_notice(0)
+        params = {}
+        opts, args = getopt.getopt(argv[2:], 'e:')
+        for opt, val in opts:
+            if opt == '-e': params['feature_engine'] = val
+        if len(args) > 0: bench_alloc(results_dir, args, params)
+        else: bench_alloc(synth_dir, get_trial_dirs(synth_dir), params)
+    else:
+        print '\nERROR:: Benchmark name has to be provided as an argument. (e.g.: clustering, synthetic, engines, sweep_check, color, alloc)\n'
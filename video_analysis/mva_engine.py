@@ -0,0 +1,1945 @@
+'''
+This is the analysis part of 'mva_surf.py', calculating the head
+direction in each frame, without any GUI.
+(head turning experiment of common marmoset monkeys)
+
+It is used by 'mva_surf.py' (GUI) and 'mva_batch.py' (batch run
+without GUI).
+
+Calibration file :
+A calibration file (plist) has the position-Y of the feeding hole and
+HSV ranges for finding marmoset's ears. It is written by 'mva_surf.py'
+when the analysis starts, after the feeding hole line was adjusted.
+------
+feeding_hole_Y : 240
+HSV_max_ear : [179, 40, 255]
+HSV_min_ear : { default: [0, 0, 140], Pooh: [0, 0, 120], ... }
+------
+Keys of 'HSV_min_ear' are individual names, the 2nd item of the
+directory name, [Group]_[Individual-name]_[Trial#]_[Stimulus]_[Stim.numbering]
+
+Frame sources :
+Frames of a trial are read from a directory of JPG images, extracted by
+'m_extract_frames.py' (DirFrameSource), or decoded directly from the
+session MP4 file with the same time window and cropping as
+'m_extract_frames.py' (VideoFrameSource), given the session LOG file,
+which has the stimulus onset times.
+
+----------------------------------------------------------------------
+Copyright (C) 2014 Jinook Oh, W. Tecumseh Fitch for ERC Advanced Grant
+SOMACCA # 230604
+- Contact: jinook.oh@univie.ac.at, tecumseh.fitch@univie.ac.at
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os, plistlib, threading, Queue, traceback, hashlib, shutil
+from glob import glob
+from time import time
+from copy import copy
+from math import degrees, radians, sin, cos, atan2, sqrt
+
+import cv2
+import numpy as np
+if not hasattr(cv2, 'connectedComponentsWithStats'): from scipy import ndimage # OpenCV 2.4
+
+from m_extract_frames import FPS, CROP, PRE_ONSET, DURATION, get_trial_list
+from common_funcs import ColorLUT
+try: import fcntl
+except ImportError: fcntl = None # no locking of the feature cache (Windows)
+
+# --------------------------------------------------
+
+HSV_MIN_EAR = dict( Pooh = (0,0,120),
+                    Yara = (0,0,165),
+                    Kobold = (0,0,120),
+                    Smart = (0,0,160),
+                    Locri = (0,0,160),
+                    Augustina = (0,0,150),
+                    default = (0,0,140) ) # lower HSV bound of marmoset's ear color for each individual
+HSV_MAX_EAR = (179,40,255) # upper HSV bound of marmoset's ear color
+COL_PREPROC_MARGIN = 8 # reach of preprocessing_col (5x5 gaussian: 2, 3x dilate: 3, 3x erode: 3)
+RESULT_CHUNK_SIZE = 100 # result rows are written into files at every this number of rows (ResultWriter)
+CHECKPOINT_INTERVAL = 100 # results & checkpoint of a trial are committed at every this number of frames
+HESSIAN_TH_MIN = 10 # lower bound of SURF hessian threshold adjusted by KeypointBudget
+HESSIAN_TH_MAX = 20000 # upper bound
+CLUSTER_SMALL_N = 100 # up to this number of points, cluster_points compares all pairs of points
+CLUSTER_NEIGHBOUR_CELLS = sorted([ (dx, dy) for dy in xrange(0, 3) for dx in xrange(-2, 3) if dy > 0 or dx > 0 ],
+                                 key = lambda c: c[0]**2 + c[1]**2) # cells within 'threshold' distance (half of them, to compare each pair once)
+
+DEFAULT_PARAMS = dict( hessian_threshold = 300, # hessian threshold of SURF detector
+                       match_method = 'bf', # 'bf': brute-force (exact), 'flann': approximate kd-tree
+                       match_dist_th = 0.1, # (squared) distance threshold of a descriptor match
+                       feature_engine = 'surf', # 'surf' or 'orb' (FEATURE_ENGINES)
+                       orb_features = 500, # maximum number of ORB keypoints
+                       orb_dist_th = 48, # Hamming distance threshold of an ORB descriptor match
+                       head_cluster_th = 100, # distance threshold of clustering matched points (head)
+                       ear_cluster_th = 55, # distance threshold of clustering ear contour centers
+                       s_frag_th = 30, # lower-threshold for subject's fragment rect size (ear contours)
+                       ear_V_min = None, # lower V (HSV) bound of ear color for all individuals, instead of the calibration
+                       ear_HSV_min = None, # {individual name: lower HSV bound of ear color}, instead of the calibration
+                       kp_band = None, # (low, high) target band of keypoints per frame; SURF hessian threshold is adjusted
+                                       # to keep the number of keypoints in it (KeypointBudget). None: fixed threshold
+                       kp_window = 5, # number of detections, whose keypoints are averaged by KeypointBudget
+                       kp_max = None, # only this number of keypoints with the strongest response are kept in a detection (None: all)
+                       color_lut = False, # ear color segmentation with a quantized BGR lookup table (ColorLUT), instead of HSV conversion
+                       feature_cache = False, # read keypoints & descriptors of frames from FeatureCache, instead of detecting them
+                       flann_trees = 4, # number of kd-trees for 'flann' matching
+                       flann_checks = 32, # number of leaves to check for 'flann' matching; higher is more accurate, slower
+                       track_head = False, # search head only in a window around the predicted head position
+                       track_win = (400, 300), # width & height of the tracking window
+                       coarse_loc = False, # locate the head region first with the downscaled template (coarse_search_rect)
+                       coarse_levels = 2, # pyrDown levels of the coarse localization (2: quarter resolution)
+                       coarse_angles = 12, # number of rotated templates (every 360/coarse_angles degrees); 1: unrotated template
+                       coarse_th = 0.4, # lower NCC score of the coarse localization to search only in its region
+                                        # (synthetic trials; the head was found in the region of 97 % of frames with 0.4,
+                                        # 77 % with 0.5 and 11 % with 0.6. a wrong region is rejected by find_head)
+                       coarse_probe = 50, # number of coarse localizations, after which its hit rate is checked in a trial
+                       coarse_min_hit = 0.5, # coarse localization is turned off for the rest of a trial below this hit rate
+                       coarse_min = None, # frames with lower NCC score are regarded as head-absent and skipped (None: never)
+                       lk_track = False, # follow head points with optical flow after a successful match (track_points)
+                       lk_min_pts = 8, # minimum number of tracked points; feature detection runs again with fewer points
+                       lk_fb_th = 1.0, # forward-backward error threshold (pixels) of a tracked point
+                       lk_err_th = 20, # threshold of mean absolute grey difference between the patches of a tracked point
+                       lk_redetect = 30, # feature detection is forced after this number of tracked frames
+                       prefetch = 8, # number of frames read ahead by a background thread (0: no prefetching)
+                       reuse_buffers = True, # False: image buffers are allocated for every frame, as the pipeline
+                                             # before the preallocated buffers did (comparison of 'mva_bench.py alloc')
+                       profile = False, # measure time of each stage of the analysis (StageProfiler)
+                       resume = True, # skip completed trials and continue a partially analyzed trial (checkpoint)
+                       motion_gate = False, # carry the previous result over, when nothing moved around the head
+                       motion_th = 1.5, # motion gate threshold; mean absolute difference of grey values in the head rect
+                       motion_force = 10, # the full analysis is forced after this number of carried frames
+                       flip_mode = 'online' ) # 180 degrees ambiguity of head direction; 'online': with the previous direction in each frame,
+                                              # 'global': stateless measurement in each frame, resolved for the whole trial (resolve_flips)
+
+# --------------------------------------------------
+
+def get_angle(pt1, pt2):
+# calculates the angle of a straight line drawn between point one and two.
+    dx = pt2[0] - pt1[0]
+    dy = (pt2[1] - pt1[1]) * -1
+    return degrees( atan2(dy, dx) )
+
+# --------------------------------------------------
+
+def rotate_line(frame_size, pt1, pt2, r_deg=90):
+# for rotating a line between pt1 and pt2
+# r_deg: angle to rotate
+    y_list = [pt1[1], pt2[1]]
+    dx = abs(pt1[0]-pt2[0])
+    dy = abs(pt1[1]-pt2[1])
+    line_len = 100 # max(dx, dy)
+    cx = pt1[0] + dx/2 # center X
+    cy = min(y_list) + dy/2 # center Y
+    deg = get_angle(pt1, pt2)
+    if deg < 0: deg = 360 + deg
+    r_deg = ( deg + r_deg ) % 360 # rotate given degrees from the degrees of the line
+    r_pt1 = [cx, cy]
+    return r_deg, tuple(r_pt1), direction_line_end(cx, cy, r_deg, line_len)
+
+# --------------------------------------------------
+
+def direction_line_end(cx, cy, r_deg, line_len=100):
+# end point of the head direction line, which starts at (cx, cy)
+    theta = radians(r_deg)
+    return ( cx + int( line_len*cos(theta) - (1*sin(theta)) ),
+             cy - int( line_len*sin(theta) + (1*cos(theta)) ) )
+
+# --------------------------------------------------
+
+def flip_row(row):
+# result row (see format_row) with the opposite head direction
+    _fi, _earR, r_deg, r_p1, r_p2, carried = row
+    r_deg = (r_deg + 180) % 360
+    return (_fi, _earR, r_deg, r_p1, direction_line_end(r_p1[0], r_p1[1], r_deg), carried)
+
+# --------------------------------------------------
+
+def resolve_flips(rows, confidence=None, max_gap=10, gate=45):
+# global pass over result rows of a whole trial, resolving 180 degrees ambiguity of head directions
+# (a line perpendicular to the line connecting ears can point to both sides).
+# Dynamic programming (Viterbi) over two orientations of each row; the sum of direction changes between
+# consecutive rows (weighted by their confidence) is minimized. Rows more than 'max_gap' frames apart
+# are independent. Then, a row, which differs more than 'gate' degrees from all its neighbours
+# (within 'max_gap' frames), is dropped as an outlier.
+# confidence: {row frame-index: confidence (0~1)}; 1 for a row which isn't in it.
+# returns the resolved rows, sorted by frame-index
+    rows = sorted(rows, key = lambda row: row[0])
+    n = len(rows)
+    if n == 0: return []
+    if confidence == None: confidence = {}
+    deg = np.array([ row[2] for row in rows ], dtype = np.float64)
+    fidx = np.array([ row[0] for row in rows ], dtype = np.int32)
+    conf = np.array([ confidence.get(row[0], 1.0) for row in rows ], dtype = np.float64)
+    diff = np.abs(np.diff(deg)) % 360
+    diff = np.minimum(diff, 360 - diff) # direction change between consecutive rows, when both keep their orientation
+    weight = np.minimum(conf[1:], conf[:-1])
+    weight[np.diff(fidx) > max_gap] = 0 # independent segments
+    ### forward pass; cost[s]: minimum cost up to the current row with orientation s (0: as measured, 1: flipped)
+    prior = 1e-3 # slight preference for the measured orientation, when nothing else decides it
+    cost = np.array([0.0, prior])
+    back = np.zeros((n, 2), dtype = np.int8)
+    for i in xrange(1, n):
+        same = weight[i-1] * diff[i-1] # both rows keep (or both flip) their orientation
+        cross = weight[i-1] * (180 - diff[i-1]) # one of them flips
+        c0 = (cost[0] + same, cost[1] + cross)
+        c1 = (cost[0] + cross, cost[1] + same)
+        back[i, 0] = 0 if c0[0] <= c0[1] else 1
+        back[i, 1] = 0 if c1[0] <= c1[1] else 1
+        cost = np.array([ min(c0), min(c1) + prior ])
+    ### backtracking
+    state = np.zeros(n, dtype = np.int8)
+    state[-1] = 0 if cost[0] <= cost[1] else 1
+    for i in xrange(n-1, 0, -1): state[i-1] = back[i, state[i]]
+    rows = [ flip_row(rows[i]) if state[i] == 1 else rows[i] for i in xrange(n) ]
+    ### outliers
+    deg = np.array([ row[2] for row in rows ], dtype = np.float64)
+    ret = []
+    for i in xrange(n):
+        neighbours = []
+        if i > 0 and fidx[i] - fidx[i-1] <= max_gap: neighbours.append(deg[i-1])
+        if i < n-1 and fidx[i+1] - fidx[i] <= max_gap: neighbours.append(deg[i+1])
+        d = [ min(abs(deg[i]-nd) % 360, 360 - abs(deg[i]-nd) % 360) for nd in neighbours ]
+        if len(d) > 0 and min(d) > gate: continue
+        ret.append(rows[i])
+    return ret
+
+# --------------------------------------------------
+
+template_features = {} # in-memory cache of template features; key: (template file path, mtime, feature engine cache name)
+
+def get_template_features(template_fp, engine):
+# returns keypoint coordinates (N x 2) and descriptors (N x rowsize) of a template head image with a feature engine.
+# features are cached in memory and in a NPZ file next to the template image,
+# so that extraction happens only once per template file and engine setting (e.g.: SURF hessian threshold).
+    mtime = os.path.getmtime(template_fp)
+    key = (template_fp, mtime, engine.cache_name)
+    if key in template_features: return template_features[key]
+
+    npz_fp = '%s_%s.npz'%(os.path.splitext(template_fp)[0], engine.cache_name)
+    pts = None
+    if os.path.isfile(npz_fp):
+        try:
+            npz = np.load(npz_fp)
+            if float(npz['mtime']) == mtime:
+                pts = npz['pts']
+                descriptors = npz['descriptors']
+        except (IOError, KeyError, ValueError):
+            pts = None # broken cache file; extract again
+    if pts is None:
+        grey = cv2.cvtColor(cv2.imread(template_fp), cv2.COLOR_BGR2GRAY)
+        pts, descriptors = engine.detect_compute(grey)
+        ### write into a temporary file first, then rename it, so that other workers never read a half-written file
+        tmp_fp = '%s.%i.tmp'%(npz_fp, os.getpid())
+        try:
+            f = open(tmp_fp, 'wb')
+            np.savez(f, pts=pts, descriptors=descriptors, mtime=mtime)
+            f.close()
+            os.rename(tmp_fp, npz_fp)
+        except (IOError, OSError):
+            print 'WARNING:: Unable to write template feature cache [%s]'%npz_fp
+    template_features[key] = (pts, descriptors)
+    return pts, descriptors
+
+# --------------------------------------------------
+
+ear_color_lut = ColorLUT() # lookup table of ear colors ('color_lut'); shared by analyzers of a process
+
+# --------------------------------------------------
+
+coarse_templates = {} # in-memory cache of downscaled templates; key: (template file path, mtime, pyrDown levels)
+
+def get_coarse_template(template_fp, levels, n_angles=1):
+# returns grey template images downscaled 'levels' times with cv2.pyrDown (coarse head localization),
+# rotated every 360/n_angles degrees, and (width, height) of the original template image.
+# a rotated template is the central square of the template, which is inside the template in any rotation.
+# (n_angles 1: the whole unrotated template)
+    key = (template_fp, os.path.getmtime(template_fp), levels, n_angles)
+    if key not in coarse_templates:
+        grey = cv2.cvtColor(cv2.imread(template_fp), cv2.COLOR_BGR2GRAY)
+        small = grey
+        for i in xrange(levels): small = cv2.pyrDown(small)
+        if n_angles == 1:
+            templates = [ small ]
+        else:
+            h, w = small.shape
+            side = int(min(w, h) / sqrt(2))
+            x0 = (w - side) / 2; y0 = (h - side) / 2
+            templates = []
+            for i in xrange(n_angles):
+                rot_mat = cv2.getRotationMatrix2D((w/2.0, h/2.0), 360.0*i/n_angles, 1.0)
+                templates.append( cv2.warpAffine(small, rot_mat, (w, h))[y0:y0+side, x0:x0+side].copy() )
+        coarse_templates[key] = (templates, (grey.shape[1], grey.shape[0]))
+    return coarse_templates[key]
+
+# --------------------------------------------------
+
+def cluster_points(pt_list, threshold):
+# Single-linkage clustering with a distance threshold; points within 'threshold' of each other
+# are connected, and each connected group becomes a cluster.
+# (same groups as fclusterdata(pt_arr, threshold, 'distance') of scipy, without pairwise distances of all points)
+# Points are hashed into a grid of cells, whose diagonal is 'threshold'; all points in a cell are connected.
+# Two nearby cells are connected when any pair of their points is within 'threshold',
+# then connected cells are merged with union-find.
+# returns number of groups and list of groups (each group is a list of points, ordered by their first point)
+    n_groups, group_of_pt = cluster_labels(pt_list, threshold)
+    groups = []
+    for i in xrange(n_groups): groups.append([])
+    for i, gi in enumerate(group_of_pt.tolist()): groups[gi].append(pt_list[i])
+    return n_groups, groups
+
+# --------------------------------------------------
+
+def cluster_labels(pt_list, threshold):
+# clustering part of cluster_points
+# returns number of groups and an array of group index of each point (groups are ordered by their first point)
+    n = len(pt_list)
+    if n == 0: return 0, np.zeros(0, dtype = np.int64)
+    pt_arr = np.asarray(pt_list, dtype = np.float64).reshape((n, -1))
+
+    if n <= CLUSTER_SMALL_N:
+    ### few points; pairwise distances of all points & label propagation
+        d = pt_arr[:,None,:] - pt_arr[None,:,:]
+        adj = np.sum(d*d, axis=2) <= float(threshold)**2
+        labels = np.arange(n)
+        while True:
+            new_labels = np.where(adj, labels, n).min(axis=1) # smallest label among connected points
+            new_labels = new_labels[new_labels] # pointer jumping
+            if np.array_equal(new_labels, labels): break
+            labels = new_labels
+        root_of_pt = labels
+    else:
+        root_of_pt = grid_cluster_roots(pt_arr, threshold)
+
+    ### groups in order of their first point
+    roots, first_idx, group_of_pt = np.unique(root_of_pt, return_index = True, return_inverse = True)
+    rank = np.empty(len(roots), dtype = np.int64)
+    rank[np.argsort(first_idx)] = np.arange(len(roots))
+    return len(roots), rank[group_of_pt]
+
+# --------------------------------------------------
+
+def grid_cluster_roots(pt_arr, threshold):
+# grid hashing & union-find part of cluster_points
+# returns an array of root (group label) of each point
+    n = len(pt_arr)
+
+    ### grid hashing; points sorted by their cell
+    cells = np.floor(pt_arr / (threshold / sqrt(2))).astype(np.int64)
+    cells -= cells.min(axis=0) - 2 # non-negative, with room for neighbour offsets
+    k_mul = cells[:,1].max() + 3
+    keys = cells[:,0] * k_mul + cells[:,1]
+    order = np.argsort(keys, kind = 'mergesort')
+    s_pts = pt_arr[order]
+    cell_keys, cell_start, cell_of_sorted = np.unique(keys[order], return_index = True, return_inverse = True)
+    cell_cnt = np.diff( np.append(cell_start, n) )
+    n_cells = len(cell_keys)
+
+    ### union-find of cells
+    parent = range(n_cells)
+    def find(ci):
+        while parent[ci] != ci:
+            parent[ci] = parent[parent[ci]]
+            ci = parent[ci]
+        return ci
+    th_sq = float(threshold)**2
+    for dx, dy in CLUSTER_NEIGHBOUR_CELLS: # from the nearest neighbour cells
+        ### pairs of cells, which are not connected yet
+        n_keys = cell_keys + dx * k_mul + dy
+        pos = np.minimum( np.searchsorted(cell_keys, n_keys), n_cells-1 )
+        pairs_a = np.nonzero( cell_keys[pos] == n_keys )[0]
+        pairs_b = pos[pairs_a]
+        roots = np.array([ find(ci) for ci in xrange(n_cells) ])
+        not_yet = roots[pairs_a] != roots[pairs_b]
+        pairs_a = pairs_a[not_yet]; pairs_b = pairs_b[not_yet]
+        if len(pairs_a) == 0: continue
+        ### check all point pairs of the cell pairs at once
+        cnt_a = cell_cnt[pairs_a]; cnt_b = cell_cnt[pairs_b]
+        n_pp = cnt_a * cnt_b # number of point pairs of each cell pair
+        pid = np.repeat(np.arange(len(pairs_a)), n_pp)
+        local = np.arange(n_pp.sum()) - np.repeat(np.cumsum(n_pp) - n_pp, n_pp)
+        ia = cell_start[pairs_a][pid] + local // cnt_b[pid]
+        ib = cell_start[pairs_b][pid] + local % cnt_b[pid]
+        d = s_pts[ia] - s_pts[ib]
+        connected = np.unique( pid[ np.sum(d*d, axis=1) <= th_sq ] )
+        for ca, cb in zip(pairs_a[connected].tolist(), pairs_b[connected].tolist()):
+            root1 = find(ca); root2 = find(cb)
+            if root1 != root2: parent[max(root1, root2)] = min(root1, root2)
+    for ci in xrange(n_cells): parent[ci] = find(ci)
+
+    root_of_pt = np.empty(n, dtype = np.int64)
+    root_of_pt[order] = np.array(parent)[cell_of_sorted]
+    return root_of_pt
+
+#====================================================
+
+class DescriptorMatcher(object):
+# Class for matching descriptors of a frame against the fixed template descriptors.
+# Index of the template descriptors is built once per trial, then all the descriptors
+# of a frame are queried at once, instead of training kNN with each frame.
+# method 'bf' : brute-force distance matrix; for each template descriptor, the nearest frame descriptor
+#               (same result as the previous cv2.KNearest with k=1)
+# method 'flann' : approximate kd-tree index on the template descriptors; each frame descriptor finds
+#                  its nearest template descriptor, and the closest of them is kept for each template descriptor
+
+    def __init__(self, t_desc, method='bf', dist_th=0.1, flann_trees=4, flann_checks=32):
+        self.t_desc = np.ascontiguousarray(t_desc, dtype = np.float32)
+        self.t_sq = np.sum(self.t_desc**2, axis=1).reshape((-1,1)) # squared norms of template descriptors
+        self.method = method
+        self.dist_th = dist_th
+        self.flann_checks = flann_checks
+        if method == 'flann' and len(self.t_desc) > 0:
+            self.index = cv2.flann_Index(self.t_desc, dict(algorithm = 1, trees = flann_trees)) # 1: FLANN_INDEX_KDTREE
+
+    #------------------------------------------------
+
+    def match(self, h_desc):
+    # h_desc: descriptors of a frame (N x rowsize)
+    # returns 'nn_idx' (index of the nearest frame descriptor for each template descriptor, -1 if there's none)
+    # and 'matched' (boolean array; whether the squared distance is smaller than the threshold)
+        n_t = len(self.t_desc)
+        h_desc = np.ascontiguousarray(h_desc, dtype = np.float32)
+        if n_t == 0 or len(h_desc) == 0:
+            return -np.ones(n_t, dtype = np.int32), np.zeros(n_t, dtype = np.bool)
+        if self.method == 'flann':
+            idx, dists = self.index.knnSearch(h_desc, 1, params = dict(checks = self.flann_checks))
+            idx = idx.ravel(); dists = dists.ravel()
+            ### for each template descriptor, keep the frame descriptor with the smallest distance
+            order = np.argsort(dists)[::-1] # assign in descending distance order, so the smallest one is assigned last
+            nn_idx = -np.ones(n_t, dtype = np.int32)
+            nn_idx[idx[order]] = order
+            nn_dist = np.empty(n_t, dtype = np.float32)
+            nn_dist.fill(np.inf)
+            nn_dist[idx[order]] = dists[order]
+        else:
+            ### squared euclidean distances; |t|^2 - 2*t.h + |h|^2
+            d = np.dot(self.t_desc, h_desc.T)
+            d *= -2
+            d += self.t_sq
+            d += np.sum(h_desc**2, axis=1)
+            nn_idx = np.argmin(d, axis=1).astype(np.int32)
+            nn_dist = d[np.arange(n_t), nn_idx]
+        return nn_idx, nn_dist < self.dist_th
+
+#====================================================
+
+class HammingMatcher(object):
+# Matcher of binary descriptors (ORB) with the same interface as DescriptorMatcher.
+# For each template descriptor, the nearest frame descriptor in Hamming distance (brute-force).
+
+    def __init__(self, t_desc, dist_th=48):
+        self.t_desc = np.ascontiguousarray(t_desc, dtype = np.uint8)
+        self.dist_th = dist_th
+        self.bf = cv2.BFMatcher(cv2.NORM_HAMMING)
+
+    #------------------------------------------------
+
+    def match(self, h_desc):
+    # h_desc: descriptors of a frame (N x bytes)
+    # returns 'nn_idx' (index of the nearest frame descriptor for each template descriptor, -1 if there's none)
+    # and 'matched' (boolean array; whether the Hamming distance is smaller than the threshold)
+        n_t = len(self.t_desc)
+        nn_idx = -np.ones(n_t, dtype = np.int32)
+        nn_dist = np.empty(n_t, dtype = np.float32)
+        nn_dist.fill(np.inf)
+        if n_t == 0 or len(h_desc) == 0: return nn_idx, nn_dist < self.dist_th
+        for m in self.bf.match(self.t_desc, np.ascontiguousarray(h_desc, dtype = np.uint8)):
+            nn_idx[m.queryIdx] = m.trainIdx
+            nn_dist[m.queryIdx] = m.distance
+        return nn_idx, nn_dist < self.dist_th
+
+#====================================================
+
+def detect_keypoints(engine, grey, max_n=None):
+# keypoints & descriptors of a grey image with the detector of a feature engine.
+# with 'max_n', only 'max_n' keypoints with the strongest response are described.
+# number of detected keypoints (before 'max_n') is stored in engine.n_detected
+    if max_n == None:
+        keypoints, descriptors = engine.detector.detectAndCompute(grey, None)
+        engine.n_detected = len(keypoints)
+        return keypoints, descriptors
+    keypoints = engine.detector.detect(grey, None)
+    engine.n_detected = len(keypoints)
+    if len(keypoints) > max_n:
+        order = np.argsort([ -kp.response for kp in keypoints ], kind = 'mergesort')[:max_n]
+        keypoints = [ keypoints[i] for i in order ]
+    if len(keypoints) == 0: return [], None
+    return engine.detector.compute(grey, keypoints)
+
+# --------------------------------------------------
+
+def budget_cache_suffix(params):
+# suffix of feature cache names for keypoint budget parameters; features of different budgets aren't mixed
+    suffix = ''
+    if params['kp_band'] != None: suffix += '_b%i-%i-%i'%(params['kp_band'][0], params['kp_band'][1], params['kp_window'])
+    if params['kp_max'] != None: suffix += '_n%i'%params['kp_max']
+    return suffix
+
+#====================================================
+
+class SURFEngine(object):
+# Feature engine with SURF (float descriptors); detection, description and matching.
+# cv2.SURF of OpenCV 2.4, or cv2.xfeatures2d.SURF_create of OpenCV 3 or later (contrib).
+
+    name = 'surf'
+    kp_max_min = 400 # lower limit of 'kp_max'; fewer keypoints aren't enough for the head & ear rects
+
+    def __init__(self, params):
+        self.params = params
+        self.hessian_threshold = params['hessian_threshold']
+        if hasattr(cv2, 'SURF'): self.detector = cv2.SURF(self.hessian_threshold)
+        else: self.detector = cv2.xfeatures2d.SURF_create(self.hessian_threshold)
+        self.cache_name = 'surf%i'%self.hessian_threshold + budget_cache_suffix(params) # for the feature cache files
+        self.n_detected = 0 # number of keypoints of the last detection, before 'max_n'
+
+    #------------------------------------------------
+
+    def set_threshold(self, hessian_threshold):
+    # hessian threshold of the following detections (KeypointBudget)
+        self.hessian_threshold = hessian_threshold
+        if hasattr(self.detector, 'setHessianThreshold'): self.detector.setHessianThreshold(hessian_threshold)
+        else: self.detector.hessianThreshold = hessian_threshold
+
+    #------------------------------------------------
+
+    def detect_compute(self, grey, max_n=None):
+    # returns keypoint coordinates (N x 2, float32) and descriptors (N x 64, or 128 when it's extended; float32) of a grey image
+    # max_n: only this number of keypoints with the strongest response are kept (None: all)
+        keypoints, descriptors = detect_keypoints(self, grey, max_n)
+        pts = np.array([ kp.pt for kp in keypoints ], dtype = np.float32).reshape((-1, 2))
+        if len(keypoints) > 0: descriptors = np.array(descriptors, dtype = np.float32).reshape((len(keypoints), -1))
+        else: descriptors = np.zeros((0, self.detector.descriptorSize()), dtype = np.float32) # same width as other frames
+        return pts, descriptors
+
+    #------------------------------------------------
+
+    def create_matcher(self, t_desc):
+        return DescriptorMatcher(t_desc,
+                                 self.params['match_method'],
+                                 self.params['match_dist_th'],
+                                 self.params['flann_trees'],
+                                 self.params['flann_checks'])
+
+#====================================================
+
+class ORBEngine(object):
+# Feature engine with ORB (binary descriptors, Hamming distance); available in all OpenCV builds.
+# cv2.ORB of OpenCV 2.4, or cv2.ORB_create of OpenCV 3 or later.
+
+    name = 'orb'
+    kp_max_min = 400 # lower limit of 'kp_max' (synthetic trials; 200: 32 % of frames with head direction, 28 % of them opposite)
+
+    def __init__(self, params):
+        self.params = params
+        if hasattr(cv2, 'ORB_create'): self.detector = cv2.ORB_create(nfeatures = params['orb_features'])
+        else: self.detector = cv2.ORB(nfeatures = params['orb_features'])
+        self.cache_name = 'orb%i'%params['orb_features'] + budget_cache_suffix(params)
+        self.n_detected = 0 # number of keypoints of the last detection, before 'max_n'
+
+    #------------------------------------------------
+
+    def detect_compute(self, grey, max_n=None):
+    # returns keypoint coordinates (N x 2, float32) and descriptors (N x 32, uint8) of a grey image
+    # max_n: only this number of keypoints with the strongest response are kept (None: all)
+    # (number of keypoints is already bounded by 'orb_features'; KeypointBudget isn't applied to ORB)
+        keypoints, descriptors = detect_keypoints(self, grey, max_n)
+        pts = np.array([ kp.pt for kp in keypoints ], dtype = np.float32).reshape((-1, 2))
+        if len(keypoints) > 0: descriptors = np.array(descriptors, dtype = np.uint8).reshape((len(keypoints), -1))
+        else: descriptors = np.zeros((0, self.detector.descriptorSize()), dtype = np.uint8)
+        return pts, descriptors
+
+    #------------------------------------------------
+
+    def create_matcher(self, t_desc):
+        return HammingMatcher(t_desc, self.params['orb_dist_th'])
+
+# --------------------------------------------------
+
+FEATURE_ENGINES = dict( surf = SURFEngine, orb = ORBEngine )
+
+def create_feature_engine(params):
+# feature engine of 'feature_engine' parameter ('surf' or 'orb')
+    if params['feature_engine'] not in FEATURE_ENGINES:
+        raise ValueError('Unknown feature engine [%s]. (%s)'%(params['feature_engine'], '/'.join(sorted(FEATURE_ENGINES.keys()))))
+    engine_class = FEATURE_ENGINES[params['feature_engine']]
+    if params['kp_max'] != None and params['kp_max'] < engine_class.kp_max_min:
+    # too few keypoints; the head isn't found in most frames
+        print 'WARNING:: kp_max %i is raised to %i for %s.'%(params['kp_max'], engine_class.kp_max_min, engine_class.name)
+        params['kp_max'] = engine_class.kp_max_min
+    return engine_class(params)
+
+#====================================================
+
+class KeypointBudget(object):
+# Controller of SURF hessian threshold, which keeps the number of keypoints per frame in a target band
+# ('kp_band': (low, high)) regardless of lighting of a session, so that the cost of matching & clustering is bounded.
+# Number of keypoints of each detection is scaled to the whole detection area (below the feeding hole), and
+# averaged over the last 'kp_window' detections. When the average is out of the band, the threshold is multiplied
+# by (average / middle of the band), by 2 (or 1/2) at most at once, and the averaging starts again.
+# The threshold starts from 'hessian_threshold' in each trial, so that a result doesn't depend on other trials.
+
+    def __init__(self, engine, band, window):
+        self.engine = engine
+        self.band = band
+        self.window = window
+        self.base_threshold = engine.hessian_threshold
+        self.reset()
+
+    #------------------------------------------------
+
+    def reset(self, threshold=None):
+        if threshold == None: threshold = self.base_threshold
+        self.engine.set_threshold(threshold)
+        self.counts = []
+
+    #------------------------------------------------
+
+    def update(self, n_kp):
+    # n_kp: number of keypoints of a detection, scaled to the whole detection area
+        self.counts.append(n_kp)
+        if len(self.counts) > self.window: self.counts.pop(0)
+        if len(self.counts) < self.window: return
+        avg = float(sum(self.counts)) / self.window
+        if avg >= self.band[0] and avg <= self.band[1]: return
+        ratio = min(2.0, max(0.5, avg / ((self.band[0] + self.band[1]) / 2.0)))
+        self.engine.set_threshold( min(HESSIAN_TH_MAX, max(HESSIAN_TH_MIN, self.engine.hessian_threshold * ratio)) )
+        self.counts = []
+
+# --------------------------------------------------
+
+def get_trial_dirs(results_dir):
+# returns sorted names of directories in 'results_dir', which contain extracted frame images
+    dir_list = []
+    for f in glob( os.path.join(results_dir, "*") ):
+        if os.path.isdir(f):
+            _jpg_img_file = os.path.join(f, "f000001.jpg")
+            if os.path.isfile(_jpg_img_file):
+                dir_list.append( os.path.split(f)[1] ) # store directory name
+    return sorted(dir_list)
+
+# --------------------------------------------------
+
+def load_calibration(fp):
+# reads a calibration file (plist) and returns a dictionary of calibration values.
+# missing values are filled with the default values.
+    calib = dict( feeding_hole_Y = 240,
+                  HSV_min_ear = dict(HSV_MIN_EAR),
+                  HSV_max_ear = HSV_MAX_EAR )
+    if fp != None:
+        _calib = plistlib.readPlist(fp)
+        if 'feeding_hole_Y' in _calib: calib['feeding_hole_Y'] = int(_calib['feeding_hole_Y'])
+        if 'HSV_max_ear' in _calib: calib['HSV_max_ear'] = tuple(_calib['HSV_max_ear'])
+        if 'HSV_min_ear' in _calib:
+            for name in _calib['HSV_min_ear'].iterkeys():
+                calib['HSV_min_ear'][name] = tuple(_calib['HSV_min_ear'][name])
+    return calib
+
+# --------------------------------------------------
+
+def save_calibration(fp, calib):
+# writes calibration values into a calibration file (plist)
+    _calib = dict( feeding_hole_Y = int(calib['feeding_hole_Y']),
+                   HSV_max_ear = list(calib['HSV_max_ear']),
+                   HSV_min_ear = {} )
+    for name in calib['HSV_min_ear'].iterkeys():
+        _calib['HSV_min_ear'][name] = list(calib['HSV_min_ear'][name])
+    plistlib.writePlist(_calib, fp)
+
+# --------------------------------------------------
+
+def get_ear_HSV_min(dirname, HSV_min_ear):
+# returns the lower HSV bound of ear color for the individual of the given trial directory
+    name = dirname.split('_')[1]
+    if name in HSV_min_ear: return HSV_min_ear[name]
+    else: return HSV_min_ear['default']
+
+# --------------------------------------------------
+
+def write_csv_header(f):
+# writes header lines of a result CSV file
+    f.write('# Ear-rect : Ear1_UpperLeft_PT/Ear1_LowerRight_PT/Ear2_UpperLeft_PT/Ear2_LowerRight_PT\n')
+    f.write('# Carried : 1 if the result of the previous frame was carried over (nothing moved around the head)\n')
+    f.write('Frame-index, Ear-rect, Direction, Direction-line-start, Direction-line-end, Carried\n')
+
+# --------------------------------------------------
+
+def format_row(row):
+# returns a line of result CSV file
+# row: (frame-index, ear-rect, direction, direction-line-start, direction-line-end, carried)
+    _fi, _earR, r_deg, r_p1, r_p2, carried = row
+    return '%i, %i/%i/%i/%i, %i, %i/%i, %i/%i, %i\n'%( _fi, # frame-index
+                                                       _earR[0], _earR[1], _earR[2], _earR[3], # ear-rect
+                                                       r_deg, # (head) direction
+                                                       r_p1[0], # direction line start point-X
+                                                       r_p1[1], # direction line start point-Y
+                                                       r_p2[0], # direction line end point-X
+                                                       r_p2[1], # direction line end point-Y
+                                                       carried )
+
+# --------------------------------------------------
+
+def draw_result(img, res, temp_img=None, flag_draw_SURF_dots=True):
+# draws the analysis result of a frame on 'img' (and on 'temp_img', template image); numpy arrays of BGR image
+    if res['nn_pts'] is not None and flag_draw_SURF_dots == True:
+        for i in xrange(len(res['nn_pts'])):
+            if res['matched'][i] == True: color = (0, 0, 255) # draw matched keypoints in red color
+            else: color = (255, 0, 0) # draw unmatched in blue color
+            ### draw matched key points on haystack image
+            x,y = res['nn_pts'][i]
+            if x < 0: continue # no nearest point ('flann' matching)
+            cv2.circle(img, (int(x),int(y)), 2, color, -1)
+            if temp_img is not None:
+                ### draw matched key points on needle image
+                x,y = res['t_pts'][i]
+                cv2.circle(temp_img, (int(x),int(y)), 2, color, -1)
+    if res['lk_pts'] is not None:
+        for x, y in res['lk_pts']: cv2.circle(img, (int(x),int(y)), 2, (0,255,0), -1) # points followed with optical flow
+    if res['search_rect'] != None:
+        s_rect = res['search_rect']
+        cv2.rectangle(img, (s_rect[0],s_rect[1]), (s_rect[2],s_rect[3]), (0,255,0), 1) # tracking window
+    if res['h_rect'] != None:
+        h_rect = res['h_rect']
+        cv2.rectangle(img, (h_rect[0],h_rect[1]), (h_rect[2],h_rect[3]), (0,255,255), 1)
+    for pt1, pt2 in res['ear_rects']:
+        cv2.rectangle(img, pt1, pt2, (255,255,0), 1)
+    if res['ears'] != None:
+        for pt1, pt2 in res['ears']:
+            cv2.rectangle(img, pt1, pt2, (255,0,0), 1)
+    if res['ear_line'] != None:
+        cv2.line(img, res['ear_line'][0], res['ear_line'][1], (255,0,0), 1) # line between ears
+    if res['row'] != None:
+        cv2.line(img, tuple(res['row'][3]), tuple(res['row'][4]), (0,0,255), 1) # draw head direction line
+    if res['carried'] == True:
+        cv2.putText(img, 'carried', (5, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,255), 1) # result of the previous frame
+
+#====================================================
+
+class ResultWriter(object):
+# Writes result rows of a trial into the result CSV file and its binary sidecar (NPZ) file.
+# Rows are kept in memory and both files are rewritten at every 'chunk_size' rows and at close.
+# Each file is written into a temporary file, then renamed, so that a crash never leaves
+# a half-written file; at most the rows after the last chunk boundary are lost.
+# Sidecar arrays (row-aligned) :
+#   frame (N, int32), ear_rect (N x 4, int32), direction (N, float32),
+#   line_start (N x 2, int32), line_end (N x 2, int32), carried (N, bool)
+
+    def __init__(self, csv_fp, chunk_size=RESULT_CHUNK_SIZE, resume_fi=None):
+    # resume_fi: when it's given, rows of frames up to this frame (1~) are kept from the existing files
+        self.csv_fp = csv_fp
+        self.npz_fp = os.path.splitext(csv_fp)[0] + '.npz'
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.lines = [] # formatted CSV lines of rows
+        self.n_flushed = 0 # number of rows in the files
+        if resume_fi != None: self.load_rows(resume_fi)
+        self.flush()
+
+    #------------------------------------------------
+
+    def load_rows(self, resume_fi):
+    # the CSV file is the reference; the sidecar gives more precise directions, if it has the same rows
+        if not os.path.isfile(self.csv_fp): return
+        for line in open(self.csv_fp, 'r').readlines():
+            row = parse_result_line(line)
+            if row == None or row[0] >= resume_fi: continue # row frame-index is 0~ (frame index - 1)
+            self.rows.append(row)
+            self.lines.append(line)
+        if os.path.isfile(self.npz_fp):
+            npz = np.load(self.npz_fp)
+            if len(npz['frame']) >= len(self.rows) and \
+               np.array_equal(npz['frame'][:len(self.rows)], [ row[0] for row in self.rows ]):
+                for i in xrange(len(self.rows)):
+                    self.rows[i] = self.rows[i][:2] + (float(npz['direction'][i]),) + self.rows[i][3:]
+
+    #------------------------------------------------
+
+    def replace_rows(self, rows):
+    # replaces all the rows (e.g.: after resolve_flips); they're written at the next flush
+        self.rows = list(rows)
+        self.lines = [ format_row(row) for row in self.rows ]
+        self.n_flushed = -1
+
+    #------------------------------------------------
+
+    def write(self, row):
+    # row: (frame-index, ear-rect, direction, direction-line-start, direction-line-end); see format_row
+        self.rows.append(row)
+        self.lines.append( format_row(row) )
+        if len(self.rows) - self.n_flushed >= self.chunk_size: self.flush()
+
+    #------------------------------------------------
+
+    def flush(self):
+        tmp_fp = '%s.%i.tmp'%(self.csv_fp, os.getpid())
+        f = open(tmp_fp, 'w')
+        write_csv_header(f)
+        f.writelines(self.lines)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_fp, self.csv_fp)
+
+        n = len(self.rows)
+        arr = dict( frame = np.zeros(n, dtype = np.int32),
+                    ear_rect = np.zeros((n, 4), dtype = np.int32),
+                    direction = np.zeros(n, dtype = np.float32),
+                    line_start = np.zeros((n, 2), dtype = np.int32),
+                    line_end = np.zeros((n, 2), dtype = np.int32),
+                    carried = np.zeros(n, dtype = np.bool_) )
+        for i in xrange(n):
+            arr['frame'][i], arr['ear_rect'][i], arr['direction'][i], arr['line_start'][i], arr['line_end'][i], arr['carried'][i] = self.rows[i]
+        tmp_fp = '%s.%i.tmp'%(self.npz_fp, os.getpid())
+        f = open(tmp_fp, 'wb')
+        np.savez(f, **arr)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp_fp, self.npz_fp)
+        self.n_flushed = n
+
+    #------------------------------------------------
+
+    def close(self):
+        if self.n_flushed < len(self.rows): self.flush()
+
+#------------------------------------------------
+
+def parse_result_line(line):
+# returns a row (see format_row) of a line of result CSV file, or None if it's not a result row
+    if line.startswith('#') or line.startswith('Frame-'): return None
+    items = [ item.strip() for item in line.split(',') ]
+    if len(items) < 5: return None
+    try:
+        return ( int(items[0]),
+                 tuple([ int(v) for v in items[1].split('/') ]),
+                 float(items[2]),
+                 tuple([ int(v) for v in items[3].split('/') ]),
+                 tuple([ int(v) for v in items[4].split('/') ]),
+                 len(items) > 5 and items[5] == '1' ) # no 'Carried' column in results of an older version
+    except ValueError:
+        return None # broken line
+
+#------------------------------------------------
+
+def load_result(csv_fp):
+# returns result arrays of a trial (see ResultWriter) from its binary sidecar file.
+# when there's no sidecar file (results of an older version), the CSV file is parsed.
+    npz_fp = os.path.splitext(csv_fp)[0] + '.npz'
+    if os.path.isfile(npz_fp):
+        npz = np.load(npz_fp)
+        return dict( [ (key, npz[key]) for key in npz.files ] )
+    rows = []
+    for line in open(csv_fp, 'r').readlines():
+        row = parse_result_line(line)
+        if row == None: continue
+        rows.append( [row[0]] + list(row[1]) + [row[2]] + list(row[3]) + list(row[4]) + [row[5]] )
+    rows = np.asarray(rows, dtype = np.float64).reshape((-1, 11))
+    return dict( frame = rows[:,0].astype(np.int32),
+                 ear_rect = rows[:,1:5].astype(np.int32),
+                 direction = rows[:,5].astype(np.float32),
+                 line_start = rows[:,6:8].astype(np.int32),
+                 line_end = rows[:,8:10].astype(np.int32),
+                 carried = rows[:,10].astype(np.bool_) )
+
+#====================================================
+
+class FeatureCache(object):
+# On-disk cache of per-frame keypoints & descriptors of a trial, for re-running the analysis
+# with other matching, clustering or ear color parameters without feature detection.
+# Files in 'features/[trial directory name]/[engine cache name]/' of the results directory :
+#   current : name of the version directory in use, which has the three files below
+#   lock : locked while a process merges & writes a new version (mva_batch -j chunks, mva_sweep -d jobs)
+#   [version]/pts.npy (N x 2, float32) : keypoint coordinates (in the frame) of all the cached frames
+#   [version]/desc.npy (N x rowsize) : descriptors; float16 (SURF) or uint8 (ORB), memory-mapped when it's read
+#   [version]/index.npz : frame (M, int32), offsets (M+1, int64; rows of each frame in pts & desc),
+#               digest (M, MD5 of the grey detection area of each frame), key (engine & detection area)
+# An entry is used only when the digest of the current frame is same; otherwise features are detected again.
+
+    def __init__(self, results_dir, dirname, engine, area):
+    # area: detection area (x1,y1,x2,y2); whole frame below the feeding hole
+        self.cache_dir = os.path.join(results_dir, 'features', dirname, engine.cache_name)
+        self.key = '%s_%i_%i_%i_%i'%(engine.cache_name, area[0], area[1], area[2], area[3])
+        self.index = {} # key: frame index, value: (row offset, row end, digest)
+        self.pts = None
+        self.desc = None
+        self.new = {} # entries added in this run; key: frame index, value: (digest, pts, descriptors)
+        self.load()
+
+    #------------------------------------------------
+
+    def load(self):
+        current_fp = os.path.join(self.cache_dir, 'current')
+        if not os.path.isfile(current_fp): return
+        try:
+            version_dir = os.path.join(self.cache_dir, open(current_fp).read().strip())
+            index = np.load(os.path.join(version_dir, 'index.npz'))
+            if str(index['key']) != self.key: return # engine parameters or detection area were changed
+            pts = np.load(os.path.join(version_dir, 'pts.npy'), mmap_mode = 'r')
+            desc = np.load(os.path.join(version_dir, 'desc.npy'), mmap_mode = 'r')
+            offsets = index['offsets']
+            if len(pts) != offsets[-1] or len(desc) != offsets[-1]: return # index and arrays of different runs
+            for i, fi in enumerate(index['frame']):
+                self.index[int(fi)] = (int(offsets[i]), int(offsets[i+1]), str(index['digest'][i]))
+            self.pts = pts
+            self.desc = desc
+        except (IOError, KeyError, ValueError):
+            self.index = {} # broken cache; features will be detected again
+
+    #------------------------------------------------
+
+    def get(self, fi, digest):
+    # returns (pts, descriptors) of the frame 'fi', or None if there's no valid entry
+        if fi in self.new and self.new[fi][0] == digest: return self.new[fi][1], self.new[fi][2]
+        if fi not in self.index or self.index[fi][2] != digest: return None
+        s, e, _digest = self.index[fi]
+        desc = np.array(self.desc[s:e])
+        if desc.dtype == np.float16: desc = desc.astype(np.float32)
+        return np.array(self.pts[s:e]), desc
+
+    #------------------------------------------------
+
+    def put(self, fi, digest, pts, desc):
+        self.new[fi] = (digest, pts, desc)
+
+    #------------------------------------------------
+
+    def save(self):
+    # writes cached entries and entries of this run into a new version directory.
+    # load, merge and write are done while holding the lock, so that entries of other processes aren't lost.
+    # the three files are switched at once by renaming the 'current' file; readers see either the old or the new version.
+        if len(self.new) == 0: return
+        try: os.makedirs(self.cache_dir)
+        except OSError: pass # already made (possibly by another process at the same time)
+        lock_f = open(os.path.join(self.cache_dir, 'lock'), 'a')
+        if fcntl != None: fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            self.index = {}
+            self.load() # entries written by others since it was opened (e.g.: other chunks of the same trial)
+            frames = sorted( set(self.index.keys()) | set(self.new.keys()) )
+            pts_list = []; desc_list = []; digests = []
+            offsets = np.zeros(len(frames)+1, dtype = np.int64)
+            for i, fi in enumerate(frames):
+                if fi in self.new:
+                    digest, pts, desc = self.new[fi]
+                else:
+                    s, e, digest = self.index[fi]
+                    pts = self.pts[s:e]; desc = self.desc[s:e]
+                if desc.dtype.kind == 'f': desc = desc.astype(np.float16) # quantized; enough for matching distance
+                pts_list.append(pts); desc_list.append(desc); digests.append(digest)
+                offsets[i+1] = offsets[i] + len(pts)
+            version = 'v%i_%i'%(int(time()*1000), os.getpid())
+            version_dir = os.path.join(self.cache_dir, version)
+            tmp_dir = version_dir + '.tmp'
+            os.mkdir(tmp_dir)
+            np.save(os.path.join(tmp_dir, 'pts.npy'), np.concatenate(pts_list).astype(np.float32).reshape((-1, 2)))
+            np.save(os.path.join(tmp_dir, 'desc.npy'), np.concatenate(desc_list))
+            f = open(os.path.join(tmp_dir, 'index.npz'), 'wb')
+            np.savez(f, frame = np.array(frames, dtype = np.int32), offsets = offsets, digest = np.array(digests), key = self.key)
+            f.close()
+            os.rename(tmp_dir, version_dir)
+            current_fp = os.path.join(self.cache_dir, 'current')
+            tmp_fp = '%s.%i.tmp'%(current_fp, os.getpid())
+            f = open(tmp_fp, 'w')
+            f.write(version)
+            f.close()
+            os.rename(tmp_fp, current_fp)
+            # previous versions (and leftovers of crashed writers); files already memory-mapped by readers stay valid
+            for fp in glob(os.path.join(self.cache_dir, 'v*')):
+                if fp != version_dir: shutil.rmtree(fp, ignore_errors = True)
+        finally:
+            if fcntl != None: fcntl.flock(lock_f, fcntl.LOCK_UN)
+            lock_f.close()
+        self.index = {}
+        self.new = {}
+        self.load() # entries of this run are read from the files from now on
+
+#====================================================
+
+class NullStageTimer(object):
+# stage timer of a disabled StageProfiler; does nothing
+    def __enter__(self): pass
+    def __exit__(self, exc_type, exc_value, tb): return False
+
+NULL_STAGE_TIMER = NullStageTimer()
+
+#====================================================
+
+class StageTimer(object):
+# measures time of a stage (with statement) and adds it to the current frame of a StageProfiler
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        self.s_time = time()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.prof.add_time(self.name, time()-self.s_time)
+        return False
+
+#====================================================
+
+class StageProfiler(object):
+# Per-frame processing time of named stages and counters (keypoints, matches, ...).
+# with prof.stage('name'): ... measures a stage; prof.count('name', n) adds to a counter,
+# prof.set('name', value) sets a counter.
+# When it's disabled, stage() returns a timer doing nothing and other methods return immediately.
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.stage_names = [] # in the order of the first appearance
+        self.count_names = []
+        self.rows = [] # (frame index, total time, stage times, counters) of each frame
+        self.curr = None # the current frame
+
+    #------------------------------------------------
+
+    def reset(self):
+        self.rows = []
+        self.curr = None
+
+    #------------------------------------------------
+
+    def start_frame(self, fi):
+        if not self.enabled: return
+        self.curr = (fi, time(), {}, {})
+
+    #------------------------------------------------
+
+    def stage(self, name):
+        if not self.enabled or self.curr == None: return NULL_STAGE_TIMER
+        return StageTimer(self, name)
+
+    #------------------------------------------------
+
+    def add_time(self, name, e_time):
+    # a stage can occur more than once in a frame (e.g.: SURF in the tracking window, then in the whole frame)
+        if name not in self.stage_names: self.stage_names.append(name)
+        self.curr[2][name] = self.curr[2].get(name, 0.0) + e_time
+
+    #------------------------------------------------
+
+    def count(self, name, n):
+        if not self.enabled or self.curr == None: return
+        if name not in self.count_names: self.count_names.append(name)
+        self.curr[3][name] = self.curr[3].get(name, 0) + n
+
+    #------------------------------------------------
+
+    def set(self, name, value):
+    # a counter, which is a value of the frame (e.g.: detector threshold), not a sum
+        if not self.enabled or self.curr == None: return
+        if name not in self.count_names: self.count_names.append(name)
+        self.curr[3][name] = value
+
+    #------------------------------------------------
+
+    def end_frame(self):
+        if not self.enabled or self.curr == None: return
+        fi, s_time, stages, counts = self.curr
+        self.rows.append( (fi, time()-s_time, stages, counts) )
+        self.curr = None
+
+    #------------------------------------------------
+
+    def write_csv(self, fp):
+    # per-frame profile CSV; times in milliseconds. (a stage which didn't occur in a frame is 0)
+        if not os.path.isdir(os.path.dirname(fp)): os.mkdir(os.path.dirname(fp))
+        f = open(fp, 'w')
+        f.write( ', '.join(['frame', 'total'] + self.stage_names + self.count_names) + '\n' )
+        for fi, total, stages, counts in self.rows:
+            line = [ '%i'%fi, '%.3f'%(total*1000) ]
+            line += [ '%.3f'%(stages.get(name, 0.0)*1000) for name in self.stage_names ]
+            line += [ '%i'%counts.get(name, 0) for name in self.count_names ]
+            f.write( ', '.join(line) + '\n' )
+        f.close()
+
+#------------------------------------------------
+
+def get_profile_fp(results_dir, dirname):
+# per-frame profile CSV of a trial; in 'profile' directory, not to be mixed with result CSV files
+    return os.path.join(results_dir, 'profile', dirname + '.csv')
+
+#------------------------------------------------
+
+def summarize_profiles(fp_list, summary_fp):
+# per-run summary of per-frame profile CSV files (written by StageProfiler.write_csv).
+# writes mean, p50 and p95 of each stage time (ms) and counter in all the frames,
+# and returns the summary lines.
+    cols = {} # values of each column
+    names = [] # column names in order
+    for fp in fp_list:
+        if not os.path.isfile(fp): continue
+        f = open(fp, 'r')
+        header = [ name.strip() for name in f.readline().split(',') ]
+        for name in header[1:]:
+            if name not in names: names.append(name); cols[name] = []
+        for line in f.readlines():
+            items = line.split(',')
+            if len(items) != len(header): continue
+            for i in xrange(1, len(header)): cols[header[i]].append( float(items[i]) )
+        f.close()
+    lines = [ 'stage/counter, frames, mean, p50, p95' ]
+    for name in names:
+        if len(cols[name]) == 0: continue
+        _arr = np.asarray(cols[name])
+        lines.append( '%s, %i, %.3f, %.3f, %.3f'%(name,
+                                                  len(_arr),
+                                                  _arr.mean(),
+                                                  np.percentile(_arr, 50),
+                                                  np.percentile(_arr, 95)) )
+    f = open(summary_fp, 'w')
+    f.write( '\n'.join(lines) + '\n' )
+    f.close()
+    return lines
+
+#====================================================
+
+class HeadDirectionAnalyzer(object):
+# Class for calculating the head direction in each frame of a trial directory
+
+    def __init__(self, calib, results_dir, params=None):
+        if debug: print 'HeadDirectionAnalyzer.__init__'
+
+        self.params = dict(DEFAULT_PARAMS)
+        if params != None: self.params.update(params)
+        self.calib = calib
+        self.results_dir = results_dir
+        self.feeding_hole_Y = calib['feeding_hole_Y'] # the limit position-Y due to the feeding hole (white colors above this line will be ignored)
+        self.s_frag_th = self.params['s_frag_th'] # lower-threshold for subject's fragment rect size
+        self.HSV_min_ear = calib['HSV_min_ear']['default'] # for Marmoset's ear
+        self.HSV_max_ear = calib['HSV_max_ear'] # for Marmoset's ear
+        self.engine = create_feature_engine(self.params) # feature detection, description & matching (SURF or ORB)
+        self.kp_budget = None # controller of the detector threshold ('kp_band')
+        if self.params['kp_band'] != None and hasattr(self.engine, 'set_threshold'):
+            self.kp_budget = KeypointBudget(self.engine, self.params['kp_band'], self.params['kp_window'])
+        self.frame_size = None
+        self.n_alloc = 0 # number of buffer allocations (alloc_buffers)
+        self.alloc_bytes = 0 # bytes of allocated buffers
+        self.dirname = None
+        self.prof = StageProfiler(self.params['profile']) # per-frame stage timing
+
+    #------------------------------------------------
+
+    def alloc_buffers(self, frame_size, force=False):
+    # allocate image buffers (numpy arrays) for the given frame size (w, h).
+    # buffers are allocated only when the frame size changes, and reused for all the frames & trials.
+    # force: allocated again with the same frame size; the grey image of the last frame is copied.
+        if debug: print 'HeadDirectionAnalyzer.alloc_buffers'
+
+        if self.frame_size == tuple(frame_size) and force == False: return
+        last_grey = self.grey_buf if self.frame_size == tuple(frame_size) else None
+        self.frame_size = tuple(frame_size)
+        w, h = self.frame_size
+        self.grey_buf = np.zeros((h, w), dtype = np.uint8) # grey image
+        self.prev_grey_buf = np.zeros((h, w), dtype = np.uint8) # grey image of the previous frame
+        self.col_buf = np.zeros((h, w, 3), dtype = np.uint8) # color area for find_color
+        self.HSV_buf = np.zeros((h, w, 3), dtype = np.uint8) # HSV of the color area
+        self.mask_buf = np.zeros((h, w), dtype = np.uint8) # result of find_color
+        if last_grey is not None: self.grey_buf[:] = last_grey # becomes the previous grey image in proc_frame
+        self.n_alloc += 1
+        self.alloc_bytes += self.grey_buf.nbytes + self.prev_grey_buf.nbytes + self.col_buf.nbytes + self.HSV_buf.nbytes + self.mask_buf.nbytes
+
+    #------------------------------------------------
+
+    def init_trial(self, dirname):
+    # initialize variables for a trial directory
+        if debug: print 'HeadDirectionAnalyzer.init_trial'
+
+        self.dirname = dirname
+        HSV_min_ear = self.calib['HSV_min_ear']
+        if self.params['ear_HSV_min'] != None: HSV_min_ear = dict(HSV_min_ear, **self.params['ear_HSV_min']) # per-individual overrides
+        self.HSV_min_ear = get_ear_HSV_min(dirname, HSV_min_ear)
+        if self.params['ear_V_min'] != None: self.HSV_min_ear = (self.HSV_min_ear[0], self.HSV_min_ear[1], self.params['ear_V_min'])
+        _tmp = dirname.split('_')
+        _head_fn = '%s_%s_head.jpg'%(_tmp[0], _tmp[1])
+        self.template_fp = os.path.join(self.results_dir, _head_fn)
+        if self.kp_budget != None: self.kp_budget.reset() # template features with 'hessian_threshold'
+        self.t_pts, t_desc = get_template_features(self.template_fp, self.engine) # template features are cached
+        self.matcher = self.engine.create_matcher(t_desc) # built once per trial
+        if self.params['coarse_loc'] == True:
+            self.coarse_t, self.coarse_t_size = get_coarse_template(self.template_fp, self.params['coarse_levels'], self.params['coarse_angles'])
+        self.coarse_on = self.params['coarse_loc'] # turned off when the coarse localization rarely finds the head
+        self.coarse_angle = None # index of the rotated template of the last coarse region (None: all the templates are tried)
+        self.coarse_tries = 0 # number of coarse localizations in the trial
+        self.coarse_hits = 0 # number of them, where the head was found in the coarse region
+        self.prev_hd = [] # previous head directions
+        self.prev_hd_last = -1 # frame number when the last head direction was updated
+        self.update_tracker(None)
+        self.last_res = None # result of the last frame (motion gate)
+        self.last_fi = -1 # index of the last frame
+        self.n_carried = 0 # number of consecutive carried frames
+        self.confidence = {} # {row frame-index: confidence of the ear line} ('global' flip_mode)
+        self.fcache = None # FeatureCache of the trial; opened at the first frame, when the frame size is known
+        self.feat = None # (frame index, pts, descriptors) of the detection area of the current frame (feature_cache)
+        self.init_lk(None, [])
+
+    #------------------------------------------------
+
+    def get_state(self):
+    # state carried over frames (for a checkpoint); values which can be stored in a plist file
+        return dict( prev_hd = list(self.prev_hd),
+                     prev_hd_last = self.prev_hd_last,
+                     track_center = list(self.track_center) if self.track_center != None else [],
+                     track_vel = list(self.track_vel),
+                     kp_threshold = self.engine.hessian_threshold if self.kp_budget != None else -1,
+                     confidence = dict([ (str(fi), c) for fi, c in self.confidence.iteritems() ]) ) # plist keys are strings
+
+    #------------------------------------------------
+
+    def set_state(self, state):
+        self.prev_hd = list(state['prev_hd'])
+        self.prev_hd_last = state['prev_hd_last']
+        if len(state['track_center']) == 2: self.track_center = tuple(state['track_center'])
+        else: self.track_center = None
+        self.track_vel = tuple(state['track_vel'])
+        if self.kp_budget != None and state.get('kp_threshold', -1) > 0: self.kp_budget.reset(state['kp_threshold'])
+        # confidence of the rows before the checkpoint, for resolving flips of the whole trial at its end
+        self.confidence = dict([ (int(fi), c) for fi, c in state.get('confidence', {}).iteritems() ])
+        self.last_res = None # the first frame after a checkpoint is fully analyzed
+        self.init_lk(None, [])
+
+    #------------------------------------------------
+
+    def update_tracker(self, center):
+    # update the motion model of head position with the head center of the current frame
+    # (center is None when the head wasn't found)
+        if center == None:
+            self.track_center = None
+            self.track_vel = (0, 0)
+            return
+        if self.track_center != None:
+            self.track_vel = (center[0]-self.track_center[0], center[1]-self.track_center[1])
+        self.track_center = center
+
+    #------------------------------------------------
+
+    def predict_search_rect(self):
+    # returns the tracking window (x1,y1,x2,y2) around the predicted head position (constant velocity),
+    # or None when tracking is off or the head wasn't found in the last frame.
+        if self.params['track_head'] == False or self.track_center == None: return None
+        cx = self.track_center[0] + self.track_vel[0]
+        cy = self.track_center[1] + self.track_vel[1]
+        w, h = self.params['track_win']
+        x1 = max(0, cx - w/2); x2 = min(self.frame_size[0], cx + w/2)
+        y1 = max(self.feeding_hole_Y, cy - h/2); y2 = min(self.frame_size[1], cy + h/2)
+        if x2 - x1 < 32 or y2 - y1 < 32: return None # window is mostly out of the frame
+        return (x1, y1, x2, y2)
+
+    #------------------------------------------------
+
+    def coarse_search_rect(self, hgrey):
+    # coarse head localization; normalized cross-correlation of the downscaled (rotated) templates against
+    # the downscaled area below the feeding hole ('coarse_levels' times of cv2.pyrDown).
+    # after a coarse region was found, only the rotated templates next to its angle are tried.
+    # returns the candidate region (x1,y1,x2,y2; around the center of the best match, twice of the template size)
+    # and the NCC score. the region is None when the score is lower than 'coarse_th'.
+        y0 = min(max(0, self.feeding_hole_Y), self.frame_size[1]-1)
+        small = hgrey[y0:]
+        for i in xrange(self.params['coarse_levels']): small = cv2.pyrDown(small)
+        n_angles = len(self.coarse_t)
+        if self.coarse_angle == None: indices = range(n_angles)
+        else: indices = sorted(set([ (self.coarse_angle + k) % n_angles for k in [-1, 0, 1] ]))
+        max_val = 0.0
+        for ai in indices:
+            t = self.coarse_t[ai]
+            if t.shape[0] > small.shape[0] or t.shape[1] > small.shape[1]: continue
+            score = cv2.matchTemplate(small, t, cv2.TM_CCOEFF_NORMED)
+            _min_val, _max_val, _min_loc, _max_loc = cv2.minMaxLoc(score)
+            if _max_val > max_val: max_val = _max_val; max_loc = _max_loc; best = ai
+        if max_val < self.params['coarse_th']:
+            self.coarse_angle = None
+            return None, max_val
+        self.coarse_angle = best
+        scale = 2 ** self.params['coarse_levels']
+        t_h, t_w = self.coarse_t[best].shape
+        cx = (max_loc[0] + t_w/2.0) * scale; cy = y0 + (max_loc[1] + t_h/2.0) * scale # center of the best match
+        t_w, t_h = self.coarse_t_size
+        if n_angles > 1: t_w = t_h = max(t_w, t_h) # the head can be rotated in the region
+        x1 = max(0, int(cx - t_w)); x2 = min(self.frame_size[0], int(cx + t_w))
+        y1 = max(y0, int(cy - t_h)); y2 = min(self.frame_size[1], int(cy + t_h))
+        return (x1, y1, x2, y2), max_val
+
+    #------------------------------------------------
+
+    def get_features(self, hgrey, rect):
+    # keypoint coordinates (in the frame) and descriptors in 'rect' (x1,y1,x2,y2) of 'hgrey'.
+    # with 'feature_cache' parameter, features of the whole detection area (below the feeding hole) are
+    # read from the cache (or detected and added to it) once per frame, and ones in 'rect' are returned.
+        x1, y1, x2, y2 = rect
+        if self.params['feature_cache'] == False:
+            with self.prof.stage('detect'):
+                h_pts, hrows = self.engine.detect_compute(hgrey[y1:y2, x1:x2], self.params['kp_max'])
+            self.update_budget(rect)
+            h_pts += (x1, y1) # coordinates in the frame
+            return h_pts, hrows
+
+        area = (0, max(0, self.feeding_hole_Y), self.frame_size[0], self.frame_size[1])
+        if self.fcache == None: self.fcache = FeatureCache(self.results_dir, self.dirname, self.engine, area)
+        if self.feat == None or self.feat[0] != self.curr_fi:
+            with self.prof.stage('feature_cache'):
+                digest = hashlib.md5( np.ascontiguousarray(hgrey[area[1]:area[3], area[0]:area[2]]) ).hexdigest()
+                feat = self.fcache.get(self.curr_fi, digest)
+            if feat == None:
+                with self.prof.stage('detect'):
+                    h_pts, hrows = self.engine.detect_compute(hgrey[area[1]:area[3], area[0]:area[2]], self.params['kp_max'])
+                self.update_budget(area)
+                h_pts += (area[0], area[1])
+                self.fcache.put(self.curr_fi, digest, h_pts, hrows)
+            else:
+                h_pts, hrows = feat
+                self.prof.count('cache_hits', 1)
+            self.feat = (self.curr_fi, h_pts, hrows)
+        _fi, h_pts, hrows = self.feat
+        if tuple(rect) == area: return h_pts, hrows
+        inside = (h_pts[:,0] >= x1) & (h_pts[:,0] < x2) & (h_pts[:,1] >= y1) & (h_pts[:,1] < y2)
+        return h_pts[inside], hrows[inside]
+
+    #------------------------------------------------
+
+    def update_budget(self, rect):
+    # logs the detector threshold & number of detected keypoints of a detection in 'rect' (x1,y1,x2,y2),
+    # and adjusts the threshold for the following detections ('kp_band')
+        if hasattr(self.engine, 'hessian_threshold'): self.prof.set('hessian_th', int(self.engine.hessian_threshold))
+        self.prof.count('detected', self.engine.n_detected)
+        if self.kp_budget == None: return
+        y0 = max(0, self.feeding_hole_Y)
+        r_area = max(1, (rect[2]-rect[0]) * (rect[3]-rect[1]))
+        self.kp_budget.update( float(self.engine.n_detected) * self.frame_size[0] * (self.frame_size[1]-y0) / r_area )
+
+    #------------------------------------------------
+
+    def save_features(self):
+    # writes features detected in this trial into the feature cache
+        if self.fcache != None: self.fcache.save()
+
+    #------------------------------------------------
+
+    def match_head(self, hgrey, rect):
+    # feature detection in 'rect' (x1,y1,x2,y2) of 'hgrey' and matching with the template descriptors
+    # returns nearest haystack point of each template descriptor (None if there's no keypoint),
+    # whether each template descriptor is matched, and list of matched points
+        x1, y1, x2, y2 = rect
+        y1 = max(0, y1)
+        if x2 - x1 < 1 or y2 - y1 < 1: return None, None, []
+        h_pts, hrows = self.get_features(hgrey, (x1, y1, x2, y2))
+        self.prof.count('keypoints', len(h_pts))
+        if len(h_pts) == 0 or len(self.t_pts) == 0: return None, None, []
+
+        # match all the template descriptors at once
+        with self.prof.stage('match'):
+            nn_idx, matched = self.matcher.match(hrows)
+        nn_pts = -np.ones((len(nn_idx), 2), dtype = np.float32) # nearest haystack point of each template descriptor
+        nn_pts[nn_idx >= 0] = h_pts[nn_idx[nn_idx >= 0]]
+        m_pts = [ tuple(pt) for pt in nn_pts[matched].astype(np.int32).tolist() ] # list of matched points
+        self.prof.count('matches', len(m_pts))
+        return nn_pts, matched, m_pts
+
+    #------------------------------------------------
+
+    def find_head(self, m_pts):
+    # returns the center point of head; the average of the largest group of matched points
+    # (None if the head wasn't found)
+        if len(m_pts) < 3: return None # there should be, at least, 3 matched points after SURF
+        with self.prof.stage('cluster_head'):
+            number_of_mGroups, mGroups = self.clustering(m_pts, self.params['head_cluster_th']) # clustrering matched points
+        self.prof.count('head_clusters', number_of_mGroups)
+        if number_of_mGroups == 0: return None
+        len_mg = []
+        for mg in mGroups: len_mg.append( len(mg) )
+        idx = len_mg.index( max(len_mg) )
+        mg_r = cv2.boundingRect( np.array(mGroups[idx], dtype = np.int32) )
+        if mg_r[2] + mg_r[3] <= 75: return None # process only if the head rect size is big enough
+        ### calculate the average x & y of the group as the center point of head
+        _cx = 0; _cy = 0
+        for mg in mGroups[idx]: _cx += mg[0]; _cy += mg[1]
+        return ( _cx/len(mGroups[idx]), _cy/len(mGroups[idx]) )
+
+    #------------------------------------------------
+
+    def proc_frame(self, fi, frame):
+    # computer vision process on a frame (fi: frame index, 1~1000, frame: numpy array of BGR image)
+    # returns a dictionary of the result.
+    # res['row'] is a row of result CSV file, it's None when the head direction wasn't determined.
+    # res['carried'] is True when nothing moved around the head and the previous result was carried over.
+        if debug: print 'HeadDirectionAnalyzer.proc_frame'
+
+        self.curr_fi = fi
+        res = dict(fi=fi, search_rect=None, nn_pts=None, t_pts=None, matched=None, h_rect=None, ear_rects=[], ears=None, ear_line=None, row=None, carried=False, lk_pts=None)
+        self.alloc_buffers( (frame.shape[1], frame.shape[0]), force = not self.params['reuse_buffers'] )
+
+        self.grey_buf, self.prev_grey_buf = self.prev_grey_buf, self.grey_buf # keep the previous grey image for the motion gate
+        with self.prof.stage('grey'):
+            hgrey = self.preprocessing(frame) # grey image; only below the feeding hole is valid
+
+        with self.prof.stage('motion_gate'):
+            flag_still = self.is_still(fi, hgrey)
+        if flag_still == True:
+            res = self.carry_result(fi)
+        else:
+            self.n_carried = 0
+            self.proc_frame_full(fi, frame, hgrey, res)
+        self.last_res = res
+        self.last_fi = fi
+        return res
+
+    #------------------------------------------------
+
+    def is_still(self, fi, hgrey):
+    # motion gate; whether nothing moved in the head rect of the previous frame.
+    # mean absolute difference of grey values between the previous and the current frame is compared with 'motion_th'.
+    # the full analysis is forced after 'motion_force' carried frames.
+        if self.params['motion_gate'] == False: return False
+        if self.last_res == None or self.last_res['h_rect'] == None: return False
+        if fi != self.last_fi + 1: return False # previous grey image is not of the previous frame
+        if self.n_carried >= self.params['motion_force']: return False
+        x1, y1, x2, y2 = self.last_res['h_rect']
+        x1 = max(0, x1); y1 = max(0, y1)
+        x2 = min(self.frame_size[0], x2); y2 = min(self.frame_size[1], y2)
+        if x2 <= x1 or y2 <= y1: return False
+        diff = cv2.norm(hgrey[y1:y2, x1:x2], self.prev_grey_buf[y1:y2, x1:x2], cv2.NORM_L1) / ((x2-x1)*(y2-y1))
+        return diff < self.params['motion_th']
+
+    #------------------------------------------------
+
+    def carry_result(self, fi):
+    # result of a still frame; the result of the previous frame with the current frame index
+        res = dict(self.last_res)
+        res['fi'] = fi
+        res['carried'] = True
+        if self.last_res['row'] != None:
+            _fi, _earR, r_deg, r_p1, r_p2 = self.last_res['row'][:5]
+            res['row'] = (fi-1, _earR, r_deg, r_p1, r_p2, True)
+            self.prev_hd_last = fi # the head direction is regarded as updated
+            # ('global' flip_mode) weighted as the measured frame, so that still frames don't outvote measured ones
+            if 'confidence' in self.last_res: self.confidence[fi-1] = self.last_res['confidence']
+        self.n_carried += 1
+        self.prof.count('carried', 1)
+        return res
+
+    #------------------------------------------------
+
+    def proc_frame_full(self, fi, frame, hgrey, res):
+    # full analysis of a frame (SURF matching, ear color), filling 'res'
+    # head points of the previous frame are followed with optical flow ('lk_track'), otherwise
+    # head is searched in the tracking window, then in the coarse region, then in the whole frame below the feeding hole
+        # ------------------------------------------------
+        # SURF extraction starts
+        # ------------------------------------------------
+
+        center = self.track_points(fi, hgrey, res)
+        if center == None:
+            center, m_pts = self.search_head(hgrey, res)
+            self.init_lk(center, m_pts)
+
+        # ------------------------------------------------
+        # SURF extraction ends
+        # ------------------------------------------------
+
+        self.update_tracker(center)
+        if center == None: return
+
+        ### rectangle for head position
+        h_rect = [center[0]-150, center[1]-100, center[0]+150, center[1]+100] # head rect (x1,y1,x2,y2 rect)
+        if h_rect[1] <= self.feeding_hole_Y: h_rect[1] = self.feeding_hole_Y + 1
+        res['h_rect'] = h_rect
+        ### find ear color
+        with self.prof.stage('find_color'):
+            self.find_color((h_rect[0],h_rect[1],h_rect[2],h_rect[3]),
+                            frame,
+                            self.HSV_min_ear,
+                            self.HSV_max_ear,
+                            (0,0,0))
+        with self.prof.stage('get_blobs'):
+            boxes, areas, centers = self.get_blobs(self.roi_mask, self.s_frag_th, self.roi_offset)
+        with self.prof.stage('cluster_ears'):
+            number_of_eGroups, group_of_blob = cluster_labels(centers, self.params['ear_cluster_th']) # clustrering ear points
+            ### bounding rect of blob rects of each group
+            g_pt1 = np.full((number_of_eGroups, 2), np.iinfo(np.int32).max, dtype = np.int32)
+            g_pt2 = np.full((number_of_eGroups, 2), np.iinfo(np.int32).min, dtype = np.int32)
+            np.minimum.at(g_pt1, group_of_blob, boxes[:,:2])
+            np.maximum.at(g_pt2, group_of_blob, boxes[:,2:])
+            g_wh = g_pt2 - g_pt1 + 1 # same as cv2.boundingRect of the corner points
+            g_sz = g_wh.sum(axis=1)
+            big = g_sz >= 40 # exclude too small rects
+            g_pt1 = g_pt1[big]; g_wh = g_wh[big]; g_sz = g_sz[big]
+            sz = g_sz.tolist()
+            pt1_list = [ tuple(pt) for pt in g_pt1.tolist() ]
+            pt2_list = [ tuple(pt) for pt in (g_pt1 + g_wh).tolist() ]
+            res['ear_rects'] = zip(pt1_list, pt2_list)
+        self.prof.count('ear_clusters', number_of_eGroups)
+        self.prof.count('ear_rects', len(res['ear_rects']))
+        if len(pt1_list) >= 2:
+        # there are, at least, 2 rects
+            ### indices for the largest and the 2nd largest (the first one among the same sizes)
+            ear1_idx, ear2_idx = np.argsort(-g_sz, kind = 'mergesort')[:2].tolist()
+            res['ears'] = [ (pt1_list[ear1_idx], pt2_list[ear1_idx]),
+                            (pt1_list[ear2_idx], pt2_list[ear2_idx]) ]
+            _earR = ( pt1_list[ear1_idx][0],
+                      pt2_list[ear1_idx][1],
+                      pt1_list[ear2_idx][0],
+                      pt2_list[ear2_idx][1] )
+            ### left side point becomes pos1
+            if pt1_list[ear2_idx][0] < pt1_list[ear1_idx][0]:
+                tmp = copy(ear1_idx)
+                ear1_idx = copy(ear2_idx)
+                ear2_idx = tmp
+            ### line connecting ears & head direction line
+            pos1 = [ pt1_list[ear1_idx][0] + abs(pt1_list[ear1_idx][0]-pt2_list[ear1_idx][0])/2,
+                     pt1_list[ear1_idx][1] + abs(pt1_list[ear1_idx][1]-pt2_list[ear1_idx][1])/2 ]
+            pos2 = [ pt1_list[ear2_idx][0] + abs(pt1_list[ear2_idx][0]-pt2_list[ear2_idx][0])/2,
+                     pt1_list[ear2_idx][1] + abs(pt1_list[ear2_idx][1]-pt2_list[ear2_idx][1])/2 ]
+            res['ear_line'] = ( tuple(pos1), tuple(pos2) )
+            r_deg, r_p1, r_p2 = rotate_line(self.frame_size, pos1, pos2) # calculate head direction
+            if self.params['flip_mode'] == 'global':
+            # stateless measurement; which side the head faces is resolved after the trial (resolve_flips)
+                ### confidence; two similar sized ear rects without others is the most reliable
+                res['confidence'] = float(min(sz[ear1_idx], sz[ear2_idx])) / max(sz[ear1_idx], sz[ear2_idx]) * 2 / len(pt1_list)
+                self.confidence[fi-1] = res['confidence']
+                res['row'] = (fi-1, _earR, r_deg, r_p1, r_p2, False)
+            elif len(self.prev_hd) < 1: # collect some frames as previous head direction references
+                self.prev_hd.append( copy(r_deg) ) # store the direction
+                self.prev_hd_last = copy( fi ) # last frame when the head direction was collected
+            else:
+                m_val = self.prev_hd[0]
+                alt_r_deg = (r_deg + 180) % 360 # alternate degree (opposite direction)
+                diff1 = abs(m_val - r_deg)
+                if diff1 > 180: diff1 = 180 - (diff1 % 180)
+                diff2 = abs(m_val - alt_r_deg)
+                if diff2 > 180: diff2 = 180 - (diff2 % 180)
+                if min([diff1, diff2]) < 45: # if minimum degree is bigger than 45, ignore this head direction
+                    if diff1 > diff2: # if alternate degree has smaller difference
+                        r_deg, r_p1, r_p2 = rotate_line(self.frame_size, pos1, pos2, -90) # calculate the points again
+                    self.prev_hd.append( copy(r_deg) ) # store the direction
+                    self.prev_hd_last = copy( fi ) # last frame when the head direction was collected
+                    if len(self.prev_hd) == 2: self.prev_hd.pop(0) # collect 1 frame
+                    _fi = fi - 1 # Marmoset frame images have 1~1000 indices. Make it to 0~999
+                    res['row'] = (_fi, _earR, r_deg, r_p1, r_p2, False)
+            if fi - self.prev_hd_last > 10: # if there was no head direction update for 10 frames
+                self.prev_hd = [] # initialize previous head directions
+                self.prev_hd_last = copy( fi ) # last frame when the head direction was collected
+
+    #------------------------------------------------
+
+    def search_head(self, hgrey, res):
+    # head search with feature matching; in the tracking window, then in the coarse region,
+    # then in the whole frame below the feeding hole (filling 'res')
+    # returns the head center (None if the head wasn't found) and list of matched points
+        search_r = self.predict_search_rect()
+        if search_r != None:
+            nn_pts, matched, m_pts = self.match_head(hgrey, search_r)
+            center = self.find_head(m_pts)
+            if center == None: search_r = None # head wasn't found in the tracking window
+        if search_r == None and self.coarse_on == True:
+            with self.prof.stage('coarse'):
+                search_r, c_score = self.coarse_search_rect(hgrey)
+            if self.params['coarse_min'] != None and c_score < self.params['coarse_min']:
+            # head-absent frame; skipped without feature detection
+                self.prof.count('coarse_rejected', 1)
+                return None, []
+            self.coarse_tries += 1
+            if search_r != None:
+                nn_pts, matched, m_pts = self.match_head(hgrey, search_r)
+                center = self.find_head(m_pts)
+                if center == None: # head wasn't found in the coarse region; search the whole frame
+                    search_r = None
+                    self.coarse_angle = None
+                else:
+                    self.coarse_hits += 1
+                    self.prof.count('coarse_found', 1)
+            if self.coarse_tries >= self.params['coarse_probe'] and self.coarse_hits < self.params['coarse_min_hit'] * self.coarse_tries:
+            # it costs more than it saves; whole frame is searched for the rest of the trial
+                self.coarse_on = False
+                self.prof.count('coarse_off', 1)
+        if search_r == None:
+            nn_pts, matched, m_pts = self.match_head(hgrey, (0, self.feeding_hole_Y, self.frame_size[0], self.frame_size[1]))
+            center = self.find_head(m_pts)
+        else:
+            res['search_rect'] = search_r
+        res['nn_pts'] = nn_pts
+        res['t_pts'] = self.t_pts
+        res['matched'] = matched
+        return center, m_pts
+
+    #------------------------------------------------
+
+    def init_lk(self, center, m_pts):
+    # starts optical flow tracking ('lk_track') with the matched points around the head center
+        self.lk_pts = None
+        self.n_lk = 0
+        if self.params['lk_track'] == False or center == None: return
+        pts = np.array(m_pts, dtype = np.float32).reshape((-1, 2))
+        near = (np.abs(pts[:,0] - center[0]) <= 150) & (np.abs(pts[:,1] - center[1]) <= 100) # in the head rect
+        if np.count_nonzero(near) >= self.params['lk_min_pts']: self.lk_pts = pts[near].reshape((-1, 1, 2))
+
+    #------------------------------------------------
+
+    def track_points(self, fi, hgrey, res):
+    # follows head points of the previous frame with pyramidal Lucas-Kanade optical flow ('lk_track').
+    # a point is kept when it's found in both directions (previous -> current -> previous),
+    # comes back within 'lk_fb_th' pixels and its patches are similar ('lk_err_th'). feature detection is needed again (None is returned) when
+    # less than 'lk_min_pts' points are left, their rect is too small, or after 'lk_redetect' tracked frames.
+    # returns the head center (average of the tracked points)
+        if self.params['lk_track'] == False or self.lk_pts is None: return None
+        if fi != self.last_fi + 1 or self.n_lk >= self.params['lk_redetect']:
+            self.lk_pts = None
+            return None
+        with self.prof.stage('lk_track'):
+            lk_params = dict(winSize = (21, 21), maxLevel = 3, criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03))
+            p1, st1, err = cv2.calcOpticalFlowPyrLK(self.prev_grey_buf, hgrey, self.lk_pts, None, **lk_params)
+            p0r, st0, _err = cv2.calcOpticalFlowPyrLK(hgrey, self.prev_grey_buf, p1, None, **lk_params)
+            fb_err = np.abs(self.lk_pts - p0r).reshape((-1, 2)).max(axis=1)
+            good = (st1.ravel() == 1) & (st0.ravel() == 1) & (fb_err < self.params['lk_fb_th']) & (err.ravel() < self.params['lk_err_th'])
+            good &= p1[:,0,1] > self.feeding_hole_Y # grey image is valid only below the feeding hole
+            pts = p1[good]
+        self.prof.count('lk_pts', len(pts))
+        if len(pts) < self.params['lk_min_pts']:
+            self.lk_pts = None
+            return None
+        x1, y1 = pts.reshape((-1, 2)).min(axis=0); x2, y2 = pts.reshape((-1, 2)).max(axis=0)
+        if (x2 - x1) + (y2 - y1) <= 75: # same as the head rect size of find_head
+            self.lk_pts = None
+            return None
+        self.lk_pts = pts
+        self.n_lk += 1
+        res['lk_pts'] = pts.reshape((-1, 2))
+        cx, cy = pts.reshape((-1, 2)).mean(axis=0)
+        return (int(cx), int(cy))
+
+    #------------------------------------------------
+
+    def find_color(self, rect, inImage, HSV_min, HSV_max, bgcolor=(255,255,255)):
+    # Find a color(range: 'HSV_min' ~ 'HSV_max') in an area('rect': x1,y1,x2,y2) of an image('inImage'; numpy array)
+    # 'bgcolor' is a background color outside of 'rect'
+    # Only 'rect' and its margin, which preprocessing_col can reach, are processed.
+    # Result (binary image of the processed area) will be stored in self.roi_mask,
+    # and its upper-left position in the image in self.roi_offset.
+    # self.roi_mask is a view of a buffer; it's valid until the next call.
+        if debug: print 'HeadDirectionAnalyzer.find_color'
+
+        self.alloc_buffers( (inImage.shape[1], inImage.shape[0]) )
+        f_h, f_w = inImage.shape[:2]
+        ### area of 'rect' (filled rectangle, including x2 and y2) in the image
+        x1 = max(0, rect[0]); y1 = max(0, rect[1])
+        x2 = min(f_w, rect[2]+1); y2 = min(f_h, rect[3]+1)
+        if x2 <= x1 or y2 <= y1:
+            self.roi_mask = self.mask_buf[:1, :1]
+            self.roi_mask[:] = 0
+            self.roi_offset = (0, 0)
+            return
+        ### processed area; 'rect' with margin, filled with the background color
+        m = COL_PREPROC_MARGIN
+        px1 = max(0, x1-m); py1 = max(0, y1-m)
+        px2 = min(f_w, x2+m); py2 = min(f_h, y2+m)
+        roi_col = self.col_buf[:py2-py1, :px2-px1]
+        roi_col[:] = bgcolor
+        roi_col[y1-py1:y2-py1, x1-px1:x2-px1] = inImage[y1:y2, x1:x2]
+        roi_col = self.preprocessing_col(roi_col)
+        self.roi_mask = self.mask_buf[:py2-py1, :px2-px1]
+        if self.params['color_lut'] == True:
+            ear_color_lut.mask(roi_col, HSV_min, HSV_max, dst=self.roi_mask)
+        else:
+            roi_HSV = self.HSV_buf[:py2-py1, :px2-px1]
+            cv2.cvtColor(roi_col, cv2.COLOR_BGR2HSV, dst=roi_HSV)
+            cv2.inRange(roi_HSV, np.array(HSV_min, dtype = np.uint8), np.array(HSV_max, dtype = np.uint8), dst=self.roi_mask)
+        self.roi_offset = (px1, py1)
+
+    #------------------------------------------------
+
+    def preprocessing(self, inImage):
+    # grey image; only the area below the feeding hole is converted.
+    # returns the whole grey image buffer
+        if debug: print 'HeadDirectionAnalyzer.preprocessing'
+        y = min(max(0, self.feeding_hole_Y), self.frame_size[1]-1)
+        cv2.cvtColor(inImage[y:], cv2.COLOR_RGB2GRAY, dst=self.grey_buf[y:])
+        return self.grey_buf
+
+    #------------------------------------------------
+
+    def preprocessing_col(self, inImage):
+        if debug: print 'HeadDirectionAnalyzer.preprocessing_col'
+        cv2.GaussianBlur(inImage, (5,5), 0, dst=inImage, borderType=cv2.BORDER_REPLICATE) # same as cv.Smooth
+        cv2.dilate(inImage, None, dst=inImage, iterations=3)
+        cv2.erode(inImage, None, dst=inImage, iterations=3)
+        return inImage
+
+    #------------------------------------------------
+
+    def get_blobs(self, inImage, threshold=15, offset=(0,0)):
+    # blobs (8-connected components; the same as outer contours) of the binary image (numpy array)
+    # 'threshold' : threshold (width + height) for a blob fragment
+    # 'offset' : position of 'inImage' in the frame; it's added to all the points
+    # returns arrays of bounding boxes (x1,y1,x2,y2; x2 = x1 + width), areas and centers (center of the box) of blobs
+        if debug: print 'HeadDirectionAnalyzer.get_blobs'
+
+        if hasattr(cv2, 'connectedComponentsWithStats'):
+            stats = cv2.connectedComponentsWithStats(inImage, connectivity=8)[2][1:] # label 0 is the background
+            xywh = stats[:, :4].astype(np.int32)
+            areas = stats[:, cv2.CC_STAT_AREA].astype(np.int32)
+        else:
+            labels, n = ndimage.label(inImage, structure=np.ones((3,3)))
+            slices = ndimage.find_objects(labels)
+            xywh = np.array([ (sx.start, sy.start, sx.stop-sx.start, sy.stop-sy.start) for sy, sx in slices ], dtype = np.int32).reshape((-1, 4))
+            areas = np.bincount(labels.ravel(), minlength = n+1)[1:].astype(np.int32)
+        keep = xywh[:,2] + xywh[:,3] > threshold
+        xywh = xywh[keep]; areas = areas[keep]
+        xywh[:,:2] += offset
+        boxes = np.hstack( (xywh[:,:2], xywh[:,:2] + xywh[:,2:]) )
+        centers = xywh[:,:2] + xywh[:,2:]/2
+        return boxes, areas, centers
+
+    #------------------------------------------------
+
+    def clustering(self, pt_list, threshold):
+        if debug: print 'HeadDirectionAnalyzer.clustering'
+        return cluster_points(pt_list, threshold)
+
+#====================================================
+
+class DirFrameSource(object):
+# Frames of a trial directory, extracted by 'm_extract_frames.py' (f000001.jpg, f000002.jpg, ...)
+# Iterating it yields (frame index; 1~, frame image; numpy array of BGR image)
+
+    def __init__(self, results_dir, dirname, start_fi=1):
+        self.dir_path = os.path.join(results_dir, dirname)
+        self.frame_cnt = len(glob( os.path.join(self.dir_path, 'f*.jpg') ))
+        self.start_fi = start_fi # the first frame to read (1~)
+
+    #------------------------------------------------
+
+    def __iter__(self):
+        fn_set = set(os.listdir(self.dir_path)) # listed once, instead of checking each file's existence
+        fi = self.start_fi # frame index; Marmoset frame files' indices are 1~1000
+        while 'f%.6i.jpg'%fi in fn_set:
+            yield fi, cv2.imread( os.path.join(self.dir_path, 'f%.6i.jpg'%fi) )
+            fi += 1
+
+#====================================================
+
+class VideoFrameSource(object):
+# Frames of a trial, decoded directly from the session movie file (MP4),
+# -PRE_ONSET ~ +(DURATION-PRE_ONSET) seconds around the stimulus onset, cropped as 'm_extract_frames.py' does.
+# It's the same frames as the extracted JPG images, without JPG encoding/decoding and files.
+# Iterating it yields (frame index; 1~, frame image; numpy array of BGR image)
+
+    def __init__(self, movie_path, movie_ts, start_fi=1):
+        self.movie_path = movie_path
+        self.movie_ts = movie_ts # stimulus onset time in the movie (from get_trial_list of 'm_extract_frames.py')
+        self.frame_cnt = int(DURATION*FPS)
+        self.start_fi = start_fi # the first frame to read (1~)
+
+    #------------------------------------------------
+
+    def __iter__(self):
+        cap = cv2.VideoCapture(self.movie_path)
+        movie_fi = int(round( (self.movie_ts-PRE_ONSET) * FPS )) + self.start_fi - 1 # frame index in the movie
+        if cap.set(getattr(cv2, 'CAP_PROP_POS_FRAMES', 1), movie_fi) == False:
+            for i in xrange(movie_fi): cap.grab() # seeking is not supported; skip frames
+        w, h, x, y = CROP
+        for fi in xrange(self.start_fi, int(DURATION*FPS)+1):
+            ret, img = cap.read()
+            if ret == False: break # end of the movie
+            yield fi, np.ascontiguousarray(img[y:y+h, x:x+w])
+        cap.release()
+
+#====================================================
+
+class PrefetchFrameSource(object):
+# Reads frames of another frame source ahead on a background thread,
+# so that reading & decoding frames overlaps with the analysis of the current frame.
+# Frames are copied into a ring of 'n_ahead'+1 buffers, allocated once with the first frame.
+# A yielded frame array is valid until the next frame is requested. (copy it to keep it longer)
+
+    def __init__(self, frame_source, n_ahead=8):
+        self.frame_source = frame_source
+        self.n_ahead = n_ahead
+        self.frame_cnt = frame_source.frame_cnt
+        self.start_fi = frame_source.start_fi
+
+    #------------------------------------------------
+
+    def read_frames(self, ready_q, free_q, stop_evt):
+    # (background thread) reads frames into free buffers and passes them to the analysis loop
+        try:
+            for fi, frame in self.frame_source:
+                if self.ring == None: self.ring = [ np.empty_like(frame) for i in xrange(self.n_ahead+1) ]
+                while True:
+                    if stop_evt.is_set(): return
+                    try: bi = free_q.get(timeout=0.1) # buffer index
+                    except Queue.Empty: continue
+                    break
+                if self.ring[bi].shape != frame.shape: self.ring[bi] = np.empty_like(frame)
+                self.ring[bi][...] = frame
+                ready_q.put( ('frame', fi, bi) )
+            ready_q.put( ('end', None, None) )
+        except Exception:
+            ready_q.put( ('error', traceback.format_exc(), None) )
+
+    #------------------------------------------------
+
+    def __iter__(self):
+        self.ring = None
+        ready_q = Queue.Queue()
+        free_q = Queue.Queue()
+        for bi in xrange(self.n_ahead+1): free_q.put(bi)
+        stop_evt = threading.Event()
+        th = threading.Thread(target=self.read_frames, args=(ready_q, free_q, stop_evt))
+        th.daemon = True
+        th.start()
+        try:
+            while True:
+                flag, fi, bi = ready_q.get()
+                if flag == 'end': break
+                elif flag == 'error': raise IOError('Reading frames failed.\n%s'%fi)
+                yield fi, self.ring[bi]
+                free_q.put(bi) # the previous frame is done
+        finally:
+            stop_evt.set()
+            th.join()
+
+#------------------------------------------------
+
+def get_trial_sources(results_dir, log_path=None, movie_path=None):
+# returns a list of (trial name, frame source) to analyze.
+# trials of the session movie, when LOG and movie file paths are given.
+# otherwise, directories of extracted frames in 'results_dir'.
+    if log_path != None and movie_path != None:
+        return [ (dirname, VideoFrameSource(movie_path, movie_ts)) for dirname, movie_ts, li in get_trial_list(log_path, movie_path) ]
+    else:
+        return [ (dirname, DirFrameSource(results_dir, dirname)) for dirname in get_trial_dirs(results_dir) ]
+
+#------------------------------------------------
+
+def get_checkpoint_fp(results_dir, dirname):
+# checkpoint file of a trial; in 'checkpoint' directory, not to be mixed with result files
+    return os.path.join(results_dir, 'checkpoint', dirname + '.plist')
+
+#------------------------------------------------
+
+def load_checkpoint(results_dir, dirname):
+# returns the checkpoint of a trial (dictionary), or None if there's none (or it's broken)
+# last_fi : the last frame, whose result was committed into the result files
+# done : whether the trial was completely analyzed
+# state : analyzer state after the last frame (HeadDirectionAnalyzer.get_state)
+    fp = get_checkpoint_fp(results_dir, dirname)
+    if not os.path.isfile(fp): return None
+    try: ckpt = plistlib.readPlist(fp)
+    except Exception: return None
+    if 'last_fi' not in ckpt or 'done' not in ckpt or 'state' not in ckpt: return None
+    return ckpt
+
+#------------------------------------------------
+
+def save_checkpoint(results_dir, dirname, ckpt):
+    fp = get_checkpoint_fp(results_dir, dirname)
+    if not os.path.isdir(os.path.dirname(fp)): os.mkdir(os.path.dirname(fp))
+    tmp_fp = '%s.%i.tmp'%(fp, os.getpid())
+    plistlib.writePlist(ckpt, tmp_fp)
+    os.rename(tmp_fp, fp)
+
+#------------------------------------------------
+
+def open_trial(analyzer, dirname, frame_source, resume=True):
+# prepares the analyzer, frame source and result writer of a trial.
+# with 'resume', a trial, which was partially analyzed before, continues after its last committed frame.
+# returns the result writer, or None when the trial was already completed.
+    analyzer.init_trial(dirname)
+    ckpt = None
+    if resume == True: ckpt = load_checkpoint(analyzer.results_dir, dirname)
+    elif os.path.isfile(get_checkpoint_fp(analyzer.results_dir, dirname)):
+        os.remove(get_checkpoint_fp(analyzer.results_dir, dirname))
+    if ckpt != None and ckpt['done'] == True: return None
+    csv_file_path = os.path.join( analyzer.results_dir, dirname + ".csv" )
+    if ckpt == None or not os.path.isfile(csv_file_path):
+        return ResultWriter(csv_file_path) # result CSV file & its binary sidecar
+    analyzer.set_state(ckpt['state'])
+    frame_source.start_fi = ckpt['last_fi'] + 1
+    return ResultWriter(csv_file_path, resume_fi = ckpt['last_fi'])
+
+#------------------------------------------------
+
+def commit_trial(analyzer, dirname, outputCSV, fi, done=False):
+# writes results up to the frame 'fi' and the checkpoint after it
+    if done == True and analyzer.params['flip_mode'] == 'global':
+        outputCSV.replace_rows( resolve_flips(outputCSV.rows, analyzer.confidence) )
+    outputCSV.flush()
+    if done == True: analyzer.save_features()
+    save_checkpoint(analyzer.results_dir, dirname, dict(last_fi = fi, done = done, state = analyzer.get_state()))
+
+#------------------------------------------------
+
+def analyze_dir(analyzer, dirname, frame_source=None):
+# analyze all the frames of a trial and write its result CSV file
+# frame_source: DirFrameSource or VideoFrameSource. (DirFrameSource of 'dirname', when it's None)
+# with 'resume' parameter, the trial is skipped if it was completed, or continued if it was partially analyzed
+# returns the number of processed frames (-1 when it was already completed)
+    if debug: print 'analyze_dir'
+
+    if frame_source == None: frame_source = DirFrameSource(analyzer.results_dir, dirname)
+    outputCSV = open_trial(analyzer, dirname, frame_source, analyzer.params['resume']) # result CSV file & its binary sidecar
+    if outputCSV == None: return -1
+    last_fi = frame_source.start_fi - 1
+    if analyzer.params['prefetch'] > 0: frame_source = PrefetchFrameSource(frame_source, analyzer.params['prefetch'])
+    analyzer.prof.reset()
+    frame_cnt = 0
+    for fi, frame in frame_source:
+        analyzer.prof.start_frame(fi)
+        res = analyzer.proc_frame(fi, frame)
+        with analyzer.prof.stage('csv'):
+            if res['row'] != None: outputCSV.write(res['row'])
+        analyzer.prof.end_frame()
+        frame_cnt += 1
+        last_fi = fi
+        if fi % CHECKPOINT_INTERVAL == 0: commit_trial(analyzer, dirname, outputCSV, fi)
+    commit_trial(analyzer, dirname, outputCSV, last_fi, True)
+    if analyzer.prof.enabled: analyzer.prof.write_csv( get_profile_fp(analyzer.results_dir, dirname) )
+    return frame_cnt
+
+#------------------------------------------------
+
+def analyze_chunk(analyzer, dirname, frame_source, start_fi, end_fi):
+# analyze frames 'start_fi' ~ 'end_fi' of a trial, independently from other frames of the trial,
+# so that chunks of a trial can be analyzed in parallel and in any order. ('flip_mode' should be 'global')
+# nothing is written; the rows of all the chunks are written by finish_chunked_trial.
+# returns (result rows, {row frame-index: confidence}, number of processed frames)
+    if debug: print 'analyze_chunk'
+
+    analyzer.init_trial(dirname)
+    frame_source.start_fi = start_fi
+    if analyzer.params['prefetch'] > 0: frame_source = PrefetchFrameSource(frame_source, analyzer.params['prefetch'])
+    rows = []
+    frame_cnt = 0
+    for fi, frame in frame_source:
+        if fi > end_fi: break
+        res = analyzer.proc_frame(fi, frame)
+        if res['row'] != None: rows.append(res['row'])
+        frame_cnt += 1
+    analyzer.save_features()
+    return rows, dict(analyzer.confidence), frame_cnt
+
+#------------------------------------------------
+
+def finish_chunked_trial(results_dir, dirname, rows, confidence, last_fi):
+# writes result files & the checkpoint of a trial, which was analyzed in chunks (analyze_chunk),
+# after resolving the 180 degrees ambiguity of head directions of the whole trial
+    rows = resolve_flips(rows, confidence)
+    outputCSV = ResultWriter(os.path.join(results_dir, dirname + '.csv'), max(1, len(rows)))
+    outputCSV.replace_rows(rows)
+    outputCSV.close()
+    save_checkpoint(results_dir, dirname, dict(last_fi = last_fi, done = True, state = {}))
+
+#====================================================
+
+debug = False
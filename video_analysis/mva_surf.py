@@ -23,6 +23,29 @@ It will go through all the directories in 'results' directory,
 generating a result CSV file for each directory,  named as same as 
 the directory.
 
+Usage :
+python mva_surf.py [-P] [-n] [-g] [-e surf/orb] [-d] [-G] [-r fps] [LOG file path] [MP4 file path]
+  Without arguments, frames are read from the directories in 'results'.
+  With the session LOG and MP4 files, trials are analyzed directly from
+  the movie file, as 'm_extract_frames.py' would extract them.
+  (Template head images and result CSV files are still in 'results')
+  -P : profile; per-frame processing time of each stage is written in
+       'results/profile' directory. (see 'mva_batch.py')
+  -n : new run; ignore checkpoints of a previous run. Without it, trials
+       completed in a previous run are skipped, and a partially analyzed
+       trial continues after its last checkpoint.
+  -g : motion gate; the result of the previous frame is carried over,
+       when nothing moved around the head. (see 'mva_batch.py')
+  -e [surf/orb] : feature engine for detecting & matching the head
+       (default: surf). (see 'mva_batch.py')
+  -d : descriptor cache; features of frames are read from (or stored in)
+       'results/features' directory. (see 'mva_batch.py')
+  -G : global flip resolution; which side the head faces is resolved for
+       the whole trial when it's finished. (see 'mva_batch.py')
+  -r [number] : maximum number of displayed frames per second while
+       running (default: 15). Frames are analyzed in a separate thread
+       as fast as possible; only the latest analyzed frame is displayed.
+
 ----------------------------------------------------------------------
 Copyright (C) 2014 Jinook Oh, W. Tecumseh Fitch for ERC Advanced Grant 
 SOMACCA # 230604 
@@ -42,7 +65,7 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import os, plistlib
+import os, plistlib, getopt, threading, traceback
 from glob import glob
 from copy import copy
 from math import degrees, radians, hypot, acos, sin, cos, atan2
@@ -56,45 +79,16 @@ import wx
 import cv2
 import cv2.cv as cv
 import numpy as np
-from scipy.cluster.hierarchy import fclusterdata
 from scipy import polyfit, polyval
 
-from common_funcs import GNU_notice, writeFile, get_time_stamp, PopupDialog
-
-
-# --------------------------------------------------
-
-def get_angle(pt1, pt2):
-# calculates the angle of a straight line drawn between point one and two.
-    dx = pt2[0] - pt1[0]
-    dy = (pt2[1] - pt1[1]) * -1
-    return degrees( atan2(dy, dx) )
-
-# --------------------------------------------------
-
-def rotate_line(frame_size, pt1, pt2, r_deg=90):
-# for rotating a line between pt1 and pt2
-# r_deg: angle to rotate
-    y_list = [pt1[1], pt2[1]]
-    dx = abs(pt1[0]-pt2[0])
-    dy = abs(pt1[1]-pt2[1])
-    line_len = 100 # max(dx, dy)
-    cx = pt1[0] + dx/2 # center X
-    cy = min(y_list) + dy/2 # center Y
-    deg = get_angle(pt1, pt2)
-    if deg < 0: deg = 360 + deg
-    r_deg = ( deg + r_deg ) % 360 # rotate given degrees from the degrees of the line
-    theta = radians(r_deg)
-    r_pt1 = [cx, cy]
-    r_pt2 = [ cx + int( line_len*cos(theta) - (1*sin(theta)) ), 
-              cy - int( line_len*sin(theta) + (1*cos(theta)) ) ]
-    return r_deg, tuple(r_pt1), tuple(r_pt2)
+from common_funcs import GNU_notice, writeFile, get_time_stamp, PopupDialog, FrameMailbox
+from mva_engine import HeadDirectionAnalyzer, get_trial_sources, PrefetchFrameSource, get_profile_fp, summarize_profiles, load_calibration, save_calibration, draw_result, open_trial, commit_trial, CHECKPOINT_INTERVAL
 
 #====================================================
 
 class MarmosetVideoAnalysis(wx.Frame):
 
-    def __init__(self):
+    def __init__(self, log_path=None, movie_path=None, params=None, preview_fps=None):
         if debug: print 'MarmosetVideoAnalysis.__init__'
 
         w_size = (1280, 770)
@@ -110,12 +104,9 @@ class MarmosetVideoAnalysis(wx.Frame):
         self.last_movement_pos = None
         self.mov_th = 15 # threshold(width+height of the rect which surrounds one fragment of contours) to be accounted as valid contour fragment for movement
         self.m_th = 150 # upper-threshold for movement rect
-        self.s_frag_th = 30 # lower-threshold for subject's fragment rect size
         self.s_rect_size_th = [40, 150]
         self.HSV_min_wht = (0, 0, 200)
         self.HSV_max_wht = (179, 50, 255)
-        self.HSV_min_ear = (0,0,150) # for Marmoset's ear
-        self.HSV_max_ear = (179,40,255) # for Marmoset's ear
         self.HSV_min_wood = (10, 50, 150) # wooden color
         self.HSV_max_wood = (30, 255, 255) # wooden color
         self.HSV_min_black = (0,0,0)
@@ -127,13 +118,29 @@ class MarmosetVideoAnalysis(wx.Frame):
 
         self.font = cv.InitFont(cv.CV_FONT_HERSHEY_SIMPLEX, 0.5, 0.5, 0, 1, 8)
         self.dirname = None
-        self.timer_proc_img = None
+        self.frame_size = None
+        self.temp_draw = None
         self.flag_run = False
+        self.analysis_thread = None # analyzes frames while running (spacebar), independently from the display
+        self.mailbox = FrameMailbox() # the latest analyzed frame & its result, for the preview
+        if preview_fps == None: preview_fps = PREVIEW_FPS
+        self.preview_fps = preview_fps # maximum number of displayed frames per second while running
+        self.preview_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.onPreviewTimer, self.preview_timer)
+        self.shown_dirname = None # trial of the displayed frame
+        self.rgb_bufs = {} # RGB buffers for bitmaps; key: image shape
         self.flag_draw_SURF_dots = True
-        self.dir_list = [] # sub-directory list of 'results' folder
+        self.dir_list = [] # list of (trial name, frame source) to analyze
+        self.frame_iter = None # iterator of frames of the current trial
         self.LED_rects = {}
         self.LED_base_cm = {}
         self.feeding_hole_Y = -1 # the limit position-Y due to the feeding hole (white colors above this line will be ignored)
+        self.calib_fp = os.path.join(results_dir, 'mva_calibration.plist') # calibration file for 'mva_batch.py'
+        if os.path.isfile(self.calib_fp): self.calib = load_calibration(self.calib_fp)
+        else: self.calib = load_calibration(None) # default values
+        self.analyzer = HeadDirectionAnalyzer(self.calib, results_dir, params)
+        self.prof = self.analyzer.prof # stage timing; display & CSV writing are measured here
+        self.profile_fps = [] # per-frame profile CSV files written in this run
 
         posX = 5
         posY = 5
@@ -164,7 +171,14 @@ class MarmosetVideoAnalysis(wx.Frame):
                                           (wx.ACCEL_NORMAL,  wx.WXK_SPACE, space_BtnID ) ])
         self.SetAcceleratorTable(accel_tbl)
 
-        if not os.path.isdir(results_dir):
+        if movie_path != None:
+            self.dir_list = get_trial_sources(results_dir, log_path, movie_path)
+            if len(self.dir_list) == 0:
+                self.show_msg("There is no trial in the LOG file.")
+                self.Destroy()
+            else:
+                self.init_video_analyzing()
+        elif not os.path.isdir(results_dir):
         # if output folder doesn't exist
             _msg = "Please make 'results' folder in the current working directory\n"
             _msg += " and put all the folders, containing JPG images obtained from the trial movies,"
@@ -172,18 +186,13 @@ class MarmosetVideoAnalysis(wx.Frame):
             self.show_msg(_msg)
             self.Destroy()
         else:
-            for f in glob( os.path.join(results_dir, "*") ):
-                if os.path.isdir(f):
-                    _jpg_img_file = os.path.join(f, "f000001.jpg")
-                    if os.path.isfile(_jpg_img_file):
-                        self.dir_list.append( os.path.split(f)[1] ) # store directory name
+            self.dir_list = get_trial_sources(results_dir)
             if len(self.dir_list) == 0:
                 _msg = "Please put all the folders, containing JPG images obtained from the trial movies,"
                 _msg += " into the 'results' folder."
                 self.show_msg(_msg)
                 self.Destroy()
             else:
-                self.dir_list = sorted(self.dir_list)
                 self.init_video_analyzing()
 
     #------------------------------------------------
@@ -214,23 +223,79 @@ class MarmosetVideoAnalysis(wx.Frame):
                 return
         '''
         if self.flag_run == True:
-            self.timer_proc_img.Stop()
-            self.timer_proc_img = None
-            self.flag_run = False
-        else:
-            self.flag_run = True
-            self.proc_img()
+            self.stop_analysis()
+        elif self.dirname != None:
+            ### store the feeding hole position for running analysis without GUI ('mva_batch.py')
+            self.calib['feeding_hole_Y'] = self.feeding_hole_Y
+            save_calibration(self.calib_fp, self.calib)
+            self.start_analysis()
+
+    #------------------------------------------------
+
+    def start_analysis(self):
+    # starts the analysis thread and the preview timer
+        if debug: print 'MarmosetVideoAnalysis.start_analysis'
+
+        self.flag_run = True
+        self.analysis_thread = threading.Thread(target = self.run_analysis)
+        self.analysis_thread.daemon = True
+        self.analysis_thread.start()
+        self.preview_timer.Start(max(1, int(1000.0/self.preview_fps)))
+
+    #------------------------------------------------
+
+    def stop_analysis(self):
+    # stops the analysis thread after the frame being analyzed, then shows the last analyzed frame
+        if debug: print 'MarmosetVideoAnalysis.stop_analysis'
+
+        self.flag_run = False
+        if self.analysis_thread != None:
+            self.analysis_thread.join()
+            self.analysis_thread = None
+        self.preview_timer.Stop()
+        self.onPreviewTimer(None)
+
+    #------------------------------------------------
+
+    def run_analysis(self):
+    # analysis thread; analyzes frames until it's stopped or all the trials are finished.
+    # each result is posted into the mailbox, and the GUI shows the latest one at the preview rate.
+        if debug: print 'MarmosetVideoAnalysis.run_analysis'
+
+        try:
+            while self.flag_run == True:
+                ret = self.analyze_frame()
+                if ret == None: break # no more trial
+                fi, frame, res = ret
+                self.mailbox.post(frame, (self.dirname, self.analyzer.template_fp, fi, self.frame_cnt, res))
+        except Exception:
+            print traceback.format_exc()
+        self.flag_run = False
+
+    #------------------------------------------------
+
+    def onPreviewTimer(self, event):
+    # shows the latest analyzed frame (if there's a new one), at most 'preview_fps' times per second
+        img, info = self.mailbox.take()
+        if img is not None: self.show_frame(img, *info)
+        if self.flag_run == False and self.analysis_thread != None:
+        # the analysis thread stopped by itself (all the trials were finished, or an error)
+            self.analysis_thread.join()
+            self.analysis_thread = None
+            self.preview_timer.Stop()
+            self.onPreviewTimer(None) # a frame posted right before the end
 
     #------------------------------------------------
     
     def cvImg_to_wxBMP(self, cvImg):
+    # cvImg: numpy array of BGR image
+    # it's converted into a RGB buffer (reused for the same image size), which the bitmap is made from
         if debug: print 'MarmosetVideoAnalysis.cvImg_to_wxBMP'
 
-        cv.CvtColor(cvImg, cvImg, cv.CV_BGR2RGB)
-        img = wx.EmptyImage(cvImg.width, cvImg.height)
-        img.SetData(cvImg.tostring())
-        bmp = img.ConvertToBitmap()
-        return bmp
+        if cvImg.shape not in self.rgb_bufs: self.rgb_bufs[cvImg.shape] = np.empty_like(cvImg)
+        rgb_buf = self.rgb_bufs[cvImg.shape]
+        cv2.cvtColor(cvImg, cv2.COLOR_BGR2RGB, dst=rgb_buf)
+        return wx.BitmapFromBuffer(cvImg.shape[1], cvImg.shape[0], rgb_buf)
 
     #------------------------------------------------
 
@@ -244,7 +309,7 @@ class MarmosetVideoAnalysis(wx.Frame):
                 bmp = img.ConvertToBitmap()
                 ret_img = wx.StaticBitmap(self.panel, -1, bmp, self.loaded_img_pos)
             elif flag == 'cv':
-                ret_img = cv.LoadImage(filepath)
+                ret_img = cv2.imread(filepath)
         return ret_img
 
     #------------------------------------------------
@@ -304,14 +369,12 @@ class MarmosetVideoAnalysis(wx.Frame):
     def onStoreLEDBaseCM(self, event):
     # check each LED's base central moments
         for key in self.LED_rects.iterkeys():
-            self.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
+            self.analyzer.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
                             self.orig_img, 
                             self.HSV_min_wht, 
                             self.HSV_max_wht, 
                             (0,0,0))
-            img_mat = cv.GetMat(self.tmp_grey_img)
-            moments = cv.Moments(img_mat)
-            cm = cv.GetCentralMoment(moments, 0, 0)
+            cm = cv2.moments(self.analyzer.roi_mask)['m00'] # zeroth moment of the found color
             self.LED_base_cm[key] = cm
         self.show_msg('Central moment of each LED is stored.')
 
@@ -321,14 +384,12 @@ class MarmosetVideoAnalysis(wx.Frame):
     # check LED whether white light is on or not
         LED_on = [ False, False, False, False ]
         for key in self.LED_rects.iterkeys():
-            self.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
+            self.analyzer.find_color((self.LED_rects[key][0],self.LED_rects[key][1],self.LED_rects[key][2],self.LED_rects[key][3]), 
                             self.curr_frame, 
                             self.HSV_min_wht,  
                             self.HSV_max_wht, 
                             (0,0,0))
-            img_mat = cv.GetMat(self.tmp_grey_img)
-            moments = cv.Moments(img_mat)
-            cm = cv.GetCentralMoment(moments, 0, 0)
+            cm = cv2.moments(self.analyzer.roi_mask)['m00'] # zeroth moment of the found color
             if self.LED_base_cm[key] != -1 and cm > self.LED_base_cm[key] + 300:
                 LED_on[ self.LED_labels.index(key) ] = True
             #print self.LED_base_cm[i], cm
@@ -340,52 +401,11 @@ class MarmosetVideoAnalysis(wx.Frame):
     # initialize variables for video image processing
         if debug: print 'MarmosetVideoAnalysis.init_video_analyzing'
 
-        if len(self.dir_list) == 0: # there's no more directory
-            self.flag_run = False
-            return
-        else:
-            self.dirname = self.dir_list[0]
-        ### for Marmoset's ear
-        if 'Pooh' in self.dirname: self.HSV_min_ear = (0,0,120)
-        elif 'Yara' in self.dirname: self.HSV_min_ear = (0,0,165)
-        elif 'Kobold' in self.dirname: self.HSV_min_ear = (0,0,120)
-        elif 'Smart' in self.dirname: self.HSV_min_ear = (0,0,160)
-        elif 'Locri' in self.dirname: self.HSV_min_ear = (0,0,160)
-        elif 'Augustina' in self.dirname: self.HSV_min_ear = (0,0,150)
-        else: self.HSV_min_ear = (0,0,140)
-        
-        self.dir_list.pop(0)
-        csv_file_path = os.path.join( results_dir, self.dirname + ".csv" )
-        self.outputCSV = open(csv_file_path, 'w') # result output CSV file
-        self.outputCSV.write('# Ear-rect : Ear1_UpperLeft_PT/Ear1_LowerRight_PT/Ear2_UpperLeft_PT/Ear2_LowerRight_PT\n')
-        self.outputCSV.write('Frame-index, Ear-rect, Direction, Direction-line-start, Direction-line-end\n')
-        self.sTxt_fn.SetLabel('FolderName: %s'%(self.dirname))
-        self.fi = 1 # frame index; Marmoset frame files' indices are 1~1000
-        _fp = os.path.join(results_dir, self.dirname, 'f%.6i.jpg'%self.fi)
-        frame = cv.LoadImage(_fp) # load image
-        self.frame_size = cv.GetSize(frame)
-        self.SetSize( (self.frame_size[0]+10, self.frame_size[1]+50) )
-        self.frame_cnt = len(glob( os.path.join(results_dir, self.dirname, '*.jpg') ))
-        self.curr_frame = cv.CreateImage(self.frame_size, 8, 3)
-        self.orig_img = cv.CreateImage(self.frame_size, 8, 3)
-        self.HSV_img = cv.CreateImage(self.frame_size, 8, 3)
-        self.tmp_col_img = cv.CreateImage(self.frame_size, 8, 3)
-        self.grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
-        self.grey_avg = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_32F, 1)
-        self.tmp_grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
-        self.diff_grey_img = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_8U, 1)
-        self.grey_avg = cv.CreateImage(self.frame_size, cv.IPL_DEPTH_32F, 1)
-        self.storage = cv.CreateMemStorage(0)
-        self.mask_img = cv.CreateImage(self.frame_size, 8, 1)
-        _tmp = self.dirname.split('_')
-        _head_fn = '%s_%s_head.jpg'%(_tmp[0], _tmp[1])
-        self.template_fp = os.path.join(results_dir, _head_fn)
-        self.template_img = cv.LoadImage( self.template_fp )
-        #cv.CvtColor(self.template_img, self.template_img, cv.CV_BGRA2BGR)
+        self.fi, frame = self.next_trial()
+        if frame is None: return # there's no trial to analyze
         self.first_run = True
 
-        self.curr_frame = cv.CloneImage(frame)
-        if self.feeding_hole_Y == -1: self.feeding_hole_Y = 240
+        if self.feeding_hole_Y == -1: self.feeding_hole_Y = self.calib['feeding_hole_Y']
         
         ### init LED related variables
         if len(self.LED_rects) == 0:
@@ -404,317 +424,131 @@ class MarmosetVideoAnalysis(wx.Frame):
         self.LED_prev_on = [False, False, False, False]
         self.selected_obj_key = -1
         
-        self.prev_hd = [] # previous head directions
-        self.prev_hd_last = -1 # frame number when the last head direction was updated
         self.proc_img(frame) # display the 1st frame
 
     #------------------------------------------------
 
-    def proc_img(self, frame=None):
-    # read a jpg image, computer vision process, then display it.
-        if debug: print 'MarmosetVideoAnalysis.proc_img'
+    def next_trial(self):
+    # opens the next trial to analyze (no GUI; it's also called in the analysis thread)
+    # returns (frame index, frame image) of its first frame to analyze, or (None, None) when there's no more trial
+        if debug: print 'MarmosetVideoAnalysis.next_trial'
 
-        if frame == None:
-            self.fi += 1
-            _fp = os.path.join(results_dir, self.dirname, 'f%.6i.jpg'%self.fi)
-            if os.path.isfile(_fp) == False: # file doesn't exist
-                self.init_video_analyzing() # move to the next trial folder
-                return
-            else:
-                self.orig_img = cv.LoadImage(_fp) # load image
-        else: 
-            self.orig_img = frame
-        cv.Copy(self.orig_img, self.curr_frame)
-
-        cv.Line(self.curr_frame, (0,self.feeding_hole_Y-1), (self.frame_size[0],self.feeding_hole_Y-1), (50,50,50), 1) # bottom of feeding hole
-
-        self.grey_img = self.preprocessing(self.orig_img)
-
-        # ------------------------------------------------
-        # SURF extraction starts
-        # ------------------------------------------------
-        t_img = cv2.imread(self.template_fp)
-        cv.Zero(self.mask_img)
-        cv.Zero(self.tmp_grey_img)
-        cv.Rectangle(self.mask_img, (0,self.feeding_hole_Y), (self.frame_size[0], self.frame_size[1]), 255, -1)
-        cv.Copy(self.grey_img, self.tmp_grey_img, self.mask_img) # copy only below feeding hole
-        mat = cv.GetMat(self.tmp_grey_img)
-        hgrey = np.asarray(mat)
-        ngrey = cv2.cvtColor(t_img, cv2.COLOR_BGR2GRAY)
-
-        # build feature detector and descriptor extractor
-        hessian_threshold = 300
-        detector = cv2.SURF(hessian_threshold)
-        (hkeypoints, hdescriptors) = detector.detectAndCompute(hgrey, None, useProvidedKeypoints = False)
-        (nkeypoints, ndescriptors) = detector.detectAndCompute(ngrey, None, useProvidedKeypoints = False)
-
-        # extract vectors of size 64 from raw descriptors numpy arrays
-        rowsize = len(hdescriptors) / len(hkeypoints)
-        if rowsize > 1:
-            hrows = np.array(hdescriptors, dtype = np.float32).reshape((-1, rowsize))
-            nrows = np.array(ndescriptors, dtype = np.float32).reshape((-1, rowsize))
-            #print hrows.shape, nrows.shape
-        else:
-            hrows = np.array(hdescriptors, dtype = np.float32)
-            nrows = np.array(ndescriptors, dtype = np.float32)
-            rowsize = len(hrows[0])
-
-        # kNN training - learn mapping from hrow to hkeypoints index
-        samples = hrows
-        responses = np.arange(len(hkeypoints), dtype = np.float32)
-        #print len(samples), len(responses)
-        knn = cv2.KNearest()
-        knn.train(samples,responses)
-
-        # retrieve index and value through enumeration
-        if self.flag_draw_SURF_dots == True: temp_img = cv.CloneImage(self.template_img)
-        m_pts = [] # list of matched points
-        for i, descriptor in enumerate(nrows):
-            descriptor = np.array(descriptor, dtype = np.float32).reshape((1, rowsize))
-            #print i, descriptor.shape, samples[0].shape
-            retval, results, neigh_resp, dists = knn.find_nearest(descriptor, 1)
-            res, dist =  int(results[0][0]), dists[0][0]
-            #print res, dist
-
-            if dist < 0.1:
-                # draw matched keypoints in red color
-                color = (0, 0, 255)
-                x,y = hkeypoints[res].pt
-                m_pts.append( (int(x),int(y)) )
-            else:
-                # draw unmatched in blue color
-                color = (255, 0, 0)
-            if self.flag_draw_SURF_dots == True:
-                ### draw matched key points on haystack image
-                x,y = hkeypoints[res].pt
-                center = (int(x),int(y))
-                cv.Circle(self.curr_frame, center, 2, color, -1)
-                ### draw matched key points on needle image
-                x,y = nkeypoints[i].pt
-                center = (int(x),int(y))
-                cv.Circle(temp_img, center, 2, color, -1)
-
-        # ------------------------------------------------
-        # SURF extraction ends
-        # ------------------------------------------------
-
-        if len(m_pts) >= 3:
-        # there are, at least, 2 matched points after SURF
-            number_of_mGroups, mGroups = self.clustering(m_pts, 100) # clustrering matched points
-            len_mg = []
-            for mg in mGroups: len_mg.append( len(mg) )
-            idx = len_mg.index( max(len_mg) )
-            mg_r = cv.BoundingRect( mGroups[idx] )
-            if mg_r[2] + mg_r[3] > 75:
-            # process only if the head rect size is big enough
-                ### calculate the average x & y of the group as the center point of head
-                _cx = 0; _cy = 0
-                for mg in mGroups[idx]: _cx += mg[0]; _cy += mg[1]
-                center = ( _cx/len(mGroups[idx]), _cy/len(mGroups[idx]) )
-                #cv.Circle(self.curr_frame, center, 5, (0,255,255), -1)
-                ### draw rectangle for head position
-                h_rect = [center[0]-150, center[1]-100, center[0]+150, center[1]+100] # head rect (x1,y1,x2,y2 rect)
-                if h_rect[1] <= self.feeding_hole_Y: h_rect[1] = self.feeding_hole_Y + 1
-                cv.Rectangle(self.curr_frame, (h_rect[0],h_rect[1]), (h_rect[2],h_rect[3]), (0,255,255), 1)
-                ### find ear color
-                self.find_color((h_rect[0],h_rect[1],h_rect[2],h_rect[3]), 
-                                self.curr_frame, 
-                                self.HSV_min_ear, 
-                                self.HSV_max_ear, 
-                                (0,0,0))
-                _pt1_list, _pt2_list, _min_pt1, _max_pt2, _center_pt_list = self.get_points(self.tmp_grey_img, self.s_frag_th)
-                number_of_eGroups, eGroups = self.clustering(_center_pt_list, 55) # clustrering ear points
-                pt1_list = []; pt2_list = []; center_pt_list = []; sz =  []
-                for ept_group in eGroups:
-                    ### group points with the grouped center points
-                    _pts = []
-                    for ept in ept_group:
-                        _idx = _center_pt_list.index(ept)
-                        _pts.append(_pt1_list[_idx])
-                        _pts.append(_pt2_list[_idx])
-                    er = cv.BoundingRect(_pts)
-                    if er[2]+er[3] < 40: continue # exclude too small rects
-                    ### calculate and store grouped rects
-                    pt1_list.append( (er[0], er[1]) )
-                    pt2_list.append( (er[0]+er[2], er[1]+er[3]) )
-                    center_pt_list.append( (er[0]+er[2]/2, er[1]+er[3]/2) )
-                    sz.append( er[2]+er[3] )
-                    cv.Rectangle(self.curr_frame, pt1_list[-1], pt2_list[-1], (255,255,0), 1)
-                if len(pt1_list) >= 2: 
-                # there are, at least, 2 rects
-                    ### get indices for the largest and the 2nd largest
-                    ear1_idx = -1; ear2_idx = -1
-                    for _ei in xrange(len(pt1_list)):
-                        if ear1_idx == -1: ear1_idx = copy(_ei)
-                        else:
-                            if sz[_ei] > sz[ear1_idx]: ear1_idx = copy(_ei) 
-                    for _ei in xrange(len(pt1_list)):
-                        if _ei == ear1_idx: continue
-                        if ear2_idx == -1: ear2_idx = copy(_ei)
-                        else:
-                            if sz[_ei] > sz[ear2_idx]: ear2_idx = copy(_ei)
-                    if ear1_idx != -1 and ear2_idx != -1:
-                    # if indices of both ears are determined.
-                        ear1_center = center_pt_list[ear1_idx]
-                        ear2_center = center_pt_list[ear2_idx]
-                        ### draw ear rects and record it in CSV
-                        cv.Rectangle(self.curr_frame, pt1_list[ear1_idx], pt2_list[ear1_idx], (255,0,0), 1)
-                        cv.Rectangle(self.curr_frame, pt1_list[ear2_idx], pt2_list[ear2_idx], (255,0,0), 1) 
-                        _earR = '%i/%i/%i/%i'%(pt1_list[ear1_idx][0], 
-                                               pt2_list[ear1_idx][1], 
-                                               pt1_list[ear2_idx][0], 
-                                               pt2_list[ear2_idx][1])
-                        ### left side point becomes pos1
-                        if pt1_list[ear2_idx][0] < pt1_list[ear1_idx][0]:
-                            tmp = copy(ear1_idx)
-                            ear1_idx = copy(ear2_idx)
-                            ear2_idx = tmp
-                        ### display line connecting ears & head direction line
-                        pos1 = [ pt1_list[ear1_idx][0] + abs(pt1_list[ear1_idx][0]-pt2_list[ear1_idx][0])/2, 
-                                 pt1_list[ear1_idx][1] + abs(pt1_list[ear1_idx][1]-pt2_list[ear1_idx][1])/2 ]
-                        pos2 = [ pt1_list[ear2_idx][0] + abs(pt1_list[ear2_idx][0]-pt2_list[ear2_idx][0])/2, 
-                                 pt1_list[ear2_idx][1] + abs(pt1_list[ear2_idx][1]-pt2_list[ear2_idx][1])/2 ]
-                        cv.Line(self.curr_frame, tuple(pos1), tuple(pos2), (255,0,0), 1) # line between ears
-                        r_deg, r_p1, r_p2 = rotate_line(self.frame_size, pos1, pos2) # calculate head direction
-                        if len(self.prev_hd) < 1: # collect some frames as previous head direction references
-                            self.prev_hd.append( copy(r_deg) ) # store the direction
-                            self.prev_hd_last = copy( self.fi ) # last frame when the head direction was collected
-                        else:
-                            #m_val = np.median(self.prev_hd)
-                            m_val = self.prev_hd[0]
-                            '''
-                            m_val = self.prev_hd[1]
-                            for hdi in xrange(1, len(self.prev_hd)):
-                            diff = ((m_val - self.prev_hd[hdi] + 180 + 360) % 360) - 180
-                            m_val = (360 + self.prev_hd[hdi] + (diff/2)) % 360
-                            '''
-                            alt_r_deg = (r_deg + 180) % 360 # alternate degree (opposite direction)
-                            diff1 = abs(m_val - r_deg)
-                            if diff1 > 180: diff1 = 180 - (diff1 % 180)
-                            diff2 = abs(m_val - alt_r_deg)
-                            if diff2 > 180: diff2 = 180 - (diff2 % 180)
-                            #print self.fi, m_val, r_deg, alt_r_deg, diff1, diff2
-                            #print self.prev_hd
-                            if min([diff1, diff2]) < 45: # if minimum degree is bigger than 45, ignore this head direction
-                                if diff1 > diff2: # if alternate degree has smaller difference
-                                    r_deg, r_p1, r_p2 = rotate_line(self.frame_size, pos1, pos2, -90) # calculate the points again
-                                self.prev_hd.append( copy(r_deg) ) # store the direction
-                                self.prev_hd_last = copy( self.fi ) # last frame when the head direction was collected
-                                if len(self.prev_hd) == 2: self.prev_hd.pop(0) # collect 1 frame
-                                _fi = self.fi - 1 # Marmoset frame images have 1~1000 indices. Make it to 0~999
-                                _output = '%i, %s, %i, %i/%i, %i/%i\n'%( _fi, # frame-index
-                                                                         _earR, # ear-rect
-                                                                         r_deg, # (head) direction
-                                                                         r_p1[0], # direction line start point-X
-                                                                         r_p1[1], # direction line start point-Y
-                                                                         r_p2[0], # direction line end point-X
-                                                                         r_p2[1] )# direction line end point-Y
-                                self.outputCSV.write( _output ) 
-                                cv.Line(self.curr_frame, r_p1, r_p2, (0,0,255), 1) # draw head direction line
-                        if self.fi - self.prev_hd_last > 10: # if there was no head direction update for 10 frames
-                            self.prev_hd = [] # initialize previous head directions
-                            self.prev_hd_last = copy( self.fi ) # last frame when the head direction was collected
-
-        #self.tmp_col_img = cv.CreateImage(self.frame_size, 8, 3)
-        #cv.CvtColor(_tmp, self.tmp_col_img, cv.CV_GRAY2BGR)
-        self.loaded_img.SetBitmap( self.cvImg_to_wxBMP(self.curr_frame) ) # display image
-        if self.flag_draw_SURF_dots == True:
-            self.t_loaded_img.SetBitmap( self.cvImg_to_wxBMP(temp_img) )
+        if self.dirname != None: self.outputCSV.close() # result files of the previous trial
+        self.dirname = None
+        while len(self.dir_list) > 0:
+            dirname, frame_source = self.dir_list.pop(0)
+            # per-individual ear color, template path and head direction references;
+            # a trial completed in a previous run is skipped, a partially analyzed trial continues after its checkpoint
+            self.outputCSV = open_trial(self.analyzer, dirname, frame_source, self.analyzer.params['resume'])
+            if self.outputCSV == None: continue
+            if self.analyzer.params['prefetch'] > 0: frame_source = PrefetchFrameSource(frame_source, self.analyzer.params['prefetch']) # frames are read ahead while analyzing
+            self.frame_iter = iter(frame_source)
+            fi, frame = self.next_frame() # frame index; Marmoset frame indices are 1~1000
+            if frame is None: # all the frames were analyzed before
+                commit_trial(self.analyzer, dirname, self.outputCSV, frame_source.start_fi-1, True)
+                continue
+            self.dirname = dirname
+            self.frame_cnt = frame_source.frame_cnt
+            self.prof.reset()
+            return fi, frame
+        ### there's no more directory
+        if len(self.profile_fps) > 0:
+            summarize_profiles(self.profile_fps, os.path.join(results_dir, 'profile', 'mva_profile_summary.csv'))
+            self.profile_fps = []
+        return None, None
 
-        ### show timestamp
-        self.sTxt_fr.SetLabel('Frame: %i / %i'%(self.fi, self.frame_cnt))
+    #------------------------------------------------
 
-        if self.flag_run == True:
-            self.timer_proc_img = wx.FutureCall(5, self.proc_img)
+    def next_frame(self):
+    # returns (frame index, frame image; numpy array of BGR image) of the next frame of the current trial
+    # (None, None) when there's no more frame
+        if debug: print 'MarmosetVideoAnalysis.next_frame'
+        try: return self.frame_iter.next()
+        except StopIteration: return None, None
 
     #------------------------------------------------
 
-    def find_color(self, rect, inImage, HSV_min, HSV_max, bgcolor=(255,255,255)):
-    # Find a color(range: 'HSV_min' ~ 'HSV_max') in an area('rect') of an image('inImage')
-    # 'bgcolor' is a background color of the masked image
-    # Result will be stored in self.tmp_grey_img
-        if debug: print 'MarmosetVideoAnalysis.find_color'
-
-        cv.Zero(self.mask_img)
-        cv.Zero(self.tmp_grey_img)
-        cv.Set(self.tmp_col_img, bgcolor)
-        cv.Rectangle(self.mask_img, (rect[0], rect[1]), (rect[2], rect[3]), 255, cv.CV_FILLED)
-        cv.Copy(inImage, self.tmp_col_img, self.mask_img)
-        self.tmp_col_img = self.preprocessing_col(self.tmp_col_img)
-        cv.CvtColor(self.tmp_col_img, self.HSV_img, cv.CV_BGR2HSV)
-        cv.InRangeS(self.HSV_img, HSV_min, HSV_max, self.tmp_grey_img)     
+    def proc_img(self, frame=None):
+    # read the next frame (or analyze 'frame' again, as the current frame), computer vision process, then display it.
+    # (while running, frames are analyzed in the analysis thread instead; see run_analysis)
+        if debug: print 'MarmosetVideoAnalysis.proc_img'
+
+        ret = self.analyze_frame(frame)
+        if ret == None: return # no more trial
+        fi, frame, res = ret
+        self.show_frame(frame, self.dirname, self.analyzer.template_fp, fi, self.frame_cnt, res)
 
     #------------------------------------------------
 
-    def preprocessing(self, inImage):
-        if debug: print 'MarmosetVideoAnalysis.preprocessing'
-        cv.CvtColor(inImage, self.tmp_grey_img, cv.CV_RGB2GRAY)
-        #cv.Smooth(self.tmp_grey_img, self.tmp_grey_img, cv.CV_GAUSSIAN, 3, 0)
-        #cv.Dilate(self.tmp_grey_img, self.tmp_grey_img, None, 1)
-        #cv.Erode(self.tmp_grey_img, self.tmp_grey_img, None, 1)
-        return cv.CloneImage(self.tmp_grey_img)
+    def analyze_frame(self, frame=None):
+    # reads the next frame (moving to the next trial at the end of a trial), analyzes it and writes its result.
+    # with 'frame', it's analyzed again as the current frame. (no GUI; it's also called in the analysis thread)
+    # returns (frame index, frame image, result), or None when there's no more trial
+        if debug: print 'MarmosetVideoAnalysis.analyze_frame'
+
+        if self.dirname == None: return None
+        if frame is None:
+            fi, frame = self.next_frame()
+            if frame is None: # no more frame
+                commit_trial(self.analyzer, self.dirname, self.outputCSV, self.fi, True)
+                if self.prof.enabled:
+                    self.profile_fps.append( get_profile_fp(results_dir, self.dirname) )
+                    self.prof.write_csv(self.profile_fps[-1])
+                fi, frame = self.next_trial() # move to the next trial
+                if frame is None: return None
+            self.fi = fi
+
+        self.analyzer.feeding_hole_Y = self.feeding_hole_Y
+        self.prof.start_frame(self.fi)
+        res = self.analyzer.proc_frame(self.fi, frame) # computer vision process
+        with self.prof.stage('csv'):
+            if res['row'] != None: self.outputCSV.write(res['row'])
+            if self.fi % CHECKPOINT_INTERVAL == 0: commit_trial(self.analyzer, self.dirname, self.outputCSV, self.fi)
+        self.prof.end_frame()
+        return self.fi, frame, res
 
     #------------------------------------------------
-    
-    def preprocessing_col(self, inImage):
-        if debug: print 'MarmosetVideoAnalysis.preprocessing_col'
-        cv.Smooth(inImage, inImage, cv.CV_GAUSSIAN, 5, 0)
-        cv.Dilate(inImage, inImage, None, 3)
-        cv.Erode(inImage, inImage, None, 3)
-        return cv.CloneImage(inImage)
+
+    def show_trial(self, dirname, template_fp, frame_shape):
+    # prepares the display for frames of a trial
+        if debug: print 'MarmosetVideoAnalysis.show_trial'
+
+        self.shown_dirname = dirname
+        self.sTxt_fn.SetLabel('FolderName: %s'%(dirname))
+        if self.frame_size != (frame_shape[1], frame_shape[0]):
+            ### display buffer is allocated only when the frame size changes
+            self.frame_size = (frame_shape[1], frame_shape[0])
+            self.SetSize( (self.frame_size[0]+10, self.frame_size[1]+50) )
+            self.curr_frame = np.empty(frame_shape, dtype = np.uint8) # frame image to draw the result on
+        self.template_img = cv2.imread(template_fp)
+        if self.temp_draw is None or self.temp_draw.shape != self.template_img.shape:
+            self.temp_draw = np.empty_like(self.template_img) # template image to draw the result on
 
     #------------------------------------------------
 
-    def get_points(self, inImage, threshold=15):
-    # get the binary image after edge-detection and returns the some useful points of its contours
-    # 'threshold' : threshold for a contour fragment
-        if debug: print 'MarmosetVideoAnalysis.get_points'
-
-        contour = cv.FindContours(inImage, self.storage, cv.CV_RETR_CCOMP, cv.CV_CHAIN_APPROX_SIMPLE)
-        pt1_list = []
-        pt2_list = []
-        min_pt1 = []
-        max_pt2 = []
-        center_pt_list = []
-        while contour:
-            contour_list = list(contour)
-            contour = contour.h_next()
-            bound_rect = cv.BoundingRect(contour_list)
-            pt1 = (bound_rect[0], bound_rect[1])
-            pt2 = (bound_rect[0] + bound_rect[2], bound_rect[1] + bound_rect[3])
-
-            if bound_rect[2] + bound_rect[3] > threshold:
-                pt1_list.append(pt1)
-                pt2_list.append(pt2)
-                center_pt_list.append((bound_rect[0]+bound_rect[2]/2, bound_rect[1]+bound_rect[3]/2))
-                if len(min_pt1) == 0:
-                    min_pt1 = list(pt1)
-                    max_pt2 = list(pt2)
-                else:
-                    if min_pt1[0] > pt1[0]: min_pt1[0] = int(pt1[0])
-                    if min_pt1[1] > pt1[1]: min_pt1[1] = int(pt1[1])
-                    if max_pt2[0] < pt2[0]: max_pt2[0] = int(pt2[0])
-                    if max_pt2[1] < pt2[1]: max_pt2[1] = int(pt2[1])
-        return pt1_list, pt2_list, tuple(min_pt1), tuple(max_pt2), center_pt_list
+    def show_frame(self, frame, dirname, template_fp, fi, frame_cnt, res):
+    # draws the result on a frame and displays it.
+    # only displayed frames are drawn; while running, it's called at the preview rate.
+        if debug: print 'MarmosetVideoAnalysis.show_frame'
 
-    #------------------------------------------------
+        if dirname != self.shown_dirname: self.show_trial(dirname, template_fp, frame.shape)
+        self.orig_img = frame
+        self.curr_frame[:] = frame
+        cv2.line(self.curr_frame, (0,self.feeding_hole_Y-1), (self.frame_size[0],self.feeding_hole_Y-1), (50,50,50), 1) # bottom of feeding hole
+        if self.flag_draw_SURF_dots == True:
+            temp_img = self.temp_draw
+            temp_img[:] = self.template_img
+        else: temp_img = None
+        draw_result(self.curr_frame, res, temp_img, self.flag_draw_SURF_dots)
 
-    def clustering(self, pt_list, threshold):
-        if debug: print 'MarmosetVideoAnalysis.clustering'
-
-        pt_arr = np.asarray(pt_list)
-        result = []
-        try: result = list(fclusterdata(pt_arr, threshold, 'distance'))
-        except: pass
-        number_of_groups = 0
-        groups = []
-        if result != []:
-            groups = []
-            number_of_groups = max(result)
-            for i in range(number_of_groups): groups.append([])
-            for i in range(len(result)):
-                groups[result[i]-1].append(pt_list[i])
-        return number_of_groups, groups
+        #self.tmp_col_img = cv.CreateImage(self.frame_size, 8, 3)
+        #cv.CvtColor(_tmp, self.tmp_col_img, cv.CV_GRAY2BGR)
+        self.loaded_img.SetBitmap( self.cvImg_to_wxBMP(self.curr_frame) ) # display image
+        if self.flag_draw_SURF_dots == True:
+            self.t_loaded_img.SetBitmap( self.cvImg_to_wxBMP(temp_img) )
+
+        ### show timestamp
+        self.sTxt_fr.SetLabel('Frame: %i / %i'%(fi, frame_cnt))
 
     #------------------------------------------------
 
@@ -728,22 +562,36 @@ class MarmosetVideoAnalysis(wx.Frame):
 
     def onExit(self, event):
         if debug: print 'MarmosetVideoAnalysis.onExit'
-        if self.dirname != None: self.outputCSV.close()
+        if self.flag_run == True: self.stop_analysis()
+        if self.dirname != None: commit_trial(self.analyzer, self.dirname, self.outputCSV, self.fi) # to continue from here later
         self.Destroy()
 
 #====================================================
 
+PREVIEW_FPS = 15 # maximum number of displayed frames per second while running
+
 CWD = os.getcwd()
 debug = False
 results_dir = os.path.join(CWD, "results")
 
 if __name__ == "__main__":      
-    if len(argv) > 1:
-        if argv[1] == '-w': GNU_notice(1)
-        elif argv[1] == '-c': GNU_notice(2)
+    if len(argv) > 1 and argv[1] == '-w': GNU_notice(1)
+    elif len(argv) > 1 and argv[1] == '-c': GNU_notice(2)
     else:
         GNU_notice(0)  
+        params = {} # analysis parameters, different from default values (DEFAULT_PARAMS in 'mva_engine.py')
+        preview_fps = PREVIEW_FPS
+        opts, args = getopt.getopt(argv[1:], 'Pnge:dGr:')
+        for opt, val in opts:
+            if opt == '-P': params['profile'] = True
+            elif opt == '-n': params['resume'] = False
+            elif opt == '-g': params['motion_gate'] = True
+            elif opt == '-e': params['feature_engine'] = val
+            elif opt == '-d': params['feature_cache'] = True
+            elif opt == '-G': params['flip_mode'] = 'global'
+            elif opt == '-r': preview_fps = float(val)
         MVAApp = wx.PySimpleApp()
-        MVA_inst = MarmosetVideoAnalysis()
+        if len(args) > 1: MVA_inst = MarmosetVideoAnalysis(args[0], args[1], params, preview_fps) # LOG & MP4 file paths
+        else: MVA_inst = MarmosetVideoAnalysis(params=params, preview_fps=preview_fps)
         MVA_inst.Show(True)
         MVAApp.MainLoop()
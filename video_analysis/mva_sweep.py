@@ -0,0 +1,309 @@
+'''
+This is for tuning parameters of the head direction analysis
+('mva_engine.py') with a grid or random search, without GUI.
+(head turning experiment of common marmoset monkeys)
+Each (trial directory, parameter set) pair is analyzed by one of worker
+processes, and the head directions are compared with reference result
+CSV files (e.g.: results of a run with the current parameters, which
+were checked by the revision tools).
+
+Usage :
+python mva_sweep.py [options] [trial directory names]
+
+Options :
+-s [name=value1,value2,...] : values of a parameter to sweep. It can be
+     given several times; all the combinations of values are the grid.
+     Parameters are keys of DEFAULT_PARAMS in 'mva_engine.py'. Values are
+     numbers, None, strings or tuples. e.g.:
+       match_dist_th : descriptor matching (0.1)
+       head_cluster_th, ear_cluster_th : clustering thresholds (100, 55)
+       s_frag_th : lower-threshold of ear fragment rect size (30)
+       ear_V_min : lower V bound of ear color (instead of calibration)
+       ear_HSV_min.[individual] : lower HSV bound of ear color of an
+                                  individual (instead of calibration)
+       kp_band, track_win : keypoint band (None), tracking window (400,300)
+       coarse_th, coarse_min : coarse head localization scores (0.4, None)
+       lk_min_pts, lk_fb_th : optical flow tracking (8, 1.0)
+       hessian_threshold, kp_max : SURF threshold (300), keypoint cap (None, >= 400)
+-n [number] : random search; this number of parameter sets are randomly
+              chosen from the grid (default: 0, whole grid)
+-p [number] : number of worker processes (default: number of CPUs)
+-f [directory path] : directory of reference result CSV files
+                      (default: 'results')
+-d : descriptor cache (see 'mva_batch.py'); parameter sets with the same
+     feature engine parameters read features of frames from the cache.
+Without trial directory names, all the trial directories in 'results'
+directory, which have a reference result CSV file, are analyzed.
+
+e.g.: python mva_sweep.py -s match_dist_th=0.08,0.1,0.12 -s ear_V_min=120,140,160
+      python mva_sweep.py -s "kp_band=None,(300,800),(500,1200)"
+      python mva_sweep.py -s "ear_HSV_min.Pooh=(0,0,110),(0,0,130)"
+
+Each parameter set is analyzed by its own analyzer (HeadDirectionAnalyzer)
+with its own parameters; nothing is shared between parameter sets.
+Result CSV files and checkpoints in 'results' directory are not changed.
+
+Output ('results/sweep' directory) :
+sweep_[date]_[time].csv : a row for each (parameter set, trial);
+     (items of a tuple value are separated by '/', e.g.: 300/800)
+     frames, seconds, FPS, frames with head direction, and agreement
+     with the reference (frames with direction in both, mean difference
+     of direction, ratio of reference directions within 10 degrees).
+sweep_[date]_[time]_summary.csv : the same for each parameter set and
+     for each (parameter set, individual), sorted by the agreement.
+
+----------------------------------------------------------------------
+Copyright (C) 2014 Jinook Oh, W. Tecumseh Fitch for ERC Advanced Grant
+SOMACCA # 230604
+- Contact: jinook.oh@univie.ac.at, tecumseh.fitch@univie.ac.at
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import os, getopt, traceback, itertools, ast
+from time import time, strftime
+from sys import argv
+from multiprocessing import Pool, cpu_count
+
+import cv2
+import numpy as np
+
+from common_funcs import GNU_notice
+from mva_engine import DEFAULT_PARAMS, HeadDirectionAnalyzer, DirFrameSource, get_trial_dirs, load_calibration, load_result, resolve_flips
+
+#------------------------------------------------
+
+def parse_value(val):
+# a parameter value of the command line; integer, float, None, tuple (e.g.: '(300,800)') or string
+    try: value = ast.literal_eval(val)
+    except (ValueError, SyntaxError): return val # e.g.: bf, orb
+    if isinstance(value, list): value = tuple(value)
+    return value
+
+#------------------------------------------------
+
+def split_values(values):
+# values of a parameter of the command line, separated by commas, which aren't in parentheses
+    items = []; depth = 0; start = 0
+    for i, c in enumerate(values):
+        if c in '([': depth += 1
+        elif c in ')]': depth -= 1
+        elif c == ',' and depth == 0:
+            items.append(values[start:i])
+            start = i + 1
+    items.append(values[start:])
+    return [ item.strip() for item in items ]
+
+#------------------------------------------------
+
+def set_params(params, param_set):
+# updates analysis parameters with a parameter set; 'name.key' is the item 'key' of the dictionary parameter 'name'
+# (e.g.: ear_HSV_min.Pooh)
+    for name, value in param_set.iteritems():
+        if '.' in name:
+            name, key = name.split('.', 1)
+            params[name] = dict(params[name] or {})
+            params[name][key] = value
+        else:
+            params[name] = value
+
+#------------------------------------------------
+
+def get_param_sets(sweep, n_random=0, seed=0):
+# list of parameter sets (dictionaries) of the grid of 'sweep' ([(name, [values]), ...])
+# n_random: number of randomly chosen sets from the grid (0: whole grid)
+    names = [ name for name, values in sweep ]
+    grid = [ dict(zip(names, values)) for values in itertools.product(*[ values for name, values in sweep ]) ]
+    if n_random > 0 and n_random < len(grid):
+        rng = np.random.RandomState(seed)
+        grid = [ grid[i] for i in sorted(rng.choice(len(grid), n_random, replace = False)) ]
+    return grid
+
+#------------------------------------------------
+
+def init_worker(calib):
+# initializer of a worker process
+    global worker_calib
+    cv2.setNumThreads(1) # parallelism comes from worker processes
+    worker_calib = calib
+
+#------------------------------------------------
+
+def sweep_job(job):
+# analyzes a trial with a parameter set, in a worker process, without writing any result file
+# job: (parameter set index, parameters, trial directory name)
+# returns (parameter set index, directory name, number of frames, elapsed time, {row frame-index: direction}, error message)
+# (row frame-index is 0~, as the 'Frame-index' column of result CSV files)
+    set_id, params, dirname = job
+    _s_time = time()
+    try:
+        analyzer = HeadDirectionAnalyzer(worker_calib, results_dir, params) # a new analyzer for each job; nothing is shared
+        analyzer.init_trial(dirname)
+        rows = []
+        frame_cnt = 0
+        for fi, frame in DirFrameSource(results_dir, dirname):
+            res = analyzer.proc_frame(fi, frame)
+            if res['row'] != None: rows.append(res['row'])
+            frame_cnt += 1
+        if analyzer.params['flip_mode'] == 'global': rows = resolve_flips(rows, analyzer.confidence) # as commit_trial does
+        directions = dict( [ (row[0], row[2]) for row in rows ] )
+        e_time = time() - _s_time
+        analyzer.save_features()
+        return set_id, dirname, frame_cnt, e_time, directions, None
+    except Exception:
+        return set_id, dirname, -1, time()-_s_time, {}, traceback.format_exc()
+
+#------------------------------------------------
+
+def compare_directions(directions, ref):
+# agreement of head directions with the reference directions ({row frame-index: direction})
+# returns (number of frames with direction in both, sum of differences, number of reference directions within 10 degrees)
+    n_common = 0; sum_diff = 0.0; n_agree = 0
+    for fi, r_deg in directions.iteritems():
+        if fi not in ref: continue
+        diff = abs(r_deg - ref[fi]) % 360
+        if diff > 180: diff = 360 - diff
+        n_common += 1
+        sum_diff += diff
+        if diff <= 10: n_agree += 1
+    return n_common, sum_diff, n_agree
+
+#------------------------------------------------
+
+def stats_line(key, names, param_set, st):
+# a line of the result table; st: [frames, seconds, directions, reference directions, common, sum of differences, agreed]
+    frames, e_time, n_dir, n_ref, n_common, sum_diff, n_agree = st
+    line = [ str(k) for k in key ]
+    for name in names:
+        if isinstance(param_set[name], tuple): line.append( '/'.join([ str(v) for v in param_set[name] ]) ) # no comma in a CSV item
+        else: line.append( str(param_set[name]) )
+    line += [ '%i'%frames, '%.2f'%e_time, '%.1f'%(frames/max(e_time, 1e-6)), '%i'%n_dir, '%i'%n_ref, '%i'%n_common ]
+    line += [ '%.2f'%(sum_diff/max(n_common, 1)), '%.2f'%(100.0*n_agree/max(n_ref, 1)) ]
+    return ', '.join(line) + '\n'
+
+#------------------------------------------------
+
+def main(sweep, n_random, n_workers, ref_dir, dir_list, base_params):
+    calib_fp = os.path.join(results_dir, 'mva_calibration.plist')
+    if not os.path.isfile(calib_fp):
+        print '\nERROR:: Calibration file [%s] does not exist.\n'%calib_fp
+        return
+    for name, values in sweep:
+        if name.split('.')[0] not in DEFAULT_PARAMS:
+            print '\nERROR:: Unknown parameter [%s].\n'%name
+            return
+        if '.' in name and name.split('.')[0] not in DICT_PARAMS:
+            print '\nERROR:: Parameter [%s] is not a dictionary; it can\'t have an item name.\n'%name.split('.')[0]
+            return
+    if len(dir_list) == 0:
+        dir_list = [ d for d in get_trial_dirs(results_dir) if os.path.isfile(os.path.join(ref_dir, d + '.csv')) ]
+    if len(dir_list) == 0:
+        print '\nERROR:: There is no trial directory with a reference result CSV file in [%s].\n'%ref_dir
+        return
+    refs = {}
+    for dirname in dir_list:
+        ref_fp = os.path.join(ref_dir, dirname + '.csv')
+        if not os.path.isfile(ref_fp):
+            print '\nERROR:: Reference result CSV file [%s] does not exist.\n'%ref_fp
+            return
+        result = load_result(ref_fp)
+        refs[dirname] = dict( zip(result['frame'].tolist(), result['direction'].tolist()) )
+
+    names = [ name for name, values in sweep ]
+    param_sets = get_param_sets(sweep, n_random)
+    jobs = []
+    for set_id, param_set in enumerate(param_sets):
+        params = dict(DEFAULT_PARAMS)
+        params.update(base_params)
+        set_params(params, param_set)
+        for dirname in dir_list: jobs.append( (set_id, params, dirname) )
+    print '%i parameter sets x %i trials = %i jobs, %i worker(s)'%(len(param_sets), len(dir_list), len(jobs), n_workers)
+
+    out_dir = os.path.join(results_dir, 'sweep')
+    if not os.path.isdir(out_dir): os.mkdir(out_dir)
+    out_fp = os.path.join(out_dir, 'sweep_%s.csv'%strftime('%Y%m%d_%H%M%S'))
+    header = ', '.join(['Set', 'Trial'] + names + ['Frames', 'Seconds', 'FPS', 'Directions', 'Ref-directions', 'Common', 'Mean-diff', 'Agree-10deg(%)']) + '\n'
+    f = open(out_fp, 'w')
+    f.write(header)
+    s_time = time()
+    stats = {} # key: (set index, trial name), value: see stats_line
+    if n_workers <= 1:
+        init_worker(load_calibration(calib_fp))
+        results = itertools.imap(sweep_job, jobs)
+    else:
+        pool = Pool(processes = n_workers, initializer = init_worker, initargs = (load_calibration(calib_fp),))
+        results = pool.imap_unordered(sweep_job, jobs, chunksize = 1)
+    cnt = 0
+    for set_id, dirname, frame_cnt, e_time, directions, err in results:
+        cnt += 1
+        if err != None:
+            print '[%i/%i] set %i, %s : ERROR\n%s'%(cnt, len(jobs), set_id, dirname, err)
+            continue
+        st = [ frame_cnt, e_time, len(directions), len(refs[dirname]) ] + list( compare_directions(directions, refs[dirname]) )
+        stats[(set_id, dirname)] = st
+        f.write( stats_line((set_id, dirname), names, param_sets[set_id], st) )
+        f.flush()
+        print '[%i/%i] set %i, %s : %i frames, FPS: %.1f, agreement %.1f %%'%(cnt, len(jobs), set_id, dirname, frame_cnt,
+                                                                           frame_cnt/max(e_time, 1e-6), 100.0*st[6]/max(st[3], 1))
+    if n_workers > 1:
+        pool.close()
+        pool.join()
+    f.close()
+
+    ### summary for each parameter set, and for each (parameter set, individual)
+    summary = {}
+    for (set_id, dirname), st in stats.iteritems():
+        for key in [ (set_id, 'all'), (set_id, dirname.split('_')[1]) ]:
+            if key not in summary: summary[key] = [0] * len(st)
+            summary[key] = [ a + b for a, b in zip(summary[key], st) ]
+    keys = sorted( summary.keys(), key = lambda k: (k[1] != 'all', k[1], -summary[k][6]/max(summary[k][3], 1.0)) )
+    summary_fp = os.path.splitext(out_fp)[0] + '_summary.csv'
+    f = open(summary_fp, 'w')
+    f.write( header.replace('Trial', 'Individual', 1) )
+    for key in keys: f.write( stats_line(key, names, param_sets[key[0]], summary[key]) )
+    f.close()
+    print 'Finished. %i jobs, %.1f seconds'%(len(jobs), time()-s_time)
+    print open(summary_fp, 'r').read()
+    print 'Results : %s\nSummary : %s'%(out_fp, summary_fp)
+
+#------------------------------------------------
+
+DICT_PARAMS = ['ear_HSV_min'] # parameters of a dictionary, whose items can be swept with 'name.key'
+
+CWD = os.getcwd()
+results_dir = os.path.join(CWD, "results")
+
+if __name__ == '__main__':
+    if len(argv) > 1 and argv[1] == '-w': GNU_notice(1)
+    elif len(argv) > 1 and argv[1] == '-c': GNU_notice(2)
+    else:
+        GNU_notice(0)
+        sweep = [] # [(parameter name, [values]), ...]
+        n_random = 0
+        n_workers = cpu_count()
+        ref_dir = results_dir
+        base_params = dict(prefetch = 0, resume = False) # parameters of all the sets
+        opts, args = getopt.getopt(argv[1:], 's:n:p:f:d')
+        for opt, val in opts:
+            if opt == '-s':
+                name, values = val.split('=', 1)
+                sweep.append( (name.strip(), [ parse_value(v) for v in split_values(values) ]) )
+            elif opt == '-n': n_random = int(val)
+            elif opt == '-p': n_workers = int(val)
+            elif opt == '-f': ref_dir = val
+            elif opt == '-d': base_params['feature_cache'] = True
+        if len(sweep) == 0:
+            print '\nERROR:: At least one parameter to sweep has to be given. (e.g.: -s match_dist_th=0.08,0.1,0.12)\n'
+        else:
+            main(sweep, n_random, n_workers, ref_dir, args, base_params)